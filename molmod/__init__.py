@@ -54,15 +54,19 @@ from molmod.context import *
 from molmod.binning import *
 from molmod.clusters import *
 from molmod.constants import *
+from molmod.distances import *
+from molmod.formats import *
 from molmod.graphs import *
 from molmod.ic import *
 from molmod.log import *
 from molmod.minimizer import *
 from molmod.molecules import *
 from molmod.molecular_graphs import *
+from molmod.multipole import *
 from molmod.pairff import *
 from molmod.quaternions import *
 from molmod.randomize import *
+from molmod.rdf import *
 from molmod.similarity import *
 from molmod.symmetry import *
 from molmod.toyff import *
@@ -29,14 +29,22 @@
      1) Divide the given set of coordinates into bins on a regular grid
      2) Calculate the distances (or other useful things) between coordinates in
         neighboring bins.
+
+   The pair search classes compute the distances between the coordinates of
+   two bins in one vectorized step. The results can be obtained as a set of
+   arrays with the method ``as_arrays``, or pair by pair by iterating over the
+   pair search object.
 """
 
 
 from molmod.unit_cells import UnitCell
-import numpy
+import numpy, itertools, copy
 
 
-__all__ = ["PairSearchIntra", "PairSearchInter"]
+__all__ = [
+    "CellList", "PairSearchIntra", "PairSearchInter", "NeighborList",
+    "SpatialIndex", "SparseDistanceMatrix",
+]
 
 
 class Binning(object):
@@ -57,23 +65,21 @@ class Binning(object):
            Optional argument:
             | ``integer_cell``  --  the periodicity of the system in terms if
                                     integer grid cells.
+
+           Each bin is a numpy array with the (sorted) indexes of the
+           coordinates that belong to that bin.
         """
+        self.coordinates = coordinates
         self.grid_cell = grid_cell
         self.integer_cell = integer_cell
 
         # setup the bins
         self._bins = {}
 
-        fractional = grid_cell.to_fractional(coordinates)
-        for i in xrange(len(coordinates)):
-            key = tuple(fractional[i].astype(int))
-            if integer_cell is not None:
-                key = self.wrap_key(key)
-            bin = self._bins.get(key)
-            if bin is None:
-                bin = []
-                self._bins[key] = bin
-            bin.append((i, coordinates[i]))
+        self._keys = self._get_keys(coordinates)
+        self._owns_coordinates = False
+        for key, bin in self._group(numpy.arange(len(coordinates))):
+            self._bins[key] = bin
 
         # compute the neigbouring bins within the cutoff
         if self.integer_cell is None:
@@ -82,11 +88,121 @@ class Binning(object):
             max_ranges = numpy.diag(self.integer_cell.matrix).astype(int)
             max_ranges[True^self.integer_cell.active] = -1
             self.neighbor_indexes = grid_cell.get_radius_indexes(cutoff, max_ranges)
+        self._setup_half_shell()
+
+    def _get_keys(self, coordinates):
+        """Return the (wrapped) integer keys of the bins of the coordinates"""
+        keys = numpy.floor(self.grid_cell.to_fractional(coordinates)).astype(int)
+        if self.integer_cell is not None:
+            keys = self.wrap_keys(keys)
+        return keys
+
+    def _group(self, indexes):
+        """Group a sorted array of atom indexes by bin
+
+           Returns: a list of (key, indexes) tuples, sorted by key.
+        """
+        if len(indexes) == 0:
+            return []
+        keys = self._keys[indexes]
+        order = numpy.lexsort(keys.transpose()[::-1])
+        sorted_keys = keys[order]
+        boundaries = (sorted_keys[1:] != sorted_keys[:-1]).any(axis=1).nonzero()[0] + 1
+        return [
+            (tuple(keys[group[0]].tolist()), indexes[group])
+            for group in numpy.split(order, boundaries)
+        ]
+
+    def _canonical(self, shifts):
+        """Return an array of shifts, such that equivalent shifts are equal
+
+           Two shifts are equivalent when they only differ by an integer linear
+           combination of the active integer cell vectors.
+        """
+        if self.integer_cell is None:
+            return shifts.astype(float)
+        fractional = numpy.round(self.integer_cell.to_fractional(shifts), 6)
+        active = self.integer_cell.active
+        fractional[:,active] = numpy.round(fractional[:,active] % 1.0, 6) % 1.0
+        return fractional
+
+    def _setup_half_shell(self):
+        """Select one shift out of each pair of opposite neighbor shifts
+
+           When a bin B lies in the neighborhood of bin A at a shift s, bin A
+           is found in the neighborhood of B at the shift -s. Only one of both
+           shifts is retained in the array self.half_neighbor_indexes, such
+           that each pair of neighboring bins is visited only once. In
+           periodic systems, a shift may be equivalent to its own opposite,
+           e.g. half of the periodic cell. Such shifts are marked in the
+           array self.half_conjugate and are only followed when the key of
+           the neighboring bin is larger than the key of the central bin.
+           The shift towards the central bin itself is not included.
+        """
+        shifts = self.neighbor_indexes
+        canonical = [tuple(row) for row in self._canonical(shifts).tolist()]
+        opposite = [tuple(row) for row in self._canonical(-shifts).tolist()]
+        lookup = dict((row, i) for i, row in enumerate(canonical))
+        half = []
+        conjugate = []
+        for i, shift in enumerate(shifts.tolist()):
+            j = lookup.get(opposite[i])
+            if j is None:
+                # the opposite shift is not present
+                half.append(i)
+                conjugate.append(False)
+            elif j == i:
+                if any(shift):
+                    half.append(i)
+                    conjugate.append(True)
+            elif shift > shifts[j].tolist():
+                half.append(i)
+                conjugate.append(False)
+        self.half_neighbor_indexes = shifts[numpy.array(half, int)]
+        self.half_conjugate = numpy.array(conjugate, bool)
 
     def __iter__(self):
         """Iterate over (key,bin) pairs"""
         return self._bins.iteritems()
 
+    def update(self, indexes, new_coordinates):
+        """Move a subset of the coordinates to new positions
+
+           Arguments:
+            | ``indexes``  --  An array with the (unique) indexes of the moved
+                               coordinates.
+            | ``new_coordinates``  --  An array with the new positions of the
+                                       moved coordinates.
+
+           Only the moved coordinates are transferred between bins. The first
+           time this method is called, the original coordinates array is
+           copied, such that it is never modified.
+        """
+        indexes = numpy.asarray(indexes, int)
+        if not self._owns_coordinates:
+            self.coordinates = numpy.array(self.coordinates, float)
+            self._owns_coordinates = True
+        self.coordinates[indexes] = new_coordinates
+        new_keys = self._get_keys(self.coordinates[indexes])
+        changed = (new_keys != self._keys[indexes]).any(axis=1)
+        for index, old_key, new_key in zip(indexes[changed].tolist(), self._keys[indexes[changed]].tolist(), new_keys[changed].tolist()):
+            # remove from the old bin
+            old_key = tuple(old_key)
+            bin = self._bins[old_key]
+            bin = bin[bin != index]
+            if len(bin) == 0:
+                del self._bins[old_key]
+            else:
+                self._bins[old_key] = bin
+            # add to the new bin, the indexes in a bin remain sorted
+            new_key = tuple(new_key)
+            bin = self._bins.get(new_key)
+            if bin is None:
+                self._bins[new_key] = numpy.array([index])
+            else:
+                self._bins[new_key] = numpy.insert(bin, bin.searchsorted(index), index)
+        self._keys[indexes] = new_keys
+
     def iter_surrounding(self, center_key):
         """Iterate over all bins surrounding the given bin"""
         for shift in self.neighbor_indexes:
@@ -97,6 +213,23 @@ class Binning(object):
             if bin is not None:
                 yield key, bin
 
+    def iter_half_surrounding(self, center_key):
+        """Iterate over half of the bins surrounding the given bin
+
+           Each pair of neighboring bins is visited exactly once when this
+           method is called for all bins. The central bin itself is not
+           included. See :meth:`_setup_half_shell`.
+        """
+        for shift, conjugate in zip(self.half_neighbor_indexes, self.half_conjugate):
+            key = tuple(numpy.add(center_key, shift).astype(int))
+            if self.integer_cell is not None:
+                key = self.wrap_key(key)
+                if conjugate and key <= center_key:
+                    continue
+            bin = self._bins.get(key)
+            if bin is not None:
+                yield key, bin
+
     def wrap_key(self, key):
         """Translate the key into the central cell
 
@@ -106,46 +239,216 @@ class Binning(object):
             self.integer_cell.shortest_vector(key)
         ).astype(int))
 
+    def wrap_keys(self, keys):
+        """Translate an array of keys into the central cell
+
+           This is the vectorized counterpart of :meth:`wrap_key`.
+        """
+        return numpy.round(self.integer_cell.shortest_vector(keys)).astype(int)
+
+
+class CellList(object):
+    """Array-backed division of coordinates in regular bins
+
+       This is an alternative for :class:`Binning` that avoids Python objects
+       for the individual atoms. Each bin has a linear integer id. The atoms are
+       sorted by bin id and the atoms in one bin are found with the arrays
+       ``starts`` and ``counts``, which are indexed by the bin id. The bins of a
+       CellList can be used in the same way as those of a :class:`Binning`
+       object, except that the keys are linear bin ids instead of tuples.
+
+       In case of a non-periodic system, the grid of bins is padded such that
+       the linear ids of the surrounding bins are obtained by adding a fixed
+       array of offsets to the id of the central bin.
+    """
+    def __init__(self, coordinates, cutoff, grid_cell, integer_cell=None):
+        """Initialize a CellList object
+
+           Arguments:
+            | ``coordinates``  --  a Nx3 numpy array with coordinates to be
+                                   triaged into bins
+            | ``cutoff``  --  The maximum distance between coordinates pairs.
+            | ``grid_cell``  --  A unit cell  object specifying the size and
+                                 shape of the bins
+
+           Optional argument:
+            | ``integer_cell``  --  the periodicity of the system in terms if
+                                    integer grid cells. The active cell vectors
+                                    must be parallel to the grid cell vectors.
+        """
+        self.coordinates = coordinates
+        self.grid_cell = grid_cell
+        self.integer_cell = integer_cell
+
+        # the relative keys of the neighboring bins
+        if integer_cell is None:
+            self.periodic = numpy.zeros(3, bool)
+            self.neighbor_indexes = grid_cell.get_radius_indexes(cutoff)
+        else:
+            integer_matrix = integer_cell.matrix.astype(int)
+            active = integer_cell.active
+            if _has_skew(integer_matrix, active):
+                raise ValueError("The active cell vectors of the integer cell must be parallel to the grid cell vectors.")
+            self.periodic = active.copy()
+            max_ranges = numpy.diag(integer_matrix).copy()
+            max_ranges[True^active] = -1
+            self.neighbor_indexes = grid_cell.get_radius_indexes(cutoff, max_ranges)
+
+        # the integer keys of all coordinates
+        keys = numpy.floor(grid_cell.to_fractional(coordinates)).astype(int)
+
+        # the layout of the grid of bins
+        pad = abs(self.neighbor_indexes).max(axis=0)
+        if len(keys) > 0:
+            lower = keys.min(axis=0) - pad
+            shape = keys.max(axis=0) - lower + pad + 1
+        else:
+            lower = -pad
+            shape = 2*pad + 1
+        if integer_cell is not None:
+            sizes = abs(numpy.diag(integer_matrix))
+            lower[self.periodic] = 0
+            shape[self.periodic] = sizes[self.periodic]
+            keys[:,self.periodic] %= sizes[self.periodic]
+        self.lower = lower
+        self.shape = shape
+        self.strides = numpy.array([shape[1]*shape[2], shape[2], 1])
+        self.neighbor_offsets = numpy.dot(self.neighbor_indexes, self.strides)
+
+        # sort the coordinates by bin id
+        self.bin_ids = numpy.dot(keys - lower, self.strides)
+        self.counts = numpy.bincount(self.bin_ids, minlength=shape.prod())
+        self.starts = numpy.zeros(len(self.counts), int)
+        self.starts[1:] = self.counts.cumsum()[:-1]
+        self.order = self.bin_ids.argsort(kind="mergesort")
+        self.occupied = self.counts.nonzero()[0]
+
+    def get_bin(self, bin_id):
+        """Return the indexes of the coordinates in the given bin"""
+        start = self.starts[bin_id]
+        return self.order[start:start+self.counts[bin_id]]
+
+    def get_key(self, bin_id):
+        """Return the integer bin coordinates (in the grid) of a bin id"""
+        return numpy.array(numpy.unravel_index(bin_id, self.shape)) + self.lower
+
+    def get_surrounding(self, bin_id):
+        """Return the ids of all non-empty bins surrounding the given bin"""
+        if self.periodic.any():
+            keys = self.get_key(bin_id) + self.neighbor_indexes - self.lower
+            keys[:,self.periodic] %= self.shape[self.periodic]
+            bin_ids = numpy.dot(keys, self.strides)
+        else:
+            bin_ids = bin_id + self.neighbor_offsets
+        return bin_ids[self.counts[bin_ids] > 0]
+
+    def __iter__(self):
+        """Iterate over (bin_id,bin) pairs of all non-empty bins"""
+        for bin_id in self.occupied:
+            yield bin_id, self.get_bin(bin_id)
+
+    def iter_surrounding(self, center_id):
+        """Iterate over all non-empty bins surrounding the given bin"""
+        for bin_id in self.get_surrounding(center_id):
+            yield bin_id, self.get_bin(bin_id)
+
+
+def _has_skew(integer_matrix, active):
+    """Test if active integer cell vectors are not parallel to the grid cell vectors"""
+    off_diagonal = integer_matrix - numpy.diag(numpy.diag(integer_matrix))
+    return (off_diagonal[:,active] != 0).any()
+
+
+def _setup_grid(cutoff, unit_cell, grid):
+    """Choose a proper grid for the binning process"""
+    if grid is None:
+        # automatically choose a decent grid
+        if unit_cell is None:
+            grid = cutoff/2.9
+        else:
+            # nearly cubic bins, also for skewed cells
+            grid = unit_cell.get_optimal_subcell(cutoff)
+
+    if isinstance(grid, float):
+        grid_cell = UnitCell(numpy.array([
+            [grid, 0, 0],
+            [0, grid, 0],
+            [0, 0, grid]
+        ]))
+    elif isinstance(grid, UnitCell):
+        grid_cell = grid
+    else:
+        raise TypeError("Grid must be None, a float or a UnitCell instance.")
+
+    if unit_cell is not None:
+        # The columns of integer_matrix are the unit cell vectors in
+        # fractional coordinates of the grid cell.
+        integer_matrix = grid_cell.to_fractional(unit_cell.matrix.transpose()).transpose()
+        if abs((integer_matrix - numpy.round(integer_matrix))*unit_cell.active).max() > 1e-6:
+            raise ValueError("The unit cell vectors are not an integer linear combination of grid cell vectors.")
+        integer_matrix = integer_matrix.round()
+        if _has_skew(integer_matrix, unit_cell.active):
+            # The reduced cell describes the same lattice. Its cell vectors
+            # may be parallel to those of the grid cell, e.g. when the grid
+            # cell is obtained with UnitCell.get_optimal_subcell.
+            reduced_matrix = grid_cell.to_fractional(unit_cell.reduced.matrix.transpose()).transpose().round()
+            if not _has_skew(reduced_matrix, unit_cell.active):
+                integer_matrix = reduced_matrix
+        integer_cell = UnitCell(integer_matrix, unit_cell.active)
+    else:
+        integer_cell = None
+
+    return grid_cell, integer_cell
+
 
 class PairSearchBase(object):
     """Base class for :class:`PairSearchIntra` and :class:`PairSearchInter`"""
     def _setup_grid(self, cutoff, unit_cell, grid):
         """Choose a proper grid for the binning process"""
-        if grid is None:
-            # automatically choose a decent grid
-            if unit_cell is None:
-                grid = cutoff/2.9
-            else:
-                # The following would be faster, but it is not reliable
-                # enough yet.
-                #grid = unit_cell.get_optimal_subcell(cutoff/2.0)
-                divisions = numpy.ceil(unit_cell.spacings/cutoff)
-                divisions[divisions<1] = 1
-                grid = unit_cell/divisions
-
-        if isinstance(grid, float):
-            grid_cell = UnitCell(numpy.array([
-                [grid, 0, 0],
-                [0, grid, 0],
-                [0, 0, grid]
-            ]))
-        elif isinstance(grid, UnitCell):
-            grid_cell = grid
-        else:
-            raise TypeError("Grid must be None, a float or a UnitCell instance.")
-
-        if unit_cell is not None:
-            # The columns of integer_matrix are the unit cell vectors in
-            # fractional coordinates of the grid cell.
-            integer_matrix = grid_cell.to_fractional(unit_cell.matrix.transpose()).transpose()
-            if abs((integer_matrix - numpy.round(integer_matrix))*self.unit_cell.active).max() > 1e-6:
-                raise ValueError("The unit cell vectors are not an integer linear combination of grid cell vectors.")
-            integer_matrix = integer_matrix.round()
-            integer_cell = UnitCell(integer_matrix, unit_cell.active)
-        else:
-            integer_cell = None
+        return _setup_grid(cutoff, unit_cell, grid)
+
+    def _compute_block(self, coordinates0, bin0, coordinates1, bin1, lower):
+        """Compute all pairs between two bins with a distance below the cutoff
+
+           Arguments:
+            | ``coordinates0``  --  the coordinates associated with bin0
+            | ``bin0``  --  an array with indexes of the first bin
+            | ``coordinates1``  --  the coordinates associated with bin1
+            | ``bin1``  --  an array with indexes of the second bin
+            | ``lower``  --  when True, only pairs with i1 < i0 are retained
 
-        return grid_cell, integer_cell
+           Returns: arrays i0, i1, delta, distance as in :meth:`as_arrays`.
+        """
+        delta = coordinates1[bin1] - coordinates0[bin0].reshape((-1, 1, 3))
+        if self.unit_cell is not None:
+            delta = self.unit_cell.minimum_image(delta)
+        distance = numpy.sqrt((delta**2).sum(axis=2))
+        mask = distance <= self.cutoff
+        if lower:
+            mask &= bin1 < bin0.reshape((-1, 1))
+        r0, r1 = mask.nonzero()
+        return bin0[r0], bin1[r1], delta[r0, r1], distance[r0, r1]
+
+    def _order_pairs(self, i0, i1, delta, distance):
+        """Swap the pairs with i1 > i0, such that i1 < i0 for all pairs"""
+        swap = i1 > i0
+        i0, i1 = numpy.where(swap, i1, i0), numpy.where(swap, i0, i1)
+        delta[swap] *= -1
+        return i0, i1, delta, distance
+
+    def _concatenate(self, blocks):
+        """Concatenate the results of several calls to _compute_block"""
+        if len(blocks) == 0:
+            return (
+                numpy.zeros(0, int), numpy.zeros(0, int),
+                numpy.zeros((0, 3), float), numpy.zeros(0, float),
+            )
+        return tuple(numpy.concatenate(parts) for parts in zip(*blocks))
+
+    def __iter__(self):
+        """Iterate over all pairs with a distance below the cutoff"""
+        i0s, i1s, deltas, distances = self.as_arrays()
+        return itertools.izip(i0s.tolist(), i1s.tolist(), deltas, distances.tolist())
 
 
 class PairSearchIntra(PairSearchBase):
@@ -154,9 +457,14 @@ class PairSearchIntra(PairSearchBase):
        Example usage::
 
            coordinates = numpy.random.uniform(0,10,(10,3))
-           for i, j, distance, delta in PairSearchIntra(coordinates, 2.5):
+           for i, j, delta, distance in PairSearchIntra(coordinates, 2.5):
                print i, j, distance
 
+       All pairs can also be computed at once, which is much faster for large
+       systems::
+
+           i, j, delta, distance = PairSearchIntra(coordinates, 2.5).as_arrays()
+
        Note that for periodic systems the minimum image convention is applied.
     """
 
@@ -184,28 +492,164 @@ class PairSearchIntra(PairSearchBase):
 
              1) When no unit cell is given, it is equal to cutoff/2.9.
              2) When a unit cell is given, the grid cell is as close to cubic
-                as possible, with spacings below cutoff/2 that are integer
-                divisions of the unit cell spacings
+                as possible, with spacings below the cutoff that are integer
+                divisions of the spacings of the reduced unit cell. (See
+                :meth:`molmod.unit_cells.UnitCell.get_optimal_subcell`.)
         """
         self.cutoff = cutoff
         self.unit_cell = unit_cell
         grid_cell, integer_cell = self._setup_grid(cutoff, unit_cell, grid)
         self.bins = Binning(coordinates, cutoff, grid_cell, integer_cell)
 
-    def __iter__(self):
-        """Iterate over all pairs with a distance below the cutoff"""
-        for key0, bin0 in self.bins:
-            for key1, bin1 in self.bins.iter_surrounding(key0):
-                for i0, c0 in bin0:
-                    for i1, c1 in bin1:
-                        if i1 >= i0:
-                            continue
-                        delta = c1 - c0
-                        if self.unit_cell is not None:
-                            delta = self.unit_cell.shortest_vector(delta)
-                        distance = numpy.linalg.norm(delta)
-                        if distance <= self.cutoff:
-                            yield i0, i1, delta, distance
+    def as_arrays(self, workers=1):
+        """Compute all pairs with a distance below the cutoff at once
+
+           Optional argument:
+            | ``workers``  --  The number of worker processes. When larger than
+                               one, the bins are divided into slabs along the
+                               first grid direction and each slab is processed
+                               by a worker in a multiprocessing pool. The
+                               coordinates are shared with the workers through
+                               a shared memory buffer.
+
+           Returns: four arrays ``i0``, ``i1``, ``delta`` and ``distance`` with
+           the same contents as the tuples generated by the iterator, i.e. for
+           each pair ``i1 < i0``, ``delta`` is the relative vector from
+           ``i0`` to ``i1`` (shape Mx3) and ``distance`` is its norm. The
+           bins are always processed in sorted order, such that the result
+           does not depend on the number of workers.
+        """
+        keys = sorted(key for key, bin in self.bins)
+        if workers > 1 and len(keys) > 1:
+            return self._as_arrays_parallel(keys, workers)
+        return self._compute_keys(self.bins.coordinates, keys)
+
+    def _compute_keys(self, coordinates, keys):
+        """Compute the pairs found from the given bins with the half shell
+
+           Each pair of bins is visited only once, see
+           :meth:`Binning.iter_half_surrounding`.
+        """
+        blocks = []
+        for key0 in keys:
+            bin0 = self.bins._bins[key0]
+            # only the lower triangle of the central bin
+            blocks.append(self._compute_block(coordinates, bin0, coordinates, bin0, True))
+            # the neighboring bins in the half shell are treated in one block
+            others = [bin1 for key1, bin1 in self.bins.iter_half_surrounding(key0)]
+            if len(others) > 0:
+                bin1 = numpy.concatenate(others)
+                block = self._compute_block(coordinates, bin0, coordinates, bin1, False)
+                blocks.append(self._order_pairs(*block))
+        return self._concatenate(blocks)
+
+    def update(self, indexes, new_coordinates):
+        """Move a subset of the coordinates and find the pairs involving them
+
+           Arguments:
+            | ``indexes``  --  An array with the (unique) indexes of the moved
+                               coordinates.
+            | ``new_coordinates``  --  An array with the new positions of the
+                                       moved coordinates.
+
+           Returns: four arrays ``i0``, ``i1``, ``delta`` and ``distance`` as in
+           :meth:`as_arrays`, with all pairs in which at least one of the
+           moved coordinates takes part. The pairs between coordinates that
+           did not move are not changed and are not returned. The amount of
+           work is proportional to the number of moved coordinates.
+        """
+        indexes = numpy.asarray(indexes, int)
+        self.bins.update(indexes, new_coordinates)
+        coordinates = self.bins.coordinates
+        blocks = []
+        for key0, bin0 in self.bins._group(numpy.sort(indexes)):
+            others = [bin1 for key1, bin1 in self.bins.iter_surrounding(key0)]
+            bin1 = numpy.concatenate(others)
+            i0, i1, delta, distance = self._compute_block(coordinates, bin0, coordinates, bin1, False)
+            # a pair of two moved coordinates is only retained once
+            mask = (i1 < i0) | ~numpy.in1d(i1, indexes)
+            blocks.append(self._order_pairs(i0[mask], i1[mask], delta[mask], distance[mask]))
+        return self._concatenate(blocks)
+
+    def _iter_slabs(self, keys, num_slabs):
+        """Divide the (sorted) keys in slabs with a similar number of atoms
+
+           Each slab consists of all bins with a first key component in a
+           certain range. Yields a copy of this object for each slab, whose
+           bins are restricted to the slab and its halo, together with the
+           keys of the bins in the slab.
+        """
+        bins = self.bins
+        first = numpy.array([key[0] for key in keys])
+        sizes = numpy.array([len(bins._bins[key]) for key in keys])
+        # the boundaries between slabs only fall between different values of
+        # the first key component
+        boundaries = (first[1:] != first[:-1]).nonzero()[0] + 1
+        if len(boundaries) > 0:
+            targets = sizes.sum()*numpy.arange(1, num_slabs)/float(num_slabs)
+            cumulative = sizes.cumsum()[boundaries-1]
+            selected = cumulative.searchsorted(targets).clip(0, len(boundaries)-1)
+            splits = boundaries[numpy.unique(selected)]
+        else:
+            splits = []
+        all_keys = numpy.array(keys)
+        for slab_keys in numpy.split(all_keys, splits):
+            # find the bins in the halo of the slab
+            shifts = numpy.concatenate([numpy.zeros((1, 3), int), bins.half_neighbor_indexes])
+            halo = (slab_keys.reshape((-1, 1, 3)) + shifts).reshape((-1, 3))
+            if bins.integer_cell is not None:
+                halo = bins.wrap_keys(halo)
+            # Only the bins of the slab and its halo and the stencils are
+            # sent to the worker. The arrays with one row per atom are left
+            # out, the coordinates are shared through a buffer.
+            part = copy.copy(self)
+            part.bins = copy.copy(bins)
+            part.bins.coordinates = None
+            part.bins._keys = None
+            part.bins._bins = {}
+            for key in set(tuple(key) for key in halo.tolist()):
+                bin = bins._bins.get(key)
+                if bin is not None:
+                    part.bins._bins[key] = bin
+            yield part, [tuple(key) for key in slab_keys.tolist()]
+
+    def _as_arrays_parallel(self, keys, workers):
+        """Distribute the work of as_arrays over a pool of worker processes"""
+        import multiprocessing
+        from multiprocessing.sharedctypes import RawArray
+        coordinates = numpy.asarray(self.bins.coordinates, float)
+        buffer = RawArray("d", coordinates.size)
+        numpy.frombuffer(buffer, float)[:] = coordinates.ravel()
+        pool = multiprocessing.Pool(
+            workers, _init_worker, (buffer, coordinates.shape)
+        )
+        try:
+            # a few slabs per worker helps to balance the load
+            tasks = list(self._iter_slabs(keys, 4*workers))
+            blocks = pool.map(_compute_slab, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        return self._concatenate(blocks)
+
+
+# The coordinates shared with the worker processes of
+# PairSearchIntra.as_arrays. Each worker sets this global variable once, when
+# the pool is created.
+_worker_coordinates = None
+
+
+def _init_worker(buffer, shape):
+    """Wrap the shared coordinates buffer in a numpy array"""
+    global _worker_coordinates
+    _worker_coordinates = numpy.frombuffer(buffer, float).reshape(shape)
+
+
+def _compute_slab(task):
+    """Compute all pairs of one slab in a worker process"""
+    part, keys = task
+    return part._compute_keys(_worker_coordinates, keys)
+
 
 class PairSearchInter(PairSearchBase):
     """Iterator over all pairs of coordinates with a distance below a cutoff.
@@ -214,9 +658,11 @@ class PairSearchInter(PairSearchBase):
 
            coordinates0 = numpy.random.uniform(0,10,(10,3))
            coordinates1 = numpy.random.uniform(0,10,(10,3))
-           for i, j, distance, delta in PairSearchInter(coordinates0, coordinates1, 2.5):
+           for i, j, delta, distance in PairSearchInter(coordinates0, coordinates1, 2.5):
                print i, j, distance
 
+       All pairs can also be computed at once with the method ``as_arrays``.
+
        Note that for periodic systems the minimum image convention is applied.
     """
 
@@ -244,8 +690,9 @@ class PairSearchInter(PairSearchBase):
            The default value of grid depends on other parameters:
              1) When no unit cell is given, it is equal to cutoff/2.9.
              2) When a unit cell is given, the grid cell is as close to cubic
-                as possible, with spacings below cutoff/2 that are integer
-                divisions of the unit cell spacings
+                as possible, with spacings below the cutoff that are integer
+                divisions of the spacings of the reduced unit cell. (See
+                :meth:`molmod.unit_cells.UnitCell.get_optimal_subcell`.)
         """
         self.cutoff = cutoff
         self.unit_cell = unit_cell
@@ -253,15 +700,434 @@ class PairSearchInter(PairSearchBase):
         self.bins0 = Binning(coordinates0, cutoff, grid_cell, integer_cell)
         self.bins1 = Binning(coordinates1, cutoff, grid_cell, integer_cell)
 
-    def __iter__(self):
-        """Iterate over all pairs with a distance below the cutoff"""
+    def as_arrays(self):
+        """Compute all pairs with a distance below the cutoff at once
+
+           Returns: four arrays ``i0``, ``i1``, ``delta`` and ``distance`` with
+           the same contents as the tuples generated by the iterator. ``i0``
+           refers to coordinates0 and ``i1`` to coordinates1. ``delta`` is the
+           relative vector from ``i0`` to ``i1`` (shape Mx3) and ``distance``
+           is its norm.
+        """
+        coordinates0 = self.bins0.coordinates
+        coordinates1 = self.bins1.coordinates
+        blocks = []
         for key0, bin0 in self.bins0:
             for key1, bin1 in self.bins1.iter_surrounding(key0):
-                for i0, c0 in bin0:
-                    for i1, c1 in bin1:
-                        delta = c1 - c0
-                        if self.unit_cell is not None:
-                            delta = self.unit_cell.shortest_vector(delta)
-                        distance = numpy.linalg.norm(delta)
-                        if distance <= self.cutoff:
-                            yield i0, i1, delta, distance
+                blocks.append(self._compute_block(coordinates0, bin0, coordinates1, bin1, False))
+        return self._concatenate(blocks)
+
+    def update(self, indexes0=None, new_coordinates0=None, indexes1=None, new_coordinates1=None):
+        """Move a subset of the coordinates and find the pairs involving them
+
+           Optional arguments:
+            | ``indexes0``  --  An array with the (unique) indexes of the moved
+                                coordinates in coordinates0.
+            | ``new_coordinates0``  --  The new positions of these coordinates.
+            | ``indexes1``  --  An array with the (unique) indexes of the moved
+                                coordinates in coordinates1.
+            | ``new_coordinates1``  --  The new positions of these coordinates.
+
+           Returns: four arrays ``i0``, ``i1``, ``delta`` and ``distance`` as in
+           :meth:`as_arrays`, with all pairs in which at least one of the
+           moved coordinates takes part.
+        """
+        blocks = []
+        if indexes0 is not None:
+            indexes0 = numpy.asarray(indexes0, int)
+            self.bins0.update(indexes0, new_coordinates0)
+        if indexes1 is not None:
+            indexes1 = numpy.asarray(indexes1, int)
+            self.bins1.update(indexes1, new_coordinates1)
+        coordinates0 = self.bins0.coordinates
+        coordinates1 = self.bins1.coordinates
+        if indexes0 is not None:
+            for key0, bin0 in self.bins0._group(numpy.sort(indexes0)):
+                others = [bin1 for key1, bin1 in self.bins1.iter_surrounding(key0)]
+                if len(others) > 0:
+                    bin1 = numpy.concatenate(others)
+                    blocks.append(self._compute_block(coordinates0, bin0, coordinates1, bin1, False))
+        if indexes1 is not None:
+            for key1, bin1 in self.bins1._group(numpy.sort(indexes1)):
+                others = [bin0 for key0, bin0 in self.bins0.iter_surrounding(key1)]
+                if len(others) > 0:
+                    bin0 = numpy.concatenate(others)
+                    if indexes0 is not None:
+                        # these pairs are already found above
+                        bin0 = bin0[~numpy.in1d(bin0, indexes0)]
+                    blocks.append(self._compute_block(coordinates0, bin0, coordinates1, bin1, False))
+        return self._concatenate(blocks)
+
+
+class NeighborList(object):
+    """Verlet neighbor list for coordinates that change gradually.
+
+       The pairs are searched with a cutoff that is enlarged with a skin. As
+       long as no atom moves more than half the skin since the last search,
+       all pairs within the cutoff are part of the cached list of candidate
+       pairs. Only those candidates must be tested again when the coordinates
+       are updated.
+
+       Example usage::
+
+           neighbor_list = NeighborList(cutoff, skin)
+           for coordinates in trajectory:
+               neighbor_list.update(coordinates)
+               i0, i1, delta, distance = neighbor_list.as_arrays()
+
+       Note that for periodic systems the minimum image convention is applied.
+    """
+
+    def __init__(self, cutoff, skin, unit_cell=None, grid=None, coordinates=None):
+        """
+           Arguments:
+            | ``cutoff``  --  The cutoff radius for the pair distances.
+            | ``skin``  --  The extra margin added to the cutoff when the
+                            candidate pairs are searched.
+
+           Optional arguments:
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+            | ``grid``  --  Specification of the grid, see
+                            :class:`PairSearchIntra`. When not given, the
+                            default grid for the enlarged cutoff is used.
+            | ``coordinates``  --  The initial coordinates. When not given,
+                                   the method update must be called before the
+                                   pairs can be computed.
+        """
+        if skin < 0:
+            raise ValueError("The skin must be non-negative.")
+        self.cutoff = cutoff
+        self.skin = skin
+        self.unit_cell = unit_cell
+        self.grid = grid
+        self.num_builds = 0
+        self._reference = None
+        if coordinates is not None:
+            self.update(coordinates)
+
+    def _build(self, coordinates):
+        """Search the candidate pairs within the cutoff plus the skin"""
+        pair_search = PairSearchIntra(coordinates, self.cutoff + self.skin, self.unit_cell, self.grid)
+        self._candidates0, self._candidates1 = pair_search.as_arrays()[:2]
+        self._reference = coordinates.copy()
+        self.num_builds += 1
+
+    def get_max_displacement(self, coordinates):
+        """The largest displacement of an atom since the last search"""
+        delta = coordinates - self._reference
+        if self.unit_cell is not None:
+            delta = self.unit_cell.minimum_image(delta)
+        return numpy.sqrt((delta**2).sum(axis=1)).max()
+
+    def update(self, coordinates):
+        """Process a new set of coordinates
+
+           Argument:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+
+           The candidate pairs are only searched again when an atom moved
+           more than half the skin since the last search. Returns True when
+           the candidate pairs were searched again.
+        """
+        coordinates = numpy.asarray(coordinates, float)
+        rebuild = (
+            self._reference is None or
+            len(coordinates) != len(self._reference) or
+            (len(coordinates) > 0 and self.get_max_displacement(coordinates) > 0.5*self.skin)
+        )
+        if rebuild:
+            self._build(coordinates)
+        # refilter the candidate pairs
+        delta = coordinates[self._candidates1] - coordinates[self._candidates0]
+        if self.unit_cell is not None:
+            delta = self.unit_cell.minimum_image(delta)
+        distance = numpy.sqrt((delta**2).sum(axis=1))
+        mask = distance <= self.cutoff
+        self._pairs = (
+            self._candidates0[mask], self._candidates1[mask], delta[mask],
+            distance[mask],
+        )
+        return rebuild
+
+    def as_arrays(self):
+        """Return all pairs with a distance below the cutoff
+
+           Returns: four arrays ``i0``, ``i1``, ``delta`` and ``distance`` for
+           the coordinates of the last update, with the same conventions as
+           :meth:`PairSearchIntra.as_arrays`.
+        """
+        if self._reference is None:
+            raise RuntimeError("The neighbor list has no coordinates yet.")
+        return self._pairs
+
+    def __iter__(self):
+        """Iterate over all pairs with a distance below the cutoff"""
+        i0s, i1s, deltas, distances = self.as_arrays()
+        return itertools.izip(i0s.tolist(), i1s.tolist(), deltas, distances.tolist())
+
+
+class SpatialIndex(object):
+    """Reusable index for repeated queries against a fixed set of coordinates.
+
+       The coordinates are divided into bins only once. Each query processes a
+       batch of points at once, without a Python loop over the points or the
+       bins.
+
+       Example usage::
+
+           index = SpatialIndex(coordinates)
+           indptr, indexes, distances = index.query_radius(points, 5.0)
+           # the coordinates within 5.0 of points[3]:
+           print indexes[indptr[3]:indptr[4]]
+
+       Note that for periodic systems the minimum image convention is applied.
+    """
+
+    def __init__(self, coordinates, unit_cell=None, grid=None, chunk_size=1000):
+        """
+           Arguments:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+
+           Optional arguments:
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+            | ``grid``  --  Specification of the grid, see
+                            :class:`PairSearchIntra`. The default grid has
+                            bins that contain a few coordinates on average.
+                            In a periodic system, the active unit cell
+                            vectors must be parallel to the grid cell
+                            vectors. Otherwise a ValueError is raised.
+            | ``chunk_size``  --  The number of points that is processed at
+                                  once in a query. This limits the memory
+                                  usage.
+        """
+        self.coordinates = coordinates
+        self.unit_cell = unit_cell
+        self.chunk_size = chunk_size
+        size = self._get_default_size()
+        if grid is None and unit_cell is None:
+            grid = size
+        grid_cell, integer_cell = _setup_grid(size, unit_cell, grid)
+        if integer_cell is not None and _has_skew(integer_cell.matrix.astype(int), integer_cell.active):
+            raise ValueError("The active unit cell vectors must be parallel to the grid cell vectors of a SpatialIndex. Use PairSearchIntra for skewed grids.")
+        self.cell_list = CellList(coordinates, max(grid_cell.spacings), grid_cell, integer_cell)
+        self._stencils = {}
+
+    def _get_volume(self):
+        """The volume occupied by the coordinates"""
+        if self.unit_cell is not None and self.unit_cell.active.all():
+            return self.unit_cell.volume
+        if len(self.coordinates) == 0:
+            return 1.0
+        extents = self.coordinates.max(axis=0) - self.coordinates.min(axis=0)
+        if self.unit_cell is not None:
+            spacings = self.unit_cell.spacings
+            extents[self.unit_cell.active] = spacings[self.unit_cell.active]
+        extents[extents < 1.0] = 1.0
+        return extents.prod()
+
+    def _get_default_size(self):
+        """The edge of a bin that holds about four coordinates on average"""
+        return (4.0*self._get_volume()/max(1, len(self.coordinates)))**(1.0/3.0)
+
+    def _get_stencil(self, radius):
+        """The relative keys of all bins that may contain points within radius"""
+        stencil = self._stencils.get(radius)
+        if stencil is None:
+            cell_list = self.cell_list
+            if cell_list.integer_cell is None:
+                stencil = cell_list.grid_cell.get_radius_indexes(radius)
+            else:
+                max_ranges = cell_list.shape.copy()
+                max_ranges[True^cell_list.periodic] = -1
+                stencil = cell_list.grid_cell.get_radius_indexes(radius, max_ranges)
+            self._stencils[radius] = stencil
+        return stencil
+
+    def _query_chunk(self, points, radius):
+        """Find the coordinates within the radius of a few points
+
+           Returns: arrays with point indexes, coordinate indexes and
+           distances, sorted by point and coordinate index.
+        """
+        cell_list = self.cell_list
+        stencil = self._get_stencil(radius)
+        # the keys of the bins surrounding each point
+        keys = numpy.floor(cell_list.grid_cell.to_fractional(points)).astype(int)
+        keys = keys.reshape((-1, 1, 3)) + stencil - cell_list.lower
+        keys[:,:,cell_list.periodic] %= cell_list.shape[cell_list.periodic]
+        valid = ((keys >= 0) & (keys < cell_list.shape)).all(axis=2)
+        point_indexes, stencil_indexes = valid.nonzero()
+        bin_ids = numpy.dot(keys[point_indexes, stencil_indexes], cell_list.strides)
+        # expand the bins into the coordinates they contain
+        counts = cell_list.counts[bin_ids]
+        point_indexes = point_indexes.repeat(counts)
+        ends = counts.cumsum()
+        offsets = numpy.arange(len(point_indexes)) - (ends - counts).repeat(counts)
+        indexes = cell_list.order[cell_list.starts[bin_ids].repeat(counts) + offsets]
+        # compute the distances
+        delta = self.coordinates[indexes] - points[point_indexes]
+        if self.unit_cell is not None:
+            delta = self.unit_cell.minimum_image(delta)
+        distances = numpy.sqrt((delta**2).sum(axis=1))
+        mask = distances <= radius
+        point_indexes = point_indexes[mask]
+        indexes = indexes[mask]
+        distances = distances[mask]
+        order = numpy.lexsort([indexes, point_indexes])
+        return point_indexes[order], indexes[order], distances[order]
+
+    def query_radius(self, points, radius):
+        """Find all coordinates within a given radius of a set of points
+
+           Arguments:
+            | ``points``  --  A Mx3 numpy array with Cartesian coordinates
+            | ``radius``  --  The maximum distance from a point
+
+           Returns: three arrays ``indptr``, ``indexes`` and ``distances`` in a
+           compressed sparse row layout. The indexes of the coordinates within
+           the radius of point i are ``indexes[indptr[i]:indptr[i+1]]``, in
+           increasing order. The corresponding distances are found in the same
+           slice of the array ``distances``.
+        """
+        points = numpy.asarray(points, float).reshape((-1, 3))
+        all_point_indexes = []
+        all_indexes = []
+        all_distances = []
+        for begin in xrange(0, len(points), self.chunk_size):
+            point_indexes, indexes, distances = self._query_chunk(
+                points[begin:begin+self.chunk_size], radius
+            )
+            all_point_indexes.append(point_indexes + begin)
+            all_indexes.append(indexes)
+            all_distances.append(distances)
+        if len(all_indexes) == 0:
+            return numpy.zeros(1, int), numpy.zeros(0, int), numpy.zeros(0, float)
+        point_indexes = numpy.concatenate(all_point_indexes)
+        indptr = numpy.zeros(len(points)+1, int)
+        indptr[1:] = numpy.bincount(point_indexes, minlength=len(points)).cumsum()
+        return indptr, numpy.concatenate(all_indexes), numpy.concatenate(all_distances)
+
+    def query_knn(self, points, k):
+        """Find the k nearest coordinates of a set of points
+
+           Arguments:
+            | ``points``  --  A Mx3 numpy array with Cartesian coordinates
+            | ``k``  --  The number of neighbors
+
+           Returns: two Mxk arrays, ``indexes`` and ``distances``, sorted by
+           increasing distance. The nearest coordinates are searched with
+           radius queries. The radius is doubled for those points that have
+           less than k coordinates within the current radius.
+        """
+        if k > len(self.coordinates):
+            raise ValueError("There are less than k coordinates in the index.")
+        points = numpy.asarray(points, float).reshape((-1, 3))
+        result_indexes = numpy.zeros((len(points), k), int)
+        result_distances = numpy.zeros((len(points), k), float)
+        if k == 0:
+            return result_indexes, result_distances
+        # a radius that contains about k coordinates on average
+        radius = (3.0*k*self._get_volume()/len(self.coordinates)/(4*numpy.pi))**(1.0/3.0)
+        todo = numpy.arange(len(points))
+        while len(todo) > 0:
+            indptr, indexes, distances = self.query_radius(points[todo], radius)
+            counts = indptr[1:] - indptr[:-1]
+            done = counts >= k
+            # sort the results of each point by distance
+            rows = numpy.arange(len(todo)).repeat(counts)
+            order = numpy.lexsort([indexes, distances, rows])
+            selection = (indptr[:-1][done].reshape((-1, 1)) + numpy.arange(k)).ravel()
+            selection = order[selection]
+            result_indexes[todo[done]] = indexes[selection].reshape((-1, k))
+            result_distances[todo[done]] = distances[selection].reshape((-1, k))
+            todo = todo[~done]
+            radius *= 2
+        return result_indexes, result_distances
+
+
+class SparseDistanceMatrix(object):
+    """All distances below a cutoff in a symmetric compressed sparse row matrix
+
+       Example usage::
+
+           dm = SparseDistanceMatrix(coordinates, 5.0)
+           # the neighbors of atom 3 and their distances
+           print dm.indices[dm.indptr[3]:dm.indptr[4]]
+           print dm.data[dm.indptr[3]:dm.indptr[4]]
+
+       The arrays ``indptr``, ``indices`` and ``data`` follow the same
+       conventions as the CSR format of scipy. The column indexes of each row
+       are sorted. The diagonal (distance zero) is not stored.
+
+       Note that for periodic systems the minimum image convention is applied.
+    """
+
+    def __init__(self, coordinates, cutoff, unit_cell=None, grid=None, deltas=False):
+        """
+           Arguments:
+            | ``coordinates``  --  A Nx3 numpy array with Cartesian coordinates
+            | ``cutoff``  --  The cutoff radius for the pair distances.
+
+           Optional arguments:
+            | ``unit_cell``  --  Specifies the periodic boundary conditions
+            | ``grid``  --  Specification of the grid, see
+                            :class:`PairSearchIntra`
+            | ``deltas``  --  When True, the relative vectors are stored in the
+                              attribute ``deltas``, an Mx3 array that matches
+                              the array ``data``. The relative vector in row
+                              i and column j points from atom i to atom j.
+        """
+        size = len(coordinates)
+        i0, i1, delta, distance = PairSearchIntra(coordinates, cutoff, unit_cell, grid).as_arrays()
+        rows = numpy.concatenate([i0, i1])
+        columns = numpy.concatenate([i1, i0])
+        order = numpy.lexsort([columns, rows])
+        self.shape = (size, size)
+        self.cutoff = cutoff
+        self.indptr = numpy.zeros(size+1, int)
+        self.indptr[1:] = numpy.bincount(rows, minlength=size).cumsum()
+        self.indices = columns[order]
+        self.data = numpy.concatenate([distance, distance])[order]
+        if deltas:
+            self.deltas = numpy.concatenate([delta, -delta])[order]
+        else:
+            self.deltas = None
+
+    def get_neighbor_counts(self):
+        """Return the number of neighbors within the cutoff for each atom"""
+        return self.indptr[1:] - self.indptr[:-1]
+
+    def get_row(self, index):
+        """Return the neighbors of one atom and the corresponding distances"""
+        begin = self.indptr[index]
+        end = self.indptr[index+1]
+        return self.indices[begin:end], self.data[begin:end]
+
+    def iter_pairs(self):
+        """Iterate over all pairs (i,j,distance) with i < j"""
+        rows = numpy.arange(self.shape[0]).repeat(self.get_neighbor_counts())
+        mask = rows < self.indices
+        return itertools.izip(rows[mask].tolist(), self.indices[mask].tolist(), self.data[mask].tolist())
+
+    def to_dense(self, fill=0.0):
+        """Return the distance matrix as a dense array
+
+           Optional argument:
+            | ``fill``  --  The value for the pairs beyond the cutoff. The
+                            diagonal is always zero.
+        """
+        result = numpy.zeros(self.shape, float)
+        result[:] = fill
+        result.ravel()[::self.shape[0]+1] = 0.0
+        rows = numpy.arange(self.shape[0]).repeat(self.get_neighbor_counts())
+        result[rows, self.indices] = self.data
+        return result
+
+    def to_scipy(self):
+        """Return the distance matrix as a scipy.sparse.csr_matrix object
+
+           This method requires scipy, which is not needed for the rest of
+           MolMod.
+        """
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
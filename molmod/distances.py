@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Dense matrices with all interatomic distances
+
+   The distances are computed block by block, such that the temporary arrays
+   never exceed a given number of elements. The result is either a full NxN
+   matrix or a condensed array with the N(N-1)/2 distances between distinct
+   atoms. Example::
+
+       dm = compute_distance_matrix(coordinates, unit_cell)
+       condensed = compute_distance_matrix(coordinates, condensed=True)
+
+   The condensed array contains the distances of the pairs (i, j) with j < i,
+   sorted by i and then by j. This is the order of the distances in the tables
+   of :class:`molmod.similarity.SimilarityDescriptor`. The index of a pair in
+   the condensed array is i*(i-1)/2 + j.
+"""
+
+
+import numpy
+
+
+__all__ = ["compute_distance_matrix"]
+
+
+# non-periodic systems with at least this number of atoms use the Gram matrix
+GRAM_THRESHOLD = 500
+
+
+def _compute_block_direct(coordinates, begin, end, unit_cell):
+    """Distances between the atoms begin:end and the atoms 0:end"""
+    deltas = coordinates[begin:end].reshape((-1, 1, 3)) - coordinates[:end]
+    if unit_cell is not None:
+        deltas = unit_cell.minimum_image(deltas)
+    return numpy.sqrt((deltas**2).sum(axis=2))
+
+
+def _compute_block_gram(coordinates, norms_sq, begin, end):
+    """Distances between the atoms begin:end and the atoms 0:end
+
+       The squared distances are computed as |a|^2 + |b|^2 - 2 a.b, where the
+       dot products form a block of the Gram matrix.
+    """
+    result = numpy.dot(coordinates[begin:end], coordinates[:end].transpose())
+    result *= -2
+    result += norms_sq[begin:end].reshape((-1, 1))
+    result += norms_sq[:end]
+    # rounding errors may give small negative values
+    numpy.maximum(result, 0, result)
+    numpy.sqrt(result, result)
+    # the diagonal must be exactly zero
+    indexes = numpy.arange(begin, end)
+    result[indexes - begin, indexes] = 0
+    return result
+
+
+def compute_distance_matrix(coordinates, unit_cell=None, condensed=False, block_size=2**20, method="auto", workers=1):
+    """Compute all distances between a set of atoms
+
+       Arguments:
+        | ``coordinates``  --  A Nx3 array with Cartesian coordinates.
+
+       Optional arguments:
+        | ``unit_cell``  --  The periodic boundary conditions. The shortest
+                             distance between the periodic images is used, see
+                             :meth:`molmod.unit_cells.UnitCell.minimum_image`.
+        | ``condensed``  --  When True, a condensed array with N(N-1)/2
+                             distances is returned instead of a NxN matrix.
+                             See the note on the order below.
+        | ``block_size``  --  The maximum number of atom pairs in one block.
+                              This bounds the size of the temporary arrays.
+        | ``method``  --  ``"direct"`` computes the relative vectors of all
+                          pairs. ``"gram"`` derives the distances from a Gram
+                          matrix, computed with a BLAS matrix product. This
+                          is faster for large systems, but the squared
+                          distances have an absolute error of about 1e-16
+                          times the squared size of the system. It is not
+                          supported for periodic systems. ``"auto"`` uses the
+                          Gram matrix for non-periodic systems with at least
+                          GRAM_THRESHOLD atoms.
+        | ``workers``  --  The number of threads that process blocks
+                           concurrently. NumPy releases the GIL in most of the
+                           work on large arrays.
+
+       The full matrix is exactly symmetric because only the lower triangle
+       is computed.
+
+       Note that the condensed array is ordered by rows of the lower
+       triangle: the pairs (i, j) with j < i, sorted by i and then by j, at
+       index i*(i-1)/2 + j. This is NOT the order of scipy's ``pdist``, which
+       lists the upper triangle row by row, so the condensed array can not be
+       passed to scipy's ``squareform``. The lower-triangle order is the one
+       used in the tables of :class:`molmod.similarity.SimilarityDescriptor`,
+       which accepts the condensed array directly. A condensed array in the
+       ``pdist`` order would give wrong similarity descriptors.
+    """
+    coordinates = numpy.asarray(coordinates, float)
+    size = len(coordinates)
+    if unit_cell is not None and not unit_cell.active.any():
+        unit_cell = None
+    if method == "auto":
+        if unit_cell is None and size >= GRAM_THRESHOLD:
+            method = "gram"
+        else:
+            method = "direct"
+    if method == "gram":
+        if unit_cell is not None:
+            raise ValueError("The Gram matrix method does not support periodic systems.")
+        # reduce the rounding errors by centering the coordinates
+        coordinates = coordinates - coordinates.mean(axis=0)
+        norms_sq = (coordinates**2).sum(axis=1)
+        compute_block = lambda begin, end: _compute_block_gram(coordinates, norms_sq, begin, end)
+    elif method == "direct":
+        compute_block = lambda begin, end: _compute_block_direct(coordinates, begin, end, unit_cell)
+    else:
+        raise ValueError("Unknown method: %s" % method)
+
+    if condensed:
+        result = numpy.zeros(size*(size - 1)/2, float)
+    else:
+        result = numpy.zeros((size, size), float)
+
+    # rows of the lower triangle, grouped such that each block has at most
+    # block_size elements
+    blocks = []
+    begin = 0
+    while begin < size:
+        end = begin + 1
+        while end < size and (end - begin + 1)*(end + 1) <= block_size:
+            end += 1
+        blocks.append((begin, end))
+        begin = end
+
+    def process(block):
+        """Compute one block of rows and store its lower triangle"""
+        begin, end = block
+        distances = compute_block(begin, end)
+        if condensed:
+            first = begin*(begin - 1)/2
+            last = end*(end - 1)/2
+            # row i contains the columns 0:i
+            rows = numpy.arange(begin, end).repeat(numpy.arange(begin, end))
+            columns = numpy.arange(first, last) - rows*(rows - 1)/2
+            result[first:last] = distances[rows - begin, columns]
+        else:
+            result[begin:end,:begin] = distances[:,:begin]
+            result[:begin,begin:end] = distances[:,:begin].transpose()
+            lower = numpy.tril(distances[:,begin:end], -1)
+            result[begin:end,begin:end] = lower + lower.transpose()
+
+    if workers > 1 and len(blocks) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            pool.map(process, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for block in blocks:
+            process(block)
+    return result
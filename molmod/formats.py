@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Registry of file formats that can be loaded into Molecule objects
+
+   The format of a file is derived from its extension. When the extension is
+   missing or does not match the contents, the format is detected from the
+   first few lines of the file. The readers in :mod:`molmod.io` are only
+   imported when a file of that format is actually loaded. Example::
+
+       molecule = load_molecule("input/water.xyz")
+       for molecule in load_many(filenames, workers=4):
+           print molecule.title
+
+   Additional formats can be added with :func:`register_format`.
+"""
+
+
+import os
+
+
+__all__ = [
+    "FileFormat", "register_format", "get_format", "detect_format",
+    "load_molecule", "load_many",
+]
+
+
+class FileFormat(object):
+    """Description of a file format in the registry"""
+
+    def __init__(self, name, extensions, load, sniff=None):
+        """
+           Arguments:
+            | ``name``  --  A short name of the format, e.g. ``"xyz"``.
+            | ``extensions``  --  A list of filename extensions, including the
+                                  leading dot.
+            | ``load``  --  A function that takes a filename and returns a
+                            Molecule object. It should import the actual
+                            reader when it is called.
+
+           Optional argument:
+            | ``sniff``  --  A function that takes the first lines of a file
+                             (a list of strings) and returns True when the
+                             file seems to be in this format.
+        """
+        self.name = name
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self.load = load
+        self.sniff = sniff
+
+
+# the registered formats, in the order in which they are sniffed
+_formats = []
+
+# the number of lines that are passed to the sniff functions
+_num_header_lines = 8
+
+
+def register_format(name, extensions, load, sniff=None):
+    """Add a file format to the registry
+
+       See :class:`FileFormat` for the arguments. A format with the same name
+       is replaced. Returns the new FileFormat object.
+    """
+    file_format = FileFormat(name, extensions, load, sniff)
+    for i, other in enumerate(_formats):
+        if other.name == name:
+            _formats[i] = file_format
+            break
+    else:
+        _formats.append(file_format)
+    return file_format
+
+
+def get_format(name):
+    """Return the registered FileFormat with the given name"""
+    for file_format in _formats:
+        if file_format.name == name:
+            return file_format
+    raise ValueError("Unknown file format: %s" % name)
+
+
+def _read_header(filename):
+    """Return the first lines of a file"""
+    f = file(filename)
+    try:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == _num_header_lines:
+                break
+        return lines
+    finally:
+        f.close()
+
+
+def detect_format(filename):
+    """Return the FileFormat of a file
+
+       Argument:
+        | ``filename``  --  The name of the file.
+
+       The format that matches the extension is used when it accepts the
+       header of the file or when it can not sniff. Otherwise the header is
+       compared with all registered formats. When that does not work either,
+       the extension decides.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    candidate = None
+    for file_format in _formats:
+        if extension in file_format.extensions:
+            candidate = file_format
+            break
+    if candidate is not None and candidate.sniff is None:
+        return candidate
+    header = _read_header(filename)
+    if candidate is not None and candidate.sniff(header):
+        return candidate
+    for file_format in _formats:
+        if file_format.sniff is not None and file_format.sniff(header):
+            return file_format
+    if candidate is not None:
+        return candidate
+    raise ValueError("Could not determine file format for %s." % filename)
+
+
+def load_molecule(filename, format=None):
+    """Load a Molecule object from a file
+
+       Argument:
+        | ``filename``  --  The name of the file.
+
+       Optional argument:
+        | ``format``  --  The name of a registered format. By default, it is
+                          derived from the filename and the contents of the
+                          file, see :func:`detect_format`.
+
+       If a file contains more than one molecule, only the first one is read.
+    """
+    if format is None:
+        file_format = detect_format(filename)
+    else:
+        file_format = get_format(format)
+    return file_format.load(filename)
+
+
+def _load_molecule_args(args):
+    """Wrapper around load_molecule for Pool.imap"""
+    return load_molecule(*args)
+
+
+def load_many(filenames, workers=1, format=None, chunk_size=16):
+    """Load Molecule objects from many files
+
+       Argument:
+        | ``filenames``  --  An iterable with filenames.
+
+       Optional arguments:
+        | ``workers``  --  The number of processes that parse the files. When
+                           one, the files are loaded in the current process.
+        | ``format``  --  The name of a registered format for all files. By
+                          default, the format of each file is detected.
+        | ``chunk_size``  --  The number of files sent to a process at once.
+
+       This is a generator that yields the molecules in the same order as the
+       filenames. The files are parsed while the molecules are consumed, so
+       only a limited number of molecules is kept in memory.
+    """
+    if workers < 1:
+        raise ValueError("The number of workers must be at least one.")
+    args = ((filename, format) for filename in filenames)
+    if workers == 1:
+        for arg in args:
+            yield _load_molecule_args(arg)
+        return
+    from multiprocessing import Pool
+    pool = Pool(workers)
+    try:
+        for molecule in pool.imap(_load_molecule_args, args, chunk_size):
+            yield molecule
+        pool.close()
+    finally:
+        # also stops the workers when the generator is not exhausted
+        pool.terminate()
+        pool.join()
+
+
+def _sniff_cml(header):
+    """The header contains an XML declaration or a CML tag"""
+    text = "".join(header)
+    return "<molecule" in text or "xml-cml" in text
+
+
+def _load_cml(filename):
+    from molmod.io import load_cml
+    return load_cml(filename)[0]
+
+
+def _sniff_fchk(header):
+    """The third line is the first field of a formatted checkpoint file"""
+    return len(header) > 2 and header[2].startswith("Number of atoms")
+
+
+def _load_fchk(filename):
+    from molmod.io import FCHKFile
+    return FCHKFile(filename, field_labels=[]).molecule
+
+
+# the record names of the PDB format (version 3.3), including a few obsolete
+# records that are still found in older files
+_pdb_records = frozenset([
+    "HEADER", "OBSLTE", "TITLE", "SPLIT", "CAVEAT", "COMPND", "SOURCE",
+    "KEYWDS", "EXPDTA", "NUMMDL", "MDLTYP", "AUTHOR", "REVDAT", "SPRSDE",
+    "JRNL", "REMARK", "DBREF", "DBREF1", "DBREF2", "SEQADV", "SEQRES",
+    "MODRES", "HET", "HETNAM", "HETSYN", "FORMUL", "HELIX", "SHEET", "SSBOND",
+    "LINK", "CISPEP", "SITE", "CRYST1", "ORIGX1", "ORIGX2", "ORIGX3",
+    "SCALE1", "SCALE2", "SCALE3", "MTRIX1", "MTRIX2", "MTRIX3", "MODEL",
+    "ATOM", "ANISOU", "TER", "HETATM", "ENDMDL", "CONECT", "MASTER", "END",
+    "FTNOTE", "TURN", "TVECT", "SIGATM", "SIGUIJ",
+])
+
+
+def _sniff_pdb(header):
+    """All lines start with a PDB record name in the first six columns"""
+    lines = [line for line in header if len(line.strip()) > 0]
+    return len(lines) > 0 and all(line[:6].strip() in _pdb_records for line in lines)
+
+
+def _load_pdb(filename):
+    from molmod.io import load_pdb
+    return load_pdb(filename)
+
+
+def _sniff_sdf(header):
+    """The fourth line is a counts line of a MDL molfile"""
+    return len(header) > 3 and header[3].rstrip().endswith(("V2000", "V3000"))
+
+
+def _load_sdf(filename):
+    from molmod.io import SDFReader
+    return SDFReader(filename).next()
+
+
+def _sniff_xyz(header):
+    """The first line is the number of atoms, followed by a title and atoms"""
+    if len(header) < 3:
+        return False
+    try:
+        int(header[0])
+    except ValueError:
+        return False
+    words = header[2].split()
+    if len(words) < 4:
+        return False
+    try:
+        [float(word) for word in words[1:4]]
+    except ValueError:
+        return False
+    return True
+
+
+def _load_xyz(filename):
+    from molmod.io import XYZReader
+    from molmod.molecules import Molecule
+    xyz_reader = XYZReader(filename)
+    title, coordinates = xyz_reader.next()
+    return Molecule(xyz_reader.numbers, coordinates, title, symbols=xyz_reader.symbols)
+
+
+register_format("cml", [".cml"], _load_cml, _sniff_cml)
+register_format("fchk", [".fchk", ".fch"], _load_fchk, _sniff_fchk)
+register_format("pdb", [".pdb"], _load_pdb, _sniff_pdb)
+register_format("sdf", [".sdf"], _load_sdf, _sniff_sdf)
+register_format("xyz", [".xyz"], _load_xyz, _sniff_xyz)
@@ -110,27 +110,46 @@ class Graph(ReadOnly):
            num_vertices argument to tell what the total number of vertices is.
 
            If the edges argument does not have the correct format, it will be
-           converted.
+           converted. An integer array with shape (num_edges, 2) is checked
+           with vectorized operations, which is much faster for large graphs.
         """
 
-        tmp = []
-        for edge in edges:
-            if len(edge) != 2:
+        if isinstance(edges, numpy.ndarray):
+            # the same checks, vectorized, for an array with shape (N, 2)
+            if edges.size == 0:
+                edges = edges.reshape((0, 2))
+            if len(edges.shape) != 2 or edges.shape[1] != 2:
                 raise TypeError("The edges must be a iterable with 2 elements")
-            i, j = edge
-            if i == j:
-                raise ValueError("A edge must contain two different values.")
-            if not (isinstance(i, int) and isinstance(j, int)):
+            if not numpy.issubdtype(edges.dtype, numpy.integer):
                 raise TypeError("The edges must contain integers.")
-            if i < 0 or j < 0:
+            if (edges[:,0] == edges[:,1]).any():
+                raise ValueError("A edge must contain two different values.")
+            if (edges < 0).any():
                 raise TypeError("The edges must contain positive integers.")
-            tmp.append(frozenset([i, j]))
-        edges = tuple(tmp)
-
-        if len(edges) == 0:
-            real_num_vertices = 0
+            if len(edges) == 0:
+                real_num_vertices = 0
+            else:
+                real_num_vertices = int(edges.max())+1
+            edges = tuple(map(frozenset, edges.tolist()))
         else:
-            real_num_vertices = max(max(a, b) for a, b in edges)+1
+            tmp = []
+            for edge in edges:
+                if len(edge) != 2:
+                    raise TypeError("The edges must be a iterable with 2 elements")
+                i, j = edge
+                if i == j:
+                    raise ValueError("A edge must contain two different values.")
+                if not (isinstance(i, int) and isinstance(j, int)):
+                    raise TypeError("The edges must contain integers.")
+                if i < 0 or j < 0:
+                    raise TypeError("The edges must contain positive integers.")
+                tmp.append(frozenset([i, j]))
+            edges = tuple(tmp)
+
+            if len(edges) == 0:
+                real_num_vertices = 0
+            else:
+                real_num_vertices = max(max(a, b) for a, b in edges)+1
         if num_vertices is not None:
             if not isinstance(num_vertices, int):
                 raise TypeError("The optional argument num_vertices must be an "
@@ -154,17 +173,15 @@ class Graph(ReadOnly):
         """
         if not isinstance(repeat, int):
             raise TypeError("Can only multiply a graph with an integer")
-        new_edges = []
-        for i in xrange(repeat):
-            for vertex1, vertex2 in self.edges:
-                new_edges.append(frozenset([
-                    vertex1+i*self.num_vertices,
-                    vertex2+i*self.num_vertices
-                ]))
-        return Graph(new_edges, self.num_vertices*repeat)
+        return Graph(self._repeat_edges(repeat), self.num_vertices*repeat)
 
     __rmul__ = __mul__
 
+    def _repeat_edges(self, repeat):
+        """Return an array with the edges of repeat copies of this graph"""
+        offsets = numpy.arange(repeat)*self.num_vertices
+        return (self.edge_array + offsets.reshape((-1, 1, 1))).reshape((-1, 2))
+
     def __str__(self):
         return " ".join("%i-%i" % tuple(sorted([i, j])) for i, j in self.edges)
 
@@ -186,6 +203,11 @@ class Graph(ReadOnly):
 
     # cached attributes:
 
+    @cached
+    def edge_array(self):
+        """An integer array with the two vertices of each edge, shape=(num_edges, 2)"""
+        return numpy.array([tuple(edge) for edge in self.edges], int).reshape((-1, 2))
+
     @cached
     def edge_index(self):
         """A map to look up the index of a edge"""
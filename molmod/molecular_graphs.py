@@ -106,6 +106,8 @@ class MolecularGraph(Graph):
         orders = []
         lengths = []
         edges = []
+        # the relative vectors of the bonds, in both directions
+        deltas = {}
 
         for i0, i1, delta, distance in pair_search:
             bond_order = bonds.bonded(molecule.numbers[i0], molecule.numbers[i1], distance/scaling)
@@ -114,6 +116,8 @@ class MolecularGraph(Graph):
                     orders.append(bond_order)
                 lengths.append(distance)
                 edges.append((i0,i1))
+                deltas[(i0,i1)] = delta
+                deltas[(i1,i0)] = -delta
 
         if do_orders:
             result = cls(edges, molecule.numbers, orders, symbols=molecule.symbols)
@@ -129,9 +133,7 @@ class MolecularGraph(Graph):
         for c, ns in result.neighbors.iteritems():
             lengths_ns = []
             for n in ns:
-                delta = molecule.coordinates[n] - molecule.coordinates[c]
-                if unit_cell is not None:
-                    delta = unit_cell.shortest_vector(delta)
+                delta = deltas[(c,n)]
                 length = numpy.linalg.norm(delta)
                 lengths_ns.append([length, delta, n])
             lengths_ns.sort(reverse=True, cmp=(lambda r0, r1: cmp(r0[0], r1[0])))
@@ -215,18 +217,11 @@ class MolecularGraph(Graph):
         if not isinstance(repeat, int):
             raise TypeError("Can only multiply a graph with an integer")
         # copy edges
-        new_edges = []
-        for i in xrange(repeat):
-            for vertex1, vertex2 in self.edges:
-                new_edges.append(frozenset([vertex1+i*self.num_vertices, vertex2+i*self.num_vertices]))
+        new_edges = self._repeat_edges(repeat)
         # copy numbers
-        new_numbers = numpy.zeros((repeat, len(self.numbers)), int)
-        new_numbers[:] = self.numbers
-        new_numbers = new_numbers.ravel()
-        # copy orders
-        new_orders = numpy.zeros((repeat, len(self.orders)), int)
-        new_orders[:] = self.orders
-        new_orders = new_orders.ravel()
+        new_numbers = numpy.tile(self.numbers, repeat)
+        # copy orders, which may be fractional
+        new_orders = numpy.tile(self.orders, repeat)
         # copy symbols
         if self.symbols is not None:
             new_symbols = self.symbols*repeat
@@ -25,6 +25,7 @@
 
 from molmod.periodic import periodic
 from molmod.units import angstrom
+from molmod.formats import load_molecule
 from molmod.utils import cached, ReadOnly, ReadOnlyAttribute
 from molmod.molecular_graphs import MolecularGraph
 from molmod.unit_cells import UnitCell
@@ -36,7 +37,181 @@ from StringIO import StringIO
 import numpy
 
 
-__all__ = ["Molecule"]
+__all__ = [
+    "Molecule", "MoleculeEnsemble", "make_supercell", "compute_coms", "compute_inertia_tensors",
+    "compute_principal_moments", "compute_radii_of_gyration",
+]
+
+
+def _iter_frame_chunks(geometries, chunk_size):
+    """Iterate over slices of frames in a stack of geometries"""
+    if chunk_size is None:
+        chunk_size = max(1, len(geometries))
+    for begin in xrange(0, len(geometries), chunk_size):
+        yield slice(begin, begin + chunk_size)
+
+
+def _as_stack(geometries):
+    """Return a MxNx3 array and a flag to indicate a single geometry"""
+    geometries = numpy.asarray(geometries, float)
+    if len(geometries.shape) == 2:
+        return geometries.reshape((1,) + geometries.shape), True
+    if len(geometries.shape) != 3 or geometries.shape[2] != 3:
+        raise TypeError("The geometries must be a MxNx3 or a Nx3 array.")
+    return geometries, False
+
+
+def compute_coms(geometries, masses, chunk_size=None):
+    """Compute the centers of mass of a stack of geometries
+
+       Arguments:
+        | ``geometries``  --  A MxNx3 array with M geometries of N atoms, e.g.
+                              the attribute geometries of an XYZFile object.
+                              A single Nx3 array is also accepted.
+        | ``masses``  --  An array with N atomic masses.
+
+       Optional argument:
+        | ``chunk_size``  --  The number of frames processed at once. By
+                              default, all frames are processed at once.
+
+       Returns a Mx3 array, or a single vector for a single geometry.
+    """
+    geometries, single = _as_stack(geometries)
+    masses = numpy.asarray(masses, float)
+    result = numpy.zeros((len(geometries), 3), float)
+    for chunk in _iter_frame_chunks(geometries, chunk_size):
+        result[chunk] = numpy.dot(masses, geometries[chunk])/masses.sum()
+    if single:
+        return result[0]
+    return result
+
+
+def compute_inertia_tensors(geometries, masses, chunk_size=None):
+    """Compute the inertia tensors of a stack of geometries
+
+       The inertia tensors are computed with respect to the centers of mass.
+       See :func:`compute_coms` for the arguments. Returns a Mx3x3 array, or a
+       single 3x3 array for a single geometry.
+    """
+    geometries, single = _as_stack(geometries)
+    masses = numpy.asarray(masses, float)
+    result = numpy.zeros((len(geometries), 3, 3), float)
+    for chunk in _iter_frame_chunks(geometries, chunk_size):
+        relative = geometries[chunk] - compute_coms(geometries[chunk], masses).reshape((-1, 1, 3))
+        weighted = relative*masses.reshape((1, -1, 1))
+        tensors = result[chunk]
+        for i in xrange(3):
+            for j in xrange(i + 1):
+                tensors[:,i,j] = -(weighted[:,:,i]*relative[:,:,j]).sum(axis=1)
+                tensors[:,j,i] = tensors[:,i,j]
+        # the diagonal term
+        tensors[:,[0,1,2],[0,1,2]] -= tensors.trace(axis1=1, axis2=2).reshape((-1, 1))
+    if single:
+        return result[0]
+    return result
+
+
+def compute_principal_moments(geometries, masses, chunk_size=None):
+    """Compute the principal moments of inertia of a stack of geometries
+
+       See :func:`compute_coms` for the arguments. Returns a Mx3 array with
+       the eigenvalues of the inertia tensors in increasing order, or a single
+       vector for a single geometry.
+    """
+    geometries, single = _as_stack(geometries)
+    result = numpy.zeros((len(geometries), 3), float)
+    for chunk in _iter_frame_chunks(geometries, chunk_size):
+        result[chunk] = numpy.linalg.eigvalsh(compute_inertia_tensors(geometries[chunk], masses))
+    if single:
+        return result[0]
+    return result
+
+
+def compute_radii_of_gyration(geometries, masses, chunk_size=None):
+    """Compute the mass-weighted radii of gyration of a stack of geometries
+
+       See :func:`compute_coms` for the arguments. Returns an array with M
+       radii, or a single number for a single geometry.
+    """
+    geometries, single = _as_stack(geometries)
+    masses = numpy.asarray(masses, float)
+    result = numpy.zeros(len(geometries), float)
+    for chunk in _iter_frame_chunks(geometries, chunk_size):
+        relative = geometries[chunk] - compute_coms(geometries[chunk], masses).reshape((-1, 1, 3))
+        result[chunk] = numpy.sqrt(numpy.dot((relative**2).sum(axis=2), masses)/masses.sum())
+    if single:
+        return result[0]
+    return result
+
+
+def make_supercell(molecule, repeats):
+    """Repeat a periodic molecule along its cell vectors
+
+       Arguments:
+        | ``molecule``  --  A Molecule object with a unit cell. The graph is
+                            optional.
+        | ``repeats``  --  Three integers: the number of repetitions along
+                           each cell vector. Must be one for inactive cell
+                           vectors.
+
+       Returns a new Molecule object with the repeated atoms and a unit cell
+       whose active cell vectors are multiplied by the repeats. The atoms of
+       the image at integer shift (i, j, k) follow those of the preceding
+       images in row-major order of the shifts.
+
+       When the molecule has a graph, a bond between two atoms in the original
+       cell is assumed to follow the minimum image convention. Each copy of a
+       bond connects an atom with the image of its partner in the neighboring
+       copy of the cell that contains the minimum image, with periodic
+       wrapping in the supercell. All work is done with array operations.
+    """
+    unit_cell = molecule.unit_cell
+    if unit_cell is None:
+        raise ValueError("The molecule must have a unit cell.")
+    repeats = numpy.array(repeats, int)
+    if repeats.shape != (3,):
+        raise TypeError("Three repeats are required.")
+    if (repeats < 1).any():
+        raise ValueError("The repeats must be strictly positive.")
+    if (repeats[~unit_cell.active] != 1).any():
+        raise ValueError("The repeats must be one for the inactive cell vectors.")
+    size = molecule.size
+    num_images = repeats.prod()
+    # all integer shifts in row-major order
+    shifts = numpy.indices(repeats).reshape((3, -1)).transpose()
+    translations = unit_cell.to_cartesian(shifts)
+    coordinates = (molecule.coordinates + translations.reshape((-1, 1, 3))).reshape((-1, 3))
+    numbers = numpy.tile(molecule.numbers, num_images)
+    masses = None
+    if molecule.masses is not None:
+        masses = numpy.tile(molecule.masses, num_images)
+    symbols = None
+    if molecule.symbols is not None:
+        symbols = molecule.symbols*num_images
+    graph = None
+    if molecule.graph is not None:
+        graph = molecule.graph
+        edges = graph.edge_array
+        # the cell vectors crossed by each bond in the minimum image
+        deltas = molecule.coordinates[edges[:,1]] - molecule.coordinates[edges[:,0]]
+        crossings = unit_cell.to_fractional(unit_cell.minimum_image(deltas) - deltas)
+        crossings = numpy.round(crossings).astype(int)
+        # the image of the second atom for each bond in each image
+        partners = (shifts.reshape((-1, 1, 3)) + crossings) % repeats
+        partners = numpy.dot(partners, [repeats[1]*repeats[2], repeats[2], 1])
+        offsets = (numpy.arange(num_images)*size).reshape((-1, 1))
+        new_edges = numpy.zeros((num_images, len(edges), 2), int)
+        new_edges[:,:,0] = edges[:,0] + offsets
+        new_edges[:,:,1] = edges[:,1] + partners*size
+        graph = MolecularGraph(
+            new_edges.reshape((-1, 2)), numbers,
+            numpy.tile(graph.orders, num_images), symbols
+        )
+    matrix = unit_cell.matrix*numpy.where(unit_cell.active, repeats, 1)
+    return Molecule(
+        numbers, coordinates, molecule.title, masses, graph, symbols,
+        unit_cell.copy_with(matrix=matrix)
+    )
 
 
 class Molecule(ReadOnly):
@@ -120,8 +295,10 @@ class Molecule(ReadOnly):
     def from_file(cls, filename):
         """Construct a molecule object read from the given file.
 
-           The file format is inferred from the extensions. Currently supported
+           The file format is inferred from the extension, or from the
+           contents when the extension is missing or wrong. Currently supported
            formats are: ``*.cml``, ``*.fchk``, ``*.pdb``, ``*.sdf``, ``*.xyz``
+           See :mod:`molmod.formats` to add other formats.
 
            If a file contains more than one molecule, only the first one is
            read.
@@ -133,36 +310,61 @@ class Molecule(ReadOnly):
 
              >>> mol = Molecule.from_file("foo.xyz")
         """
-        # TODO: many different API's to load files. brrr...
-        if filename.endswith(".cml"):
-            from molmod.io import load_cml
-            return load_cml(filename)[0]
-        elif filename.endswith(".fchk"):
-            from molmod.io import FCHKFile
-            fchk = FCHKFile(filename, field_labels=[])
-            return fchk.molecule
-        elif filename.endswith(".pdb"):
-            from molmod.io import load_pdb
-            return load_pdb(filename)
-        elif filename.endswith(".sdf"):
-            from molmod.io import SDFReader
-            return SDFReader(filename).next()
-        elif filename.endswith(".xyz"):
-            from molmod.io import XYZReader
-            xyz_reader = XYZReader(filename)
-            title, coordinates = xyz_reader.next()
-            return Molecule(xyz_reader.numbers, coordinates, title, symbols=xyz_reader.symbols)
-        else:
-            raise ValueError("Could not determine file format for %s." % filename)
+        return load_molecule(filename)
 
     size = property(lambda self: self.numbers.shape[0],
         doc="*Read-only attribute:* the number of atoms.")
 
     @cached
     def distance_matrix(self):
-        """the matrix with all atom pair distances"""
-        from molmod.ext import molecules_distance_matrix
-        return molecules_distance_matrix(self.coordinates)
+        """the matrix with all atom pair distances
+
+           When the molecule has a unit cell, the shortest distances between
+           the periodic images are used. The relative vectors of all pairs are
+           computed directly, so the distances are exact to machine
+           precision. Use :func:`molmod.distances.compute_distance_matrix`
+           with ``method="gram"`` for a faster but less precise alternative.
+        """
+        from molmod.distances import compute_distance_matrix
+        return compute_distance_matrix(self.coordinates, self.unit_cell, method="direct")
+
+    def distance_matrix_condensed(self, block_size=2**20, method="auto", workers=1):
+        """Return all atom pair distances in a condensed array
+
+           The array contains the N(N-1)/2 distances between distinct atoms,
+           without the redundant half of the distance matrix. When the
+           molecule has a unit cell, the shortest distances between the
+           periodic images are used.
+
+           Optional arguments:
+            | ``block_size``, ``method``, ``workers``  --  see
+                :func:`molmod.distances.compute_distance_matrix`
+
+           See :mod:`molmod.distances` for the order of the pairs.
+        """
+        from molmod.distances import compute_distance_matrix
+        return compute_distance_matrix(
+            self.coordinates, self.unit_cell, True, block_size, method, workers
+        )
+
+    def distance_matrix_sparse(self, cutoff, deltas=False):
+        """Return all atom pair distances below a cutoff in a sparse matrix
+
+           This is the cutoff-limited counterpart of the attribute
+           distance_matrix. The memory usage scales linearly with the number
+           of atoms. When the molecule has a unit cell, the minimum image
+           convention is applied.
+
+           Argument:
+            | ``cutoff``  --  the largest distance to be included
+
+           Optional argument:
+            | ``deltas``  --  also store the relative vectors
+
+           Returns: a :class:`molmod.binning.SparseDistanceMatrix` object.
+        """
+        from molmod.binning import SparseDistanceMatrix
+        return SparseDistanceMatrix(self.coordinates, cutoff, self.unit_cell, deltas=deltas)
 
     @cached
     def mass(self):
@@ -172,19 +374,12 @@ class Molecule(ReadOnly):
     @cached
     def com(self):
         """the center of mass of the molecule"""
-        return (self.coordinates*self.masses.reshape((-1,1))).sum(axis=0)/self.mass
+        return compute_coms(self.coordinates, self.masses)
 
     @cached
     def inertia_tensor(self):
         """the intertia tensor of the molecule"""
-        result = numpy.zeros((3,3), float)
-        for i in xrange(self.size):
-            r = self.coordinates[i] - self.com
-            # the diagonal term
-            result.ravel()[::4] += self.masses[i]*(r**2).sum()
-            # the outer product term
-            result -= self.masses[i]*numpy.outer(r,r)
-        return result
+        return compute_inertia_tensors(self.coordinates, self.masses)
 
     @cached
     def chemical_formula(self):
@@ -289,3 +484,269 @@ class Molecule(ReadOnly):
             return compute_rotsym(self, graph, threshold)
         except ValueError:
             raise ValueError("The rotational symmetry number can only be computed when the graph is fully connected.")
+
+
+class MoleculeEnsemble(ReadOnly):
+    """A set of conformers of one molecule in a struct-of-arrays layout
+
+       The atomic numbers, masses, graph, symbols and unit cell are stored
+       once for all conformers. The coordinates are stored in a single MxNx3
+       array, together with a title and an energy for each conformer. This
+       takes far less memory than a list of :class:`Molecule` objects and
+       derived quantities are computed for all conformers at once.
+
+       An element of an ensemble is a :class:`Molecule` object that shares
+       its arrays with the ensemble, i.e. no data are copied::
+
+         >>> ensemble = MoleculeEnsemble.from_file("traj.xyz")
+         >>> print ensemble[3].distance_matrix
+         >>> print ensemble.radii_of_gyration
+    """
+    def _check_geometries(self, geometries):
+        """the number of atoms must be the same as the length of the array numbers"""
+        if geometries.shape[1] != self.size:
+            raise TypeError("The number of atoms in the geometries does not "
+                "match the length of the atomic numbers array.")
+
+    def _check_titles(self, titles):
+        """the number of titles must match the number of geometries and all elements must be strings"""
+        if len(titles) != len(self.geometries):
+            raise TypeError("The number of titles does not match the number "
+                "of geometries.")
+        for title in titles:
+            if not isinstance(title, basestring):
+                raise TypeError("All titles must be strings.")
+
+    def _check_energies(self, energies):
+        """the number of energies must match the number of geometries"""
+        if len(energies) != len(self.geometries):
+            raise TypeError("The number of energies does not match the number "
+                "of geometries.")
+
+    numbers = ReadOnlyAttribute(numpy.ndarray, none=False, npdim=1, npdtype=int,
+        doc="the atomic numbers")
+    geometries = ReadOnlyAttribute(numpy.ndarray, none=False, npdim=3,
+        npshape=(None,None,3), npdtype=float, check=_check_geometries,
+        doc="the Cartesian coordinates of all conformers, shape=(M,N,3)")
+    titles = ReadOnlyAttribute(tuple, check=_check_titles, doc="a short description "
+        "of each conformer")
+    energies = ReadOnlyAttribute(numpy.ndarray, npdim=1, npdtype=float,
+        check=_check_energies, doc="the energy of each conformer")
+    masses = Molecule.masses
+    graph = Molecule.graph
+    symbols = Molecule.symbols
+    unit_cell = Molecule.unit_cell
+
+    def __init__(self, numbers, geometries, titles=None, energies=None, masses=None, graph=None, symbols=None, unit_cell=None):
+        """
+           Mandatory arguments:
+            | ``numbers``  --  numpy array (1D, N elements) with the atomic numbers
+            | ``geometries``  --  numpy array (3D, MxNx3 elements) with the
+                                  Cartesian coordinates of M conformers
+
+           Optional keyword arguments:
+            | ``titles``  --  a list with M strings
+            | ``energies``  --  a numpy array with M energies
+            | ``masses``  --  a numpy array with atomic masses in atomic units
+            | ``graph``  --  a MolecularGraph instance
+            | ``symbols``  --  atomic elements or force-field atom-types
+            | ``unit_cell``  --  the unit cell in case the system is periodic
+
+           Like all array attributes of ReadOnly objects, a writable
+           geometries array is copied. Pass a read-only array to avoid the
+           copy of a large ensemble.
+        """
+        self.numbers = numbers
+        self.geometries = geometries
+        self.titles = titles
+        self.energies = energies
+        self.masses = masses
+        self.graph = graph
+        self.symbols = symbols
+        self.unit_cell = unit_cell
+
+    @classmethod
+    def from_molecules(cls, molecules, energies=None):
+        """Construct an ensemble from a list of molecules
+
+           Argument:
+            | ``molecules``  --  a list of Molecule objects with the same
+                                 atoms in the same order
+
+           Optional argument:
+            | ``energies``  --  an array with the energy of each molecule
+
+           The numbers, masses, graph, symbols and unit cell are taken from
+           the first molecule.
+        """
+        molecules = list(molecules)
+        if len(molecules) == 0:
+            raise ValueError("At least one molecule is required.")
+        first = molecules[0]
+        geometries = numpy.zeros((len(molecules), first.size, 3), float)
+        for i, molecule in enumerate(molecules):
+            if molecule.numbers.shape != first.numbers.shape or \
+               (molecule.numbers != first.numbers).any():
+                raise ValueError("All molecules must have the same numbers.")
+            geometries[i] = molecule.coordinates
+        geometries.setflags(write=False)
+        titles = None
+        if all(molecule.title is not None for molecule in molecules):
+            titles = [molecule.title for molecule in molecules]
+        return cls(first.numbers, geometries, titles, energies, first.masses,
+                   first.graph, first.symbols, first.unit_cell)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Construct an ensemble with all frames in a file
+
+           Currently, only the ``*.xyz`` format is supported.
+
+           Argument:
+            | ``filename``  --  the name of the file containing the conformers
+        """
+        if filename.endswith(".xyz"):
+            from molmod.io import XYZFile
+            xyz_file = XYZFile(filename)
+            geometries = xyz_file.geometries
+            geometries.setflags(write=False)
+            return cls(xyz_file.numbers, geometries, xyz_file.titles,
+                       symbols=xyz_file.symbols)
+        else:
+            raise ValueError("Could not determine file format for %s." % filename)
+
+    size = property(lambda self: self.numbers.shape[0],
+        doc="*Read-only attribute:* the number of atoms.")
+
+    def __len__(self):
+        """The number of conformers"""
+        return len(self.geometries)
+
+    def __getitem__(self, index):
+        """Return a Molecule for an integer index or an ensemble otherwise
+
+           The arrays of the result share their memory with this ensemble,
+           except for a selection with an index array.
+        """
+        if isinstance(index, (int, long, numpy.integer)):
+            geometries = self.geometries
+            if index < -len(geometries) or index >= len(geometries):
+                raise IndexError("Conformer index out of range.")
+            # Read-only arrays are not copied by the ReadOnlyAttribute.
+            return Molecule(
+                self.numbers, geometries[index],
+                None if self.titles is None else self.titles[index],
+                self.masses, self.graph, self.symbols, self.unit_cell,
+            )
+        geometries = self.geometries[index]
+        if geometries.flags.writeable:
+            geometries.setflags(write=False)
+        titles = None
+        if self.titles is not None:
+            titles = numpy.array(self.titles, dtype=object)[index].tolist()
+        energies = None
+        if self.energies is not None:
+            energies = self.energies[index]
+        return self.copy_with(geometries=geometries, titles=titles, energies=energies)
+
+    def __iter__(self):
+        """Iterate over all conformers as Molecule objects"""
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @cached
+    def mass(self):
+        """The total mass of the molecule"""
+        return self.masses.sum()
+
+    @cached
+    def coms(self):
+        """The centers of mass of all conformers, shape=(M,3)"""
+        return compute_coms(self.geometries, self.masses)
+
+    @cached
+    def inertia_tensors(self):
+        """The inertia tensors of all conformers, shape=(M,3,3)"""
+        return compute_inertia_tensors(self.geometries, self.masses)
+
+    @cached
+    def principal_moments(self):
+        """The principal moments of inertia of all conformers, shape=(M,3)"""
+        return compute_principal_moments(self.geometries, self.masses)
+
+    @cached
+    def radii_of_gyration(self):
+        """The radii of gyration of all conformers, shape=(M,)"""
+        return compute_radii_of_gyration(self.geometries, self.masses)
+
+    def set_default_masses(self):
+        """Set self.masses based on self.numbers and periodic table."""
+        self.masses = numpy.array([periodic[n].mass for n in self.numbers])
+
+    def set_default_symbols(self):
+        """Set self.symbols based on self.numbers and the periodic table."""
+        self.symbols = tuple(periodic[n].symbol for n in self.numbers)
+
+    def compute_rmsds(self, reference, chunk_size=None):
+        """Compute the RMSD of all conformers after a fit onto a reference
+
+           Argument:
+            | ``reference``  --  a Molecule or a Nx3 array with coordinates
+
+           Optional argument:
+            | ``chunk_size``  --  The number of conformers processed at once.
+                                  By default, all conformers are processed at
+                                  once.
+
+           Returns an array with M RMSDs. The result is the same as the third
+           return value of :meth:`Molecule.rmsd` for each conformer, but the
+           fits are not constructed explicitly.
+        """
+        if isinstance(reference, Molecule):
+            if reference.numbers.shape != self.numbers.shape or \
+               (reference.numbers != self.numbers).any():
+                raise ValueError("The reference does not have the same numbers as this ensemble.")
+            reference = reference.coordinates
+        reference = numpy.asarray(reference, float)
+        if reference.shape != (self.size, 3):
+            raise TypeError("The reference must be a Nx3 array.")
+        reference = reference - reference.mean(axis=0)
+        norm_reference = (reference**2).sum()
+        result = numpy.zeros(len(self), float)
+        for chunk in _iter_frame_chunks(self.geometries, chunk_size):
+            relative = self.geometries[chunk]
+            relative = relative - relative.mean(axis=1).reshape((-1, 1, 3))
+            # Kabsch algorithm: the optimal overlap follows from the singular
+            # values of the correlation matrices.
+            correlations = numpy.einsum("mki,kj->mij", relative, reference)
+            singular = numpy.linalg.svd(correlations, compute_uv=False)
+            signs = numpy.sign(numpy.linalg.det(correlations))
+            singular[:,2] *= numpy.where(signs < 0, -1, 1)
+            squares = (relative**2).sum(axis=2).sum(axis=1) + norm_reference - 2*singular.sum(axis=1)
+            result[chunk] = numpy.sqrt(squares.clip(0, numpy.inf)/(3*self.size))
+        return result
+
+    def write_to_file(self, filename):
+        """Write all conformers to a file.
+
+           Currently, only the ``*.xyz`` format is supported.
+
+           Argument:
+            | ``filename``  --  a filename
+        """
+        if filename.endswith('.xyz'):
+            from molmod.io import XYZWriter
+            symbols = []
+            for n in self.numbers:
+                atom = periodic[n]
+                if atom is None:
+                    symbols.append("X")
+                else:
+                    symbols.append(atom.symbol)
+            xyz_writer = XYZWriter(filename, symbols)
+            for i in xrange(len(self)):
+                title = "" if self.titles is None else self.titles[i]
+                xyz_writer.dump(title, self.geometries[i])
+            del xyz_writer
+        else:
+            raise ValueError("Could not determine file format for %s." % filename)
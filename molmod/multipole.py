@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Tree-code evaluation of electrostatic potentials and fields
+
+   The charges and point dipoles are sorted in an octree. The multipole
+   moments of each node, up to the quadrupole, are computed with respect to
+   the center of its atoms. The potential or the field in a point is computed
+   with the multipole expansion of a node when the node is sufficiently far
+   away, i.e. when the radius of the node divided by the distance to its
+   center is smaller than the opening angle theta. Otherwise the children of
+   the node are considered, or a direct sum is used for the leaf nodes.
+
+   A smaller opening angle gives more accurate results at a higher cost. When
+   theta is zero, the result equals the direct sum. Example::
+
+       tree = MultipoleTree(coordinates, charges, theta=0.5)
+       esp = tree.esp(points)
+       efield = tree.efield(points)
+
+   The cost of building the tree is O(N log N) and the cost of evaluating the
+   potential or the field in M points is roughly O(M log N).
+"""
+
+
+import numpy
+
+
+__all__ = ["MultipoleTree"]
+
+
+class _Node(object):
+    """A node in the octree of a MultipoleTree"""
+
+    def __init__(self, indexes, center, radius, children):
+        """
+           Arguments:
+            | ``indexes``  --  The indexes of the atoms in this node.
+            | ``center``  --  The center of the multipole expansion.
+            | ``radius``  --  The largest distance between an atom in this
+                              node and the center.
+            | ``children``  --  A list of child nodes or None for a leaf.
+        """
+        self.indexes = indexes
+        self.center = center
+        self.radius = radius
+        self.children = children
+
+
+class MultipoleTree(object):
+    """Fast approximate evaluation of the potential and the field of charges
+       and point dipoles
+    """
+
+    # the maximum number of point-atom pairs in one direct sum
+    chunk_size = 100000
+
+    def __init__(self, coordinates, charges=None, dipoles=None, theta=0.5, leaf_size=32):
+        """
+           Arguments:
+            | ``coordinates``  --  A Nx3 array with the positions of the
+                                   charges and dipoles.
+
+           Optional arguments:
+            | ``charges``  --  An array with N charges.
+            | ``dipoles``  --  A Nx3 array with point dipoles.
+            | ``theta``  --  The opening angle. A node is approximated by its
+                             multipole expansion when its radius is smaller
+                             than theta times the distance to the point.
+            | ``leaf_size``  --  Nodes with at most this number of atoms are
+                                 not split further.
+
+           At least charges or dipoles must be given. In practice, the
+           relative error decreases roughly with the square of theta. When
+           there are no atoms, the potential and the field are zero.
+        """
+        if charges is None and dipoles is None:
+            raise ValueError("At least charges or dipoles must be given.")
+        if theta < 0:
+            raise ValueError("The opening angle can not be negative.")
+        if leaf_size < 1:
+            raise ValueError("The leaf size must be at least one.")
+        self.coordinates = numpy.asarray(coordinates, float)
+        self.size = len(self.coordinates)
+        if charges is not None:
+            charges = numpy.asarray(charges, float)
+            if charges.shape != (self.size,):
+                raise TypeError("The charges must be an array with N elements.")
+        if dipoles is not None:
+            dipoles = numpy.asarray(dipoles, float)
+            if dipoles.shape != (self.size, 3):
+                raise TypeError("The dipoles must be a Nx3 array.")
+        self.charges = charges
+        self.dipoles = dipoles
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.nodes = []
+        if self.size == 0:
+            self.root = None
+        else:
+            self.root = self._build(numpy.arange(self.size))
+        self._compute_moments()
+
+    def _build(self, indexes):
+        """Recursively build the octree for a set of atoms"""
+        coordinates = self.coordinates[indexes]
+        center = coordinates.mean(axis=0)
+        radius = numpy.sqrt(((coordinates - center)**2).sum(axis=1)).max()
+        children = None
+        if len(indexes) > self.leaf_size and radius > 0:
+            # split along the center of the bounding box
+            lower = coordinates.min(axis=0)
+            upper = coordinates.max(axis=0)
+            octants = numpy.dot(coordinates > 0.5*(lower + upper), [1, 2, 4])
+            children = []
+            for octant in numpy.unique(octants):
+                children.append(self._build(indexes[octants == octant]))
+        node = _Node(indexes, center, radius, children)
+        self.nodes.append(node)
+        return node
+
+    def _compute_moments(self):
+        """Compute the monopole, dipole and quadrupole moments of all nodes
+
+           The quadrupole moments are traceless and defined as
+           sum_a q_a (3 d_a d_a^T - |d_a|^2 I) for charges, where d_a is the
+           position of atom a relative to the center of the node.
+        """
+        for node in self.nodes:
+            deltas = self.coordinates[node.indexes] - node.center
+            node.charge = 0.0
+            node.dipole = numpy.zeros(3, float)
+            node.quadrupole = numpy.zeros((3, 3), float)
+            if self.charges is not None:
+                charges = self.charges[node.indexes]
+                node.charge = charges.sum()
+                node.dipole += numpy.dot(charges, deltas)
+                node.quadrupole += 3*numpy.dot(deltas.transpose()*charges, deltas)
+                node.quadrupole -= numpy.identity(3)*numpy.dot(charges, (deltas**2).sum(axis=1))
+            if self.dipoles is not None:
+                dipoles = self.dipoles[node.indexes]
+                node.dipole += dipoles.sum(axis=0)
+                outer = numpy.dot(deltas.transpose(), dipoles)
+                node.quadrupole += 3*(outer + outer.transpose())
+                node.quadrupole -= numpy.identity(3)*2*(deltas*dipoles).sum()
+
+    def _evaluate(self, points, do_esp, do_efield):
+        """Traverse the tree for all points at once
+
+           Returns a tuple (esp, efield). The elements that are not requested
+           are None.
+        """
+        points = numpy.asarray(points, float)
+        single = (len(points.shape) == 1)
+        if single:
+            points = points.reshape((1, 3))
+        esp = numpy.zeros(len(points), float) if do_esp else None
+        efield = numpy.zeros((len(points), 3), float) if do_efield else None
+        stack = []
+        if self.root is not None:
+            stack.append((self.root, numpy.arange(len(points))))
+        while len(stack) > 0:
+            node, active = stack.pop()
+            deltas = points[active] - node.center
+            distances = numpy.sqrt((deltas**2).sum(axis=1))
+            far = node.radius < self.theta*distances
+            if far.any():
+                self._add_expansion(node, active[far], deltas[far], distances[far], esp, efield)
+            near = active[~far]
+            if len(near) == 0:
+                continue
+            if node.children is None:
+                self._add_direct(node, points, near, esp, efield)
+            else:
+                for child in node.children:
+                    stack.append((child, near))
+        if single:
+            if do_esp:
+                esp = esp[0]
+            if do_efield:
+                efield = efield[0]
+        return esp, efield
+
+    def _add_expansion(self, node, active, deltas, distances, esp, efield):
+        """Add the contributions of the multipole expansion of a node"""
+        d_1 = 1/distances
+        d_3 = d_1**3
+        d_5 = d_1**5
+        qdelta = numpy.dot(deltas, node.quadrupole)
+        pdelta = numpy.dot(deltas, node.dipole)
+        deltaqdelta = (qdelta*deltas).sum(axis=1)
+        if esp is not None:
+            esp[active] += node.charge*d_1 + pdelta*d_3 + 0.5*deltaqdelta*d_5
+        if efield is not None:
+            factors = node.charge*d_3 + 3*pdelta*d_5 + 2.5*deltaqdelta*d_5*d_1**2
+            efield[active] += deltas*factors.reshape((-1, 1))
+            efield[active] -= numpy.outer(d_3, node.dipole) + qdelta*d_5.reshape((-1, 1))
+
+    def _add_direct(self, node, points, active, esp, efield):
+        """Add the contributions of the atoms in a leaf node with a direct sum
+
+           Atoms that coincide with a point are skipped. The points are
+           processed in chunks to limit the memory usage.
+        """
+        rows = max(1, self.chunk_size/len(node.indexes))
+        for begin in xrange(0, len(active), rows):
+            self._add_direct_chunk(node, points, active[begin:begin+rows], esp, efield)
+
+    def _add_direct_chunk(self, node, points, active, esp, efield):
+        """Add the direct sum of a leaf node for a chunk of points"""
+        deltas = points[active].reshape((-1, 1, 3)) - self.coordinates[node.indexes]
+        distances = numpy.sqrt((deltas**2).sum(axis=2))
+        mask = distances > 0
+        d_1 = numpy.zeros(distances.shape, float)
+        d_1[mask] = 1/distances[mask]
+        d_2 = d_1**2
+        d_3 = d_1*d_2
+        if self.charges is not None:
+            charges = self.charges[node.indexes]
+            if esp is not None:
+                esp[active] += numpy.dot(d_1, charges)
+            if efield is not None:
+                efield[active] += (deltas*(d_3*charges).reshape(d_3.shape + (1,))).sum(axis=1)
+        if self.dipoles is not None:
+            dipoles = self.dipoles[node.indexes]
+            pdelta = (deltas*dipoles).sum(axis=2)
+            if esp is not None:
+                esp[active] += (pdelta*d_3).sum(axis=1)
+            if efield is not None:
+                factors = 3*pdelta*d_3*d_2
+                efield[active] += (deltas*factors.reshape(factors.shape + (1,))).sum(axis=1)
+                efield[active] -= numpy.dot(d_3, dipoles)
+
+    def esp(self, points):
+        """Compute the electrostatic potential in a set of points
+
+           Argument:
+            | ``points``  --  A Mx3 array with points or a single point.
+
+           Returns an array with M potentials or a single potential.
+        """
+        return self._evaluate(points, True, False)[0]
+
+    def efield(self, points):
+        """Compute the electric field in a set of points
+
+           Argument:
+            | ``points``  --  A Mx3 array with points or a single point.
+
+           Returns a Mx3 array with field vectors or a single field vector.
+        """
+        return self._evaluate(points, False, True)[1]
+
+    def esp_efield(self, points):
+        """Compute the electrostatic potential and the electric field at once
+
+           Argument:
+            | ``points``  --  A Mx3 array with points or a single point.
+
+           Returns a tuple (esp, efield), see :meth:`esp` and :meth:`efield`.
+        """
+        return self._evaluate(points, True, True)
@@ -20,20 +20,93 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>
 #
 #--
-"""Reference implementations of a few conventional nonbonding force fields
+"""Implementations of a few conventional nonbonding force fields
 
-   The main purpose of this implementation is reliability, not speed. These
-   routines can be used to validate an efficient low level implementation.
+   The energy, gradient and Hessian of the pair potentials are computed with
+   NumPy for chunks of atom pairs at once (see PairFF.chunk_size), which
+   limits the memory usage for large systems. In the dense mode, the pairwise
+   scaling factors are given as an NxN array. In the sparse mode, a
+   CutoffScaling object is given instead and only the pairs within the cutoff
+   are taken into account. These pairs are found with a Verlet neighbor list,
+   which also supports periodic boundary conditions. Periodic electrostatics
+   are computed with Ewald sums in EwaldCoulombFF.
 """
 
+from molmod.binning import NeighborList, PairSearchInter
+from molmod.multipole import MultipoleTree
+from molmod.unit_cells import UnitCell
+
+import math
+
 import numpy as np
 
 
 __all__ = [
-    "PairFF", "CoulombFF", "DispersionFF", "PauliFF", "ExpRepFF",
+    "CutoffScaling", "PairFF", "CompositeFF", "CoulombFF", "EwaldCoulombFF",
+    "DispersionFF", "PauliFF", "ExpRepFF", "TabulatedFF",
 ]
 
 
+class CutoffScaling(object):
+    """Sparse scaling factors for a pair potential with a cutoff
+
+       An instance of this class can be used instead of the dense scaling
+       matrix of a :class:`PairFF` object. Only the atom pairs within the
+       cutoff are then taken into account. These pairs are found with a
+       :class:`molmod.binning.NeighborList` and no arrays with a size
+       proportional to N**2 are allocated.
+
+       Note that the arguments of some force fields, e.g. the strengths of the
+       DispersionFF, are still dense matrices.
+    """
+
+    def __init__(self, cutoff, factors=None, unit_cell=None, skin=0.0):
+        """
+           Arguments:
+             cutoff  --  the largest distance between two interacting atoms
+
+           Optional arguments:
+             factors  --  a dictionary with the scaling factors of the atom
+                          pairs that are not simply scaled by one. The keys
+                          are tuples (i, j) or frozensets with two atom
+                          indexes. A scaling factor zero excludes a pair.
+             unit_cell  --  the periodic boundary conditions, the minimum
+                            image convention is applied
+             skin  --  the skin of the neighbor list, see
+                       :class:`molmod.binning.NeighborList`
+        """
+        self.cutoff = cutoff
+        self.unit_cell = unit_cell
+        self.skin = skin
+        if factors is None:
+            factors = {}
+        pairs = np.array([sorted(pair) for pair in factors], int).reshape((-1, 2))
+        self._first = pairs[:,0]
+        self._second = pairs[:,1]
+        self._factors = np.array(factors.values(), float)
+
+    def get_factors(self, index1, index2):
+        """Return the scaling factors for arrays of atom pairs"""
+        result = np.ones(len(index1), float)
+        if len(self._factors) > 0 and len(index1) > 0:
+            first = np.minimum(index1, index2)
+            second = np.maximum(index1, index2)
+            size = max(second.max(), self._second.max()) + 1
+            keys = self._first*size + self._second
+            order = keys.argsort()
+            keys = keys[order]
+            # look up the pairs among the keys of the exceptions
+            queries = first*size + second
+            positions = keys.searchsorted(queries).clip(0, len(keys)-1)
+            found = keys[positions] == queries
+            result[found] = self._factors[order[positions[found]]]
+        return result
+
+    def create_neighbor_list(self):
+        """Return a neighbor list for the pairs within the cutoff"""
+        return NeighborList(self.cutoff, self.skin, self.unit_cell)
+
+
 class PairFF(object):
     """Evaluates the energy, gradient and Hessian of pairwise potential
 
@@ -42,24 +115,49 @@ class PairFF(object):
        In the derived classes one must provide functions that iterate over all
        the corresponding function values, derivatives and second derivatives of
        s and v for a given r_ij.
+
+       The energy, gradient and Hessian are computed for many atom pairs at
+       once. Derived classes should therefore also implement the methods
+       yield_pair_energy_arrays, yield_pair_gradient_arrays and
+       yield_pair_hessian_arrays, which do the same as the methods for a single
+       pair, but for arrays of atom pairs. The default implementations of these
+       methods fall back to the methods for a single pair, which is slow.
     """
 
+    # the number of atom pairs that are processed at once
+    chunk_size = 10000
+    # the names of the attributes with atomic (N) or pairwise (NxN) parameters
+    pair_parameters = ()
+
     def __init__(self, scaling, coordinates=None):
         """Initialize a pair potential object
 
            Arguments:
              scaling  --  symmetric NxN array with pairwise scaling factors.
                           When an element is set to zero, it will be excluded.
+                          Alternatively, this is a CutoffScaling object. In
+                          that case, only the pairs within the cutoff are
+                          considered. (sparse mode)
 
            Optional argument:
              coordinates  --  the initial Cartesian coordinates of the system,
                               which can be updated with the update_coordinates
                               method
+
+           In sparse mode, the attributes deltas, distances, directions and
+           dirouters are not available. Instead, the pairs are stored in
+           the attributes pair_index1, pair_index2, pair_deltas,
+           pair_distances and pair_scaling. Only the methods for arrays of
+           atom pairs are used in sparse mode.
         """
+        self.scaling = scaling
+        self.sparse = isinstance(scaling, CutoffScaling)
+        if self.sparse:
+            self.neighbor_list = scaling.create_neighbor_list()
+        else:
+            self.scaling.ravel()[::len(self.scaling)+1] = 0
         if coordinates is not None:
             self.update_coordinates(coordinates)
-        self.scaling = scaling
-        self.scaling.ravel()[::len(self.scaling)+1] = 0
 
     def update_coordinates(self, coordinates=None):
         """Update the coordinates (and derived quantities)
@@ -70,20 +168,33 @@ class PairFF(object):
         if coordinates is not None:
             self.coordinates = coordinates
         self.numc = len(self.coordinates)
-        self.distances = np.zeros((self.numc, self.numc), float)
-        self.deltas = np.zeros((self.numc, self.numc, 3), float)
-        self.directions = np.zeros((self.numc, self.numc, 3), float)
-        self.dirouters = np.zeros((self.numc, self.numc, 3, 3), float)
-        for index1, coordinate1 in enumerate(self.coordinates):
-            for index2, coordinate2 in enumerate(self.coordinates):
-                delta = coordinate1 - coordinate2
-                self.deltas[index1, index2] = delta
-                distance = np.linalg.norm(delta)
-                self.distances[index1, index2] = distance
-                if index1 != index2:
-                    tmp = delta/distance
-                    self.directions[index1, index2] = tmp
-                    self.dirouters[index1, index2] = np.outer(tmp, tmp)
+        if self.sparse:
+            self.neighbor_list.update(self.coordinates)
+            index1, index2, deltas, distances = self.neighbor_list.as_arrays()
+            scaling = self.scaling.get_factors(index1, index2)
+            mask = scaling > 0
+            self.pair_index1 = index1[mask]
+            self.pair_index2 = index2[mask]
+            # the relative vectors point from the second to the first atom
+            self.pair_deltas = -deltas[mask]
+            self.pair_distances = distances[mask]
+            self.pair_scaling = scaling[mask]
+        else:
+            self.deltas = self.coordinates.reshape((-1, 1, 3)) - self.coordinates
+            self.distances = np.sqrt((self.deltas**2).sum(axis=2))
+            # avoid a division by zero on the diagonal
+            safe_distances = self.distances.copy()
+            safe_distances.ravel()[::self.numc+1] = 1
+            self.directions = self.deltas/safe_distances.reshape((self.numc, self.numc, 1))
+            self._dirouters = None
+
+    def _get_dirouters(self):
+        """The outer products of the directions, only computed when needed"""
+        if self._dirouters is None:
+            self._dirouters = self.directions.reshape((self.numc, self.numc, 3, 1))*self.directions.reshape((self.numc, self.numc, 1, 3))
+        return self._dirouters
+
+    dirouters = property(_get_dirouters)
 
     def yield_pair_energies(self, index1, index2):
         """Yields pairs ((s(r_ij), v(bar{r}_ij))"""
@@ -97,75 +208,266 @@ class PairFF(object):
         """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij))"""
         raise NotImplementedError
 
+    def _yield_stacked(self, method, index1, index2):
+        """Stack the terms of a single-pair method for arrays of atom pairs"""
+        if len(index1) == 0:
+            return
+        all_terms = [list(method(i1, i2)) for i1, i2 in zip(index1, index2)]
+        for k in xrange(len(all_terms[0])):
+            yield (
+                np.array([terms[k][0] for terms in all_terms], float),
+                np.array([terms[k][1] for terms in all_terms], float),
+            )
+
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of atom pairs
+
+           Arguments:
+             index1  --  array with the first atom of each pair (M elements)
+             index2  --  array with the second atom of each pair
+             deltas  --  the relative vectors, coordinates[index1] -
+                         coordinates[index2] (Mx3 array)
+             distances  --  the norms of the relative vectors
+
+           The first element of each yielded pair is an array with M values,
+           the second element is an array with M values or a scalar.
+        """
+        return self._yield_stacked(self.yield_pair_energies, index1, index2)
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of atom pairs
+
+           See :meth:`yield_pair_energy_arrays`. The second element of each
+           yielded pair is an Mx3 array or a scalar.
+        """
+        return self._yield_stacked(self.yield_pair_gradients, index1, index2)
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of atom pairs
+
+           See :meth:`yield_pair_energy_arrays`. The second element of each
+           yielded pair is an Mx3x3 array or a scalar.
+        """
+        return self._yield_stacked(self.yield_pair_hessians, index1, index2)
+
+    def _iter_pairs(self, index1=None):
+        """Iterate over chunks of atom pairs with a non-zero scaling factor
+
+           Optional argument:
+             index1  --  when given, only the pairs (index1, j) are included,
+                         for all other atoms j. Otherwise all pairs (i, j)
+                         with i > j are included.
+
+           Yields tuples (index1, index2, deltas, distances, scaling) with
+           arrays for each chunk of atom pairs.
+        """
+        if self.sparse:
+            for chunk in self._iter_sparse_pairs(index1):
+                yield chunk
+            return
+        if index1 is None:
+            index1, index2 = np.tril(self.scaling > 0, -1).nonzero()
+        else:
+            index2 = (self.scaling[index1] > 0).nonzero()[0]
+            index1 = np.zeros(len(index2), int) + index1
+        for begin in xrange(0, len(index1), self.chunk_size):
+            end = begin + self.chunk_size
+            i1 = index1[begin:end]
+            i2 = index2[begin:end]
+            yield i1, i2, self.deltas[i1, i2], self.distances[i1, i2], self.scaling[i1, i2]
+
+    def _iter_sparse_pairs(self, index1=None):
+        """Iterate over chunks of atom pairs in sparse mode, see _iter_pairs"""
+        if index1 is None:
+            pairs = (
+                self.pair_index1, self.pair_index2, self.pair_deltas,
+                self.pair_distances, self.pair_scaling
+            )
+        else:
+            # put atom index1 first in all pairs
+            mask1 = self.pair_index1 == index1
+            mask2 = self.pair_index2 == index1
+            index2 = np.concatenate([self.pair_index2[mask1], self.pair_index1[mask2]])
+            pairs = (
+                np.zeros(len(index2), int) + index1, index2,
+                np.concatenate([self.pair_deltas[mask1], -self.pair_deltas[mask2]]),
+                np.concatenate([self.pair_distances[mask1], self.pair_distances[mask2]]),
+                np.concatenate([self.pair_scaling[mask1], self.pair_scaling[mask2]]),
+            )
+        for begin in xrange(0, len(pairs[0]), self.chunk_size):
+            end = begin + self.chunk_size
+            yield tuple(array[begin:end] for array in pairs)
+
+    def _compute_pair_terms(self, index1, index2, deltas, distances, scaling, order):
+        """Compute the energy and its derivatives for arrays of atom pairs
+
+           Arguments:
+             index1, index2, deltas, distances  --  see
+                  :meth:`yield_pair_energy_arrays`
+             scaling  --  the scaling factors of the pairs
+             order  --  0 (energy), 1 (energy and gradient) or 2 (energy,
+                        gradient and Hessian)
+
+           Returns: a list with the energy of each pair and, depending on the
+           order, the gradient (Mx3) and Hessian (Mx3x3) of each pair energy
+           towards the coordinates of the first atom.
+        """
+        directions, dirouters = self._get_pair_geometry(deltas, distances, order)
+        result = self._sum_pair_terms(index1, index2, deltas, distances, directions, dirouters, order)
+        result[0] *= scaling
+        if order >= 1:
+            result[1] *= scaling.reshape((-1, 1))
+        if order >= 2:
+            result[2] *= scaling.reshape((-1, 1, 1))
+        return result
+
+    def _get_pair_geometry(self, deltas, distances, order):
+        """Return the directions and their outer products for arrays of pairs
+
+           The outer products are only computed for order 2 and the directions
+           only for order 1 or higher. Otherwise, None is returned.
+        """
+        directions = None
+        dirouters = None
+        if order >= 1:
+            directions = deltas/distances.reshape((-1, 1))
+        if order >= 2:
+            dirouters = directions.reshape((-1, 3, 1))*directions.reshape((-1, 1, 3))
+        return directions, dirouters
+
+    def _sum_pair_terms(self, index1, index2, deltas, distances, directions, dirouters, order):
+        """Sum the terms of the pair energies without the scaling factors
+
+           See :meth:`_compute_pair_terms` and :meth:`_get_pair_geometry`.
+        """
+        size = len(distances)
+        energies = np.zeros(size, float)
+        iterators = [self.yield_pair_energy_arrays(index1, index2, deltas, distances)]
+        if order >= 1:
+            gradients = np.zeros((size, 3), float)
+            iterators.append(self.yield_pair_gradient_arrays(index1, index2, deltas, distances))
+        if order >= 2:
+            hessians = np.zeros((size, 3, 3), float)
+            iterators.append(self.yield_pair_hessian_arrays(index1, index2, deltas, distances))
+        for terms in zip(*iterators):
+            se, ve = terms[0]
+            se = np.asarray(se, float)
+            ve = np.asarray(ve, float)
+            energies += se*ve
+            if order >= 1:
+                sg, vg = terms[1]
+                sg = np.asarray(sg, float).reshape((-1, 1))
+                vg = np.asarray(vg, float)
+                gradients += sg*directions*ve.reshape((-1, 1)) + se.reshape((-1, 1))*vg
+            if order >= 2:
+                sh, vh = terms[2]
+                sh = np.asarray(sh, float).reshape((-1, 1, 1))
+                vh = np.asarray(vh, float)
+                sg = sg.reshape((-1, 1, 1))
+                vg = np.zeros((size, 3), float) + vg
+                hessians += (
+                    +sh*dirouters*ve.reshape((-1, 1, 1))
+                    +sg*(np.identity(3, float) - dirouters)*(ve/distances).reshape((-1, 1, 1))
+                    +sg*directions.reshape((-1, 3, 1))*vg.reshape((-1, 1, 3))
+                    +sg*vg.reshape((-1, 3, 1))*directions.reshape((-1, 1, 3))
+                    +se.reshape((-1, 1, 1))*vh
+                )
+        result = [energies]
+        if order >= 1:
+            result.append(gradients)
+        if order >= 2:
+            result.append(hessians)
+        return result
+
     def energy(self):
         """Compute the energy of the system"""
         result = 0.0
-        for index1 in xrange(self.numc):
-            for index2 in xrange(index1):
-                if self.scaling[index1, index2] > 0:
-                    for se, ve in self.yield_pair_energies(index1, index2):
-                        result += se*ve*self.scaling[index1, index2]
+        for index1, index2, deltas, distances, scaling in self._iter_pairs():
+            result += self._compute_pair_terms(index1, index2, deltas, distances, scaling, 0)[0].sum()
         return result
 
     def gradient_component(self, index1):
         """Compute the gradient of the energy for one atom"""
         result = np.zeros(3, float)
-        for index2 in xrange(self.numc):
-            if self.scaling[index1, index2] > 0:
-                for (se, ve), (sg, vg) in zip(self.yield_pair_energies(index1, index2), self.yield_pair_gradients(index1, index2)):
-                    result += (sg*self.directions[index1, index2]*ve + se*vg)*self.scaling[index1, index2]
+        for i1, i2, deltas, distances, scaling in self._iter_pairs(index1):
+            result += self._compute_pair_terms(i1, i2, deltas, distances, scaling, 1)[1].sum(axis=0)
         return result
 
     def gradient(self):
         """Compute the gradient of the energy for all atoms"""
         result = np.zeros((self.numc, 3), float)
-        for index1 in xrange(self.numc):
-            result[index1] = self.gradient_component(index1)
+        for index1, index2, deltas, distances, scaling in self._iter_pairs():
+            gradients = self._compute_pair_terms(index1, index2, deltas, distances, scaling, 1)[1]
+            for i in xrange(3):
+                result[:,i] += np.bincount(index1, gradients[:,i], self.numc)
+                result[:,i] -= np.bincount(index2, gradients[:,i], self.numc)
         return result
 
     def hessian_component(self, index1, index2):
         """Compute the hessian of the energy for one atom pair"""
         result = np.zeros((3, 3), float)
         if index1 == index2:
-            for index3 in xrange(self.numc):
-                if self.scaling[index1, index3] > 0:
-                    d_1 = 1/self.distances[index1, index3]
-                    for (se, ve), (sg, vg), (sh, vh) in zip(
-                        self.yield_pair_energies(index1, index3),
-                        self.yield_pair_gradients(index1, index3),
-                        self.yield_pair_hessians(index1, index3)
-                    ):
-                        result += (
-                            +sh*self.dirouters[index1, index3]*ve
-                            +sg*(np.identity(3, float) - self.dirouters[index1, index3])*ve*d_1
-                            +sg*np.outer(self.directions[index1, index3],  vg)
-                            +sg*np.outer(vg, self.directions[index1, index3])
-                            +se*vh
-                        )*self.scaling[index1, index3]
+            for i1, i3, deltas, distances, scaling in self._iter_pairs(index1):
+                result += self._compute_pair_terms(i1, i3, deltas, distances, scaling, 2)[2].sum(axis=0)
+        elif self.sparse:
+            for i1, i2, deltas, distances, scaling in self._iter_pairs(index1):
+                mask = i2 == index2
+                if mask.any():
+                    result -= self._compute_pair_terms(
+                        i1[mask], i2[mask], deltas[mask], distances[mask],
+                        scaling[mask], 2
+                    )[2].sum(axis=0)
         elif self.scaling[index1, index2] > 0:
-            d_1 = 1/self.distances[index1, index2]
-            for (se, ve), (sg, vg), (sh, vh) in zip(
-                self.yield_pair_energies(index1, index2),
-                self.yield_pair_gradients(index1, index2),
-                self.yield_pair_hessians(index1, index2)
-            ):
-                result -= (
-                    +sh*self.dirouters[index1, index2]*ve
-                    +sg*(np.identity(3, float) - self.dirouters[index1, index2])*ve*d_1
-                    +sg*np.outer(self.directions[index1, index2],  vg)
-                    +sg*np.outer(vg, self.directions[index1, index2])
-                    +se*vh
-                )*self.scaling[index1, index2]
+            index1 = np.array([index1])
+            index2 = np.array([index2])
+            result -= self._compute_pair_terms(
+                index1, index2, self.deltas[index1, index2],
+                self.distances[index1, index2], self.scaling[index1, index2], 2
+            )[2][0]
         return result
 
     def hessian(self):
         """Compute the hessian of the energy"""
         result = np.zeros((self.numc, 3, self.numc, 3), float)
-        for index1 in xrange(self.numc):
-            for index2 in xrange(self.numc):
-                result[index1, :, index2, :] = self.hessian_component(index1, index2)
+        diagonal = np.zeros((self.numc, 3, 3), float)
+        for index1, index2, deltas, distances, scaling in self._iter_pairs():
+            hessians = self._compute_pair_terms(index1, index2, deltas, distances, scaling, 2)[2]
+            for i in xrange(3):
+                for j in xrange(3):
+                    diagonal[:,i,j] += np.bincount(index1, hessians[:,i,j], self.numc)
+                    diagonal[:,i,j] += np.bincount(index2, hessians[:,i,j], self.numc)
+            result[index1,:,index2,:] -= hessians
+            result[index2,:,index1,:] -= hessians.transpose((0, 2, 1))
+        indexes = np.arange(self.numc)
+        result[indexes,:,indexes,:] += diagonal
         return result
 
+    def hessian_dot(self, vector):
+        """Compute the product of the hessian with a vector
+
+           Argument:
+             vector  --  a Nx3 array or a flat 3N array
+
+           Returns an array with the same shape as the argument. The product is
+           computed pair by pair without forming the hessian, such that the
+           memory usage is proportional to the number of pairs in a chunk.
+        """
+        vector = np.asarray(vector, float)
+        v = vector.reshape((self.numc, 3))
+        result = np.zeros((self.numc, 3), float)
+        for index1, index2, deltas, distances, scaling in self._iter_pairs():
+            hessians = self._compute_pair_terms(index1, index2, deltas, distances, scaling, 2)[2]
+            v1 = v[index1].reshape((-1, 1, 3))
+            v2 = v[index2].reshape((-1, 1, 3))
+            # rows of the blocks (index1, index1) and (index1, index2)
+            products1 = (hessians*(v1 - v2)).sum(axis=2)
+            # rows of the blocks (index2, index2) and (index2, index1)
+            products2 = (hessians*v2).sum(axis=2) - (hessians*v1.transpose((0, 2, 1))).sum(axis=1)
+            for i in xrange(3):
+                result[:,i] += np.bincount(index1, products1[:,i], self.numc)
+                result[:,i] += np.bincount(index2, products2[:,i], self.numc)
+        return result.reshape(vector.shape)
+
     def gradient_flat(self):
         """Return the gradient a 3N array"""
         return self.gradient().ravel()
@@ -175,9 +477,149 @@ class PairFF(object):
         return self.hessian().reshape((self.numc*3, self.numc*3))
 
 
+def _same_unit_cell(unit_cell1, unit_cell2):
+    """Test if two unit cells (or None) describe the same periodic system"""
+    if unit_cell1 is None or unit_cell2 is None:
+        return unit_cell1 is unit_cell2
+    return (
+        (unit_cell1.matrix == unit_cell2.matrix).all() and
+        (unit_cell1.active == unit_cell2.active).all()
+    )
+
+
+class CompositeFF(PairFF):
+    """The sum of several pair potentials evaluated in one pass
+
+       The relative vectors and distances of the atom pairs are computed only
+       once for all terms. Each term keeps its own parameters and scaling
+       factors. Example::
+
+           ff = CompositeFF([
+               CoulombFF(scaling_coulomb, charges),
+               DispersionFF(scaling_disp, strengths),
+           ], coordinates)
+           print ff.energy()
+
+       The terms must be created without coordinates. Either all terms use a
+       dense scaling matrix or all terms use a CutoffScaling object. In the
+       latter case, a single neighbor list is used with the largest cutoff
+       of the terms.
+    """
+
+    def __init__(self, terms, coordinates=None):
+        """Initialize a CompositeFF object
+
+           Arguments:
+             terms  --  a list of PairFF objects
+
+           Optional argument:
+             coordinates  --  the initial Cartesian coordinates of the system,
+                              which can be updated with the update_coordinates
+                              method
+        """
+        if len(terms) == 0:
+            raise ValueError("At least one term is required.")
+        sparse = [term.sparse for term in terms]
+        if all(sparse):
+            unit_cell = terms[0].scaling.unit_cell
+            for term in terms[1:]:
+                if not _same_unit_cell(term.scaling.unit_cell, unit_cell):
+                    raise ValueError("All terms must have the same unit cell.")
+            scaling = CutoffScaling(
+                max(term.scaling.cutoff for term in terms), None, unit_cell,
+                max(term.scaling.skin for term in terms)
+            )
+        elif not any(sparse):
+            # the pairs that are included in at least one term
+            scaling = np.zeros(terms[0].scaling.shape, float)
+            for term in terms:
+                scaling[term.scaling > 0] = 1.0
+        else:
+            raise ValueError("The terms can not mix dense and sparse scaling.")
+        self.terms = terms
+        PairFF.__init__(self, scaling, coordinates)
+
+    def update_coordinates(self, coordinates=None):
+        """Update the coordinates (and derived quantities)
+
+           Argument:
+             coordinates  --  new Cartesian coordinates of the system
+
+           In dense mode, the arrays with the relative vectors, distances
+           and directions are shared with all terms.
+        """
+        PairFF.update_coordinates(self, coordinates)
+        if not self.sparse:
+            for term in self.terms:
+                term.coordinates = self.coordinates
+                term.numc = self.numc
+                term.deltas = self.deltas
+                term.distances = self.distances
+                term.directions = self.directions
+                term._dirouters = None
+
+    def _get_term_scaling(self, term, index1, index2, distances):
+        """Return the scaling factors of one term for arrays of pairs"""
+        if self.sparse:
+            result = term.scaling.get_factors(index1, index2)
+            result[distances > term.scaling.cutoff] = 0.0
+            return result
+        else:
+            return term.scaling[index1, index2]
+
+    def _compute_pair_terms(self, index1, index2, deltas, distances, scaling, order):
+        """Compute the energy and its derivatives for arrays of atom pairs
+
+           The scaling argument is ignored. The scaling factors of each term are
+           used instead. See :meth:`PairFF._compute_pair_terms`.
+        """
+        directions, dirouters = self._get_pair_geometry(deltas, distances, order)
+        result = None
+        for term in self.terms:
+            term_scaling = self._get_term_scaling(term, index1, index2, distances)
+            mask = term_scaling > 0
+            if not mask.any():
+                continue
+            if not mask.all():
+                # only evaluate the pairs that are included in this term
+                partial = term._sum_pair_terms(
+                    index1[mask], index2[mask], deltas[mask], distances[mask],
+                    None if directions is None else directions[mask],
+                    None if dirouters is None else dirouters[mask], order
+                )
+                contribution = []
+                for array in partial:
+                    full = np.zeros((len(distances),) + array.shape[1:], float)
+                    full[mask] = array
+                    contribution.append(full)
+            else:
+                contribution = term._sum_pair_terms(
+                    index1, index2, deltas, distances, directions, dirouters, order
+                )
+            contribution[0] *= term_scaling
+            if order >= 1:
+                contribution[1] *= term_scaling.reshape((-1, 1))
+            if order >= 2:
+                contribution[2] *= term_scaling.reshape((-1, 1, 1))
+            if result is None:
+                result = contribution
+            else:
+                for total, array in zip(result, contribution):
+                    total += array
+        if result is None:
+            result = [np.zeros(len(distances), float)]
+            if order >= 1:
+                result.append(np.zeros((len(distances), 3), float))
+            if order >= 2:
+                result.append(np.zeros((len(distances), 3, 3), float))
+        return result
+
+
 class CoulombFF(PairFF):
     """Computes the electrostatic interactions using charges and point dipoles"""
 
+    pair_parameters = ("charges",)
+
     def __init__(self, scaling, charges=None, dipoles=None, coordinates=None):
         """Initialize a CoulombFF object
 
@@ -253,6 +695,69 @@ class CoulombFF(PairFF):
                 yield 12*c1*d_5, np.zeros((3, 3))
                 yield 12*c2*d_5, np.zeros((3, 3))
 
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of atom pairs"""
+        d_1 = 1/distances
+        if self.charges is not None:
+            c1 = self.charges[index1]
+            c2 = self.charges[index2]
+            yield c1*c2*d_1, 1
+        if self.dipoles is not None:
+            d_3 = d_1**3
+            d_5 = d_1**5
+            p1 = self.dipoles[index1]
+            p2 = self.dipoles[index2]
+            p1p2 = (p1*p2).sum(axis=1)
+            p1delta = (p1*deltas).sum(axis=1)
+            p2delta = (p2*deltas).sum(axis=1)
+            yield d_3*p1p2, 1
+            yield -3*d_5, p1delta*p2delta
+            if self.charges is not None:
+                yield c1*d_3, p2delta
+                yield c2*d_3, -p1delta
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        d_2 = 1/distances**2
+        if self.charges is not None:
+            c1 = self.charges[index1]
+            c2 = self.charges[index2]
+            yield -c1*c2*d_2, 0
+        if self.dipoles is not None:
+            d_4 = d_2**2
+            d_6 = d_2**3
+            p1 = self.dipoles[index1]
+            p2 = self.dipoles[index2]
+            p1p2 = (p1*p2).sum(axis=1)
+            p1delta = (p1*deltas).sum(axis=1)
+            p2delta = (p2*deltas).sum(axis=1)
+            yield -3*d_4*p1p2, 0
+            yield 15*d_6, p1*p2delta.reshape((-1, 1)) + p2*p1delta.reshape((-1, 1))
+            if self.charges is not None:
+                yield -3*c1*d_4, p2
+                yield -3*c2*d_4, -p1
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        d_1 = 1/distances
+        d_3 = d_1**3
+        if self.charges is not None:
+            c1 = self.charges[index1]
+            c2 = self.charges[index2]
+            yield 2*c1*c2*d_3, 0
+        if self.dipoles is not None:
+            d_5 = d_1**5
+            d_7 = d_1**7
+            p1 = self.dipoles[index1]
+            p2 = self.dipoles[index2]
+            p1p2 = (p1*p2).sum(axis=1)
+            outer = p1.reshape((-1, 3, 1))*p2.reshape((-1, 1, 3))
+            yield 12*d_5*p1p2, 0
+            yield -90*d_7, outer + outer.transpose((0, 2, 1))
+            if self.charges is not None:
+                yield 12*c1*d_5, 0
+                yield 12*c2*d_5, 0
+
     def esp_point(self, point):
         result = 0.0
         for index2 in xrange(self.numc):
@@ -267,13 +772,12 @@ class CoulombFF(PairFF):
 
     def esp_component(self, index1):
         result = 0.0
-        for index2 in xrange(self.numc):
-            if self.scaling[index1, index2] > 0:
-                d = self.distances[index1, index2]
-                if self.charges is not None:
-                    result += self.charges[index2]/d
-                if self.dipoles is not None:
-                    result += np.dot(self.dipoles[index2], self.directions[index1, index2])/d**2
+        for i1, i2, deltas, distances, scaling in self._iter_pairs(index1):
+            d_1 = 1/distances
+            if self.charges is not None:
+                result += (self.charges[i2]*d_1).sum()
+            if self.dipoles is not None:
+                result += ((self.dipoles[i2]*deltas).sum(axis=1)*d_1**3).sum()
         return result
 
     def esp(self):
@@ -297,16 +801,16 @@ class CoulombFF(PairFF):
         return result
 
     def efield_component(self, index1):
-        result = 0.0
-        for index2 in xrange(self.numc):
-            if self.scaling[index1, index2] > 0:
-                d = self.distances[index1, index2]
-                direction = self.directions[index1, index2]
-                if self.charges is not None:
-                    result += self.charges[index2]*direction/d**2
-                if self.dipoles is not None:
-                    p = self.dipoles[index2]
-                    result += (3*np.dot(p, direction)*direction - p)/d**3
+        result = np.zeros(3, float)
+        for i1, i2, deltas, distances, scaling in self._iter_pairs(index1):
+            d_3 = distances**(-3)
+            if self.charges is not None:
+                result += ((self.charges[i2]*d_3).reshape((-1, 1))*deltas).sum(axis=0)
+            if self.dipoles is not None:
+                p = self.dipoles[i2]
+                pdelta = (p*deltas).sum(axis=1)
+                d_5 = d_3/distances**2
+                result += ((3*pdelta*d_5).reshape((-1, 1))*deltas - p*d_3.reshape((-1, 1))).sum(axis=0)
         return result
 
     def efield(self):
@@ -316,11 +820,346 @@ class CoulombFF(PairFF):
             result[index1] = self.efield_component(index1)
         return result
 
+    def _get_grid_points(self, points, origin, axes, nrep):
+        """Return the grid points from one of the two specifications"""
+        if points is None:
+            if origin is None or axes is None or nrep is None:
+                raise TypeError("Either points or origin, axes and nrep must be given.")
+            from molmod.io.cube import get_cube_points
+            return get_cube_points(origin, axes, nrep)
+        elif origin is not None or axes is not None or nrep is not None:
+            raise TypeError("The arguments origin, axes and nrep can not be combined with points.")
+        points = np.asarray(points, float)
+        if len(points.shape) == 0 or points.shape[-1] != 3:
+            raise TypeError("The last dimension of the points array must be three.")
+        return points
+
+    def _evaluate_grid(self, points, origin, axes, nrep, theta, do_esp, do_efield):
+        """Evaluate the ESP and/or the field on a grid, see esp_grid"""
+        points = self._get_grid_points(points, origin, axes, nrep)
+        if theta == 0:
+            # a tree with a single leaf is a chunked direct sum
+            tree = self.get_multipole_tree(0.0, max(1, self.numc))
+        else:
+            tree = self.get_multipole_tree(theta)
+        tree.chunk_size = self.chunk_size
+        esp, efield = tree._evaluate(points.reshape((-1, 3)), do_esp, do_efield)
+        if do_esp:
+            esp = esp.reshape(points.shape[:-1])
+        if do_efield:
+            efield = efield.reshape(points.shape)
+        return esp, efield
+
+    def esp_grid(self, points=None, origin=None, axes=None, nrep=None, theta=0.0):
+        """Compute the electrostatic potential in a set of grid points
+
+           Optional arguments:
+             points  --  an array with points, the last dimension must be 3
+             origin, axes, nrep  --  the specification of a regular grid, as in
+                                     molmod.io.cube.get_cube_points. These
+                                     can not be used together with points.
+             theta  --  the opening angle of the tree code. The default (zero)
+                        is an exact direct sum.
+
+           Returns an array with the potentials with the same shape as the
+           points array, without the last dimension. The scaling factors are
+           not used and atoms that coincide with a point are skipped.
+        """
+        return self._evaluate_grid(points, origin, axes, nrep, theta, True, False)[0]
+
+    def efield_grid(self, points=None, origin=None, axes=None, nrep=None, theta=0.0):
+        """Compute the electric field in a set of grid points
+
+           The arguments are the same as for esp_grid. Returns an array with
+           field vectors with the same shape as the points array.
+        """
+        return self._evaluate_grid(points, origin, axes, nrep, theta, False, True)[1]
+
+    def esp_cube(self, molecule, origin, axes, nrep, theta=0.0, subtitle=''):
+        """Compute the electrostatic potential on the grid of a cube file
+
+           Arguments:
+             molecule  --  the Molecule in the header of the cube file
+             origin, axes, nrep  --  the specification of the grid, see
+                                     molmod.io.cube.get_cube_points
+
+           Optional arguments:
+             theta  --  the opening angle of the tree code, see esp_grid
+             subtitle  --  the second title line in the cube file
+
+           Returns a molmod.io.cube.Cube object.
+        """
+        from molmod.io.cube import Cube
+        data = self.esp_grid(origin=origin, axes=axes, nrep=nrep, theta=theta)
+        return Cube(molecule, origin, axes, nrep, data, subtitle)
+
+    def get_multipole_tree(self, theta=0.5, leaf_size=32):
+        """Return a MultipoleTree for fast evaluation of the ESP and the field
+
+           Optional arguments:
+             theta  --  the opening angle of the tree code
+             leaf_size  --  the maximum number of atoms in a leaf node
+
+           The tree is useful to evaluate the potential or the field in many
+           points, e.g. on a molecular surface. The scaling factors are not
+           taken into account. See :class:`molmod.multipole.MultipoleTree`.
+        """
+        return MultipoleTree(self.coordinates, self.charges, self.dipoles, theta, leaf_size)
+
+
+
+# The complementary error function for numpy arrays. For z >= 0, it is written
+# as erfc(z) = t*exp(-z**2 + P(t)) with t = 2/(2 + z), where P is a Chebyshev
+# series that is fitted to math.erfc when the module is imported. The relative
+# error is about 1e-13 for 0 <= z <= 26. Beyond this range, erfc(z) underflows.
+_erfc_zmax = 26.0
+_erfc_tmin = 2/(2 + _erfc_zmax)
+
+
+def _get_erfc_coefficients(degree=30):
+    """Fit the Chebyshev series in the rational approximation of erfc"""
+    nodes = np.cos(np.pi*(np.arange(degree + 1) + 0.5)/(degree + 1))
+    ts = 0.5*(nodes*(1 - _erfc_tmin) + 1 + _erfc_tmin)
+    values = []
+    for t in ts:
+        z = 2/t - 2
+        values.append(math.log(math.erfc(z)/t) + z*z)
+    return np.polynomial.chebyshev.chebfit(nodes, values, degree)
+
+_erfc_coefficients = _get_erfc_coefficients()
+
+
+def _erfc(x):
+    """The complementary error function of an array"""
+    x = np.asarray(x, float)
+    z = np.minimum(abs(x), _erfc_zmax)
+    t = 2/(2 + z)
+    reduced = (2*t - 1 - _erfc_tmin)/(1 - _erfc_tmin)
+    result = t*np.exp(-z*z + np.polynomial.chebyshev.chebval(reduced, _erfc_coefficients))
+    result = np.where(abs(x) >= _erfc_zmax, 0.0, result)
+    return np.where(x < 0, 2 - result, result)
+
+
+class EwaldCoulombFF(object):
+    """Computes the electrostatic interactions of point charges with Ewald sums
+
+       The system must be periodic in three dimensions. The energy consists of
+       a real-space part, a reciprocal-space part and a self-energy
+       correction. When the system is not neutral, the energy of a uniform
+       neutralizing background is included.
+
+       The parameters alpha, rcut and kcut are chosen automatically for a
+       given accuracy when they are not given. The real-space sum includes all
+       periodic images within rcut, so rcut may be larger than half of the
+       unit cell. The pairs within rcut are searched with a binned pair search
+       when the coordinates are updated.
+    """
+
+    # the number of atom pairs (or k-vectors times atoms) processed at once
+    chunk_size = 100000
+
+    def __init__(self, charges, unit_cell, coordinates=None, accuracy=1e-8, alpha=None, rcut=None, kcut=None):
+        """Initialize an EwaldCoulombFF object
+
+           Arguments:
+             charges  --  the atomic partial charges
+             unit_cell  --  the periodic boundary conditions, all three cell
+                            vectors must be active
+
+           Optional arguments:
+             coordinates  --  the initial Cartesian coordinates of the system,
+                              which can be updated with the update_coordinates
+                              method
+             accuracy  --  the relative accuracy of the real-space and
+                           reciprocal-space sums, used to choose the
+                           parameters that are not given
+             alpha  --  the width parameter of the Gaussian charge
+                        distributions. The default balances the costs of the
+                        real-space and reciprocal-space sums.
+             rcut  --  the cutoff of the real-space sum
+             kcut  --  the cutoff of the reciprocal-space sum (the norm of
+                       the wavevectors)
+        """
+        if not unit_cell.active.all():
+            raise ValueError("The Ewald summation requires a three-dimensional periodic system.")
+        self.charges = charges
+        self.unit_cell = unit_cell
+        s = math.sqrt(-math.log(accuracy))
+        if alpha is None:
+            if rcut is None:
+                alpha = math.sqrt(math.pi)*(len(charges)/unit_cell.volume**2)**(1.0/6.0)
+            else:
+                alpha = s/rcut
+        if rcut is None:
+            rcut = s/alpha
+        if kcut is None:
+            kcut = 2*alpha*s
+        self.alpha = alpha
+        self.rcut = rcut
+        self.kcut = kcut
+        self._setup_images()
+        self._setup_kvectors()
+        if coordinates is not None:
+            self.update_coordinates(coordinates)
+
+    def _setup_images(self):
+        """Find the translations of the periodic images in the real-space sum"""
+        indexes = self.unit_cell.get_radius_indexes(self.rcut)
+        self.images = np.dot(indexes, self.unit_cell.matrix.transpose())
+
+    def _setup_kvectors(self):
+        """Find the wavevectors and their weights in the reciprocal-space sum
+
+           Only one wavevector out of each pair k, -k is included.
+        """
+        reciprocal_cell = UnitCell(2*np.pi*self.unit_cell.reciprocal)
+        indexes = reciprocal_cell.get_radius_indexes(self.kcut)
+        # lexicographically positive indexes
+        positive = (
+            (indexes[:,0] > 0) |
+            ((indexes[:,0] == 0) & (indexes[:,1] > 0)) |
+            ((indexes[:,0] == 0) & (indexes[:,1] == 0) & (indexes[:,2] > 0))
+        )
+        kvectors = np.dot(indexes[positive], reciprocal_cell.matrix.transpose())
+        knorms_sq = (kvectors**2).sum(axis=1)
+        mask = knorms_sq <= self.kcut**2
+        self.kvectors = kvectors[mask]
+        # the factor two accounts for the wavevectors -k
+        self.kweights = 2*4*np.pi/self.unit_cell.volume*np.exp(
+            -knorms_sq[mask]/(4*self.alpha**2)
+        )/knorms_sq[mask]
+
+    def update_coordinates(self, coordinates=None):
+        """Update the coordinates (and derived quantities)
+
+           Argument:
+             coordinates  --  new Cartesian coordinates of the system
+        """
+        if coordinates is not None:
+            self.coordinates = coordinates
+        self.numc = len(self.coordinates)
+        # wrap the coordinates in the unit cell
+        self._wrapped = self.unit_cell.wrap(self.coordinates)
+        self._setup_real_pairs()
+
+    def _setup_real_pairs(self):
+        """Search all atom pairs within rcut, including periodic images
+
+           The atoms in the home cell are paired with their periodic images
+           with a (non-periodic) binned pair search. Only the images within
+           rcut of the home cell take part in the search.
+        """
+        margins = self.rcut/self.unit_cell.spacings
+        images = []
+        owners = []
+        for image in self.images:
+            shifted = self._wrapped + image
+            fractional = self.unit_cell.to_fractional(shifted)
+            mask = ((fractional >= -margins) & (fractional <= 1 + margins)).all(axis=1)
+            images.append(shifted[mask])
+            owners.append(mask.nonzero()[0])
+        images = np.concatenate(images)
+        owners = np.concatenate(owners)
+        index1, index2, deltas, distances = PairSearchInter(self._wrapped, images, self.rcut).as_arrays()
+        # an atom does not interact with itself
+        mask = distances > 0
+        self._real_pairs = index1[mask], owners[index2[mask]], -deltas[mask], distances[mask]
+
+    def _iter_real_pairs(self):
+        """Iterate over chunks of all atom pairs within rcut, including images
+
+           Yields tuples (index1, index2, deltas, distances), where deltas are
+           the relative vectors from the image of atom index2 to atom index1.
+           Both (i, j) and (j, i) are included.
+        """
+        index1, index2, deltas, distances = self._real_pairs
+        for begin in xrange(0, len(distances), self.chunk_size):
+            end = begin + self.chunk_size
+            yield index1[begin:end], index2[begin:end], deltas[begin:end], distances[begin:end]
+
+    def energy_real(self):
+        """Compute the real-space part of the energy"""
+        result = 0.0
+        for index1, index2, deltas, distances in self._iter_real_pairs():
+            products = self.charges[index1]*self.charges[index2]
+            result += 0.5*(products*_erfc(self.alpha*distances)/distances).sum()
+        return result
+
+    def gradient_real(self):
+        """Compute the gradient of the real-space part of the energy"""
+        result = np.zeros((self.numc, 3), float)
+        for index1, index2, deltas, distances in self._iter_real_pairs():
+            products = self.charges[index1]*self.charges[index2]
+            derivatives = products*(
+                -_erfc(self.alpha*distances)/distances**2
+                -2*self.alpha/np.sqrt(np.pi)*np.exp(-(self.alpha*distances)**2)/distances
+            )
+            for i in xrange(3):
+                result[:,i] += np.bincount(index1, derivatives*deltas[:,i]/distances, self.numc)
+        return result
+
+    def _iter_structure_factors(self):
+        """Iterate over chunks of wavevectors with their structure factors
+
+           Yields tuples (kvectors, kweights, cosines, sines, cos_sum,
+           sin_sum), where cosines and sines have one row per atom and one
+           column per wavevector. The last two are the real and imaginary
+           parts of the structure factors.
+        """
+        columns = max(1, self.chunk_size/max(1, self.numc))
+        for begin in xrange(0, len(self.kvectors), columns):
+            kvectors = self.kvectors[begin:begin+columns]
+            phases = np.dot(self._wrapped, kvectors.transpose())
+            cosines = np.cos(phases)
+            sines = np.sin(phases)
+            cos_sum = np.dot(self.charges, cosines)
+            sin_sum = np.dot(self.charges, sines)
+            yield kvectors, self.kweights[begin:begin+columns], cosines, sines, cos_sum, sin_sum
+
+    def energy_reciprocal(self):
+        """Compute the reciprocal-space part of the energy"""
+        result = 0.0
+        for kvectors, kweights, cosines, sines, cos_sum, sin_sum in self._iter_structure_factors():
+            result += 0.5*(kweights*(cos_sum**2 + sin_sum**2)).sum()
+        return result
+
+    def gradient_reciprocal(self):
+        """Compute the gradient of the reciprocal-space part of the energy"""
+        result = np.zeros((self.numc, 3), float)
+        for kvectors, kweights, cosines, sines, cos_sum, sin_sum in self._iter_structure_factors():
+            factors = kweights*(cos_sum*(-sines) + sin_sum*cosines)
+            result += self.charges.reshape((-1, 1))*np.dot(factors, kvectors)
+        return result
+
+    def energy_self(self):
+        """Compute the self-energy correction and the background energy
+
+           The background energy only differs from zero for charged systems.
+        """
+        total = self.charges.sum()
+        return (
+            -self.alpha/np.sqrt(np.pi)*(self.charges**2).sum()
+            -np.pi*total**2/(2*self.unit_cell.volume*self.alpha**2)
+        )
+
+    def energy(self):
+        """Compute the energy of the system"""
+        return self.energy_real() + self.energy_reciprocal() + self.energy_self()
+
+    def gradient(self):
+        """Compute the gradient of the energy for all atoms"""
+        return self.gradient_real() + self.gradient_reciprocal()
+
+    def gradient_flat(self):
+        """Return the gradient a 3N array"""
+        return self.gradient().ravel()
 
 
 class DispersionFF(PairFF):
     """Computes the London dispersion interaction"""
 
+    pair_parameters = ("strengths",)
+
     def __init__(self, scaling, strengths, coordinates=None):
         """Initialize a DispersionFF object
 
@@ -356,10 +1195,27 @@ class DispersionFF(PairFF):
         distance = self.distances[index1, index2]
         yield 42*strength*distance**(-8), np.zeros((3, 3))
 
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of atom pairs"""
+        strengths = self.strengths[index1, index2]
+        yield strengths*distances**(-6), 1
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        strengths = self.strengths[index1, index2]
+        yield -6*strengths*distances**(-7), 0
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        strengths = self.strengths[index1, index2]
+        yield 42*strengths*distances**(-8), 0
+
 
 class PauliFF(PairFF):
     """Computes the Pauli repulsion interaction"""
 
+    pair_parameters = ("strengths",)
+
     def __init__(self, scaling, strengths, coordinates=None):
         """Initialize a PauliFF
 
@@ -395,10 +1251,27 @@ class PauliFF(PairFF):
         distance = self.distances[index1, index2]
         yield 12*13*strength*distance**(-14), np.zeros((3, 3))
 
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of atom pairs"""
+        strengths = self.strengths[index1, index2]
+        yield strengths*distances**(-12), 1
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        strengths = self.strengths[index1, index2]
+        yield -12*strengths*distances**(-13), 0
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        strengths = self.strengths[index1, index2]
+        yield 12*13*strengths*distances**(-14), 0
+
 
 class ExpRepFF(PairFF):
     """Computes the exponential repulsion interaction"""
 
+    pair_parameters = ("As", "Bs")
+
     def __init__(self, scaling, As, Bs, coordinates=None):
         """Initialize a ExpRepFF
 
@@ -439,3 +1312,283 @@ class ExpRepFF(PairFF):
         B = self.Bs[index1, index2]
         distance = self.distances[index1, index2]
         yield B*B*A*np.exp(-B*distance), np.zeros((3, 3))
+
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of atom pairs"""
+        A = self.As[index1, index2]
+        B = self.Bs[index1, index2]
+        yield A*np.exp(-B*distances), 1
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        A = self.As[index1, index2]
+        B = self.Bs[index1, index2]
+        yield -B*A*np.exp(-B*distances), 0
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        A = self.As[index1, index2]
+        B = self.Bs[index1, index2]
+        yield B*B*A*np.exp(-B*distances), 0
+
+
+def _solve_tridiagonal(lower, diagonal, upper, rhs):
+    """Solve a tridiagonal linear system with the Thomas algorithm
+
+       Arguments:
+         lower  --  the subdiagonal, n-1 elements
+         diagonal  --  the diagonal, n elements
+         upper  --  the superdiagonal, n-1 elements
+         rhs  --  the right-hand side, an array with n rows. The columns are
+                  solved simultaneously.
+
+       No pivoting is done, so the matrix should be diagonally dominant.
+    """
+    n = len(diagonal)
+    factors = np.zeros(n - 1, float)
+    solution = np.array(rhs, float)
+    pivot = float(diagonal[0])
+    solution[0] /= pivot
+    for i in xrange(1, n):
+        factors[i-1] = upper[i-1]/pivot
+        pivot = diagonal[i] - lower[i-1]*factors[i-1]
+        solution[i] -= lower[i-1]*solution[i-1]
+        solution[i] /= pivot
+    for i in xrange(n - 2, -1, -1):
+        solution[i] -= factors[i]*solution[i+1]
+    return solution
+
+
+class TabulatedFF(PairFF):
+    """A radial pair potential evaluated with cubic-spline tables
+
+       The pair energy of an analytic radial pair potential, e.g. DispersionFF,
+       PauliFF or ExpRepFF, is tabulated on a uniform grid for each pair of
+       atom types. The energy and its first and second derivative are then
+       evaluated with a clamped cubic spline. The derivatives are those of the
+       spline, such that the gradient and the Hessian are consistent with the
+       energy.
+
+       The parameters of the analytic potential must only depend on the atom
+       types, which is checked for the attributes listed in pair_parameters
+       of each analytic potential. Distances outside the range of the tables are evaluated with
+       the analytic potential.
+
+       With NumPy, a table lookup costs about as much as the evaluation of a
+       single power or exponential. The tables pay off when several radial
+       terms with the same scaling factors are combined in one table, e.g. a
+       dispersion and a repulsion term.
+    """
+
+    def __init__(self, ff, types, r_min, r_max, num_points=1000, coordinates=None):
+        """Initialize a TabulatedFF object
+
+           Arguments:
+             ff  --  the analytic pair potential, or a list of pair potentials
+                     that are summed. Their pair energies must only depend on
+                     the distance, i.e. all v(bar{r}_ij) are one. The scaling
+                     factors of the (first) potential are also used for the
+                     tabulated potential.
+             types  --  an array with an integer atom type for each atom
+             r_min  --  the smallest distance in the tables
+             r_max  --  the largest distance in the tables, typically the
+                        cutoff
+
+           Optional arguments:
+             num_points  --  the number of grid points in the tables
+             coordinates  --  the initial Cartesian coordinates of the system,
+                              which can be updated with the update_coordinates
+                              method
+
+           The errors of the energy and its first and second derivative with
+           respect to the analytic form are stored in the attribute errors.
+           They are computed for one representative atom of each type, which
+           is sufficient because all atoms of a type must have the same pair
+           parameters. See :meth:`compute_errors`.
+        """
+        if r_min <= 0 or r_max <= r_min:
+            raise ValueError("The range of the tables must satisfy 0 < r_min < r_max.")
+        if num_points < 3:
+            raise ValueError("At least three grid points are required.")
+        if isinstance(ff, PairFF):
+            ff = [ff]
+        self.ffs = ff
+        self.types = np.asarray(types, int)
+        self.num_types = self.types.max() + 1
+        self.r_min = r_min
+        self.r_max = r_max
+        self.num_points = num_points
+        self.spacing = float(r_max - r_min)/(num_points - 1)
+        # a representative atom for each type
+        self._representatives = np.zeros(self.num_types, int)
+        for atom_type in xrange(self.num_types):
+            indexes = (self.types == atom_type).nonzero()[0]
+            if len(indexes) > 0:
+                self._representatives[atom_type] = indexes[0]
+        self._check_parameters()
+        self._setup_tables()
+        PairFF.__init__(self, self.ffs[0].scaling, coordinates)
+        self.errors = self.compute_errors()
+
+    def _check_parameters(self):
+        """Make sure the pair parameters only depend on the atom types"""
+        representatives = self._representatives[self.types]
+        for ff in self.ffs:
+            for name in ff.pair_parameters:
+                parameters = getattr(ff, name)
+                if parameters is None:
+                    continue
+                parameters = np.asarray(parameters)
+                expected = parameters.take(representatives, axis=0)
+                if parameters.ndim == 2:
+                    expected = expected.take(representatives, axis=1)
+                if (parameters != expected).any():
+                    raise ValueError("The parameter %s of %s differs between atoms of the same type." % (name, ff.__class__.__name__))
+
+    def _get_type_pairs(self):
+        """Return arrays with the representative atoms of all type pairs"""
+        types1, types2 = np.indices((self.num_types, self.num_types)).reshape((2, -1))
+        return self._representatives[types1], self._representatives[types2]
+
+    def _evaluate_analytic(self, index1, index2, distances, order):
+        """Evaluate a derivative of the analytic pair energies
+
+           Arguments:
+             index1, index2  --  arrays with the atom indexes of the pairs
+             distances  --  an array with the distances of the pairs
+             order  --  0 (energy), 1 (first derivative) or 2 (second
+                        derivative)
+        """
+        name = ["energy", "gradient", "hessian"][order]
+        # the relative vectors are only needed to call the methods
+        deltas = np.zeros((len(distances), 3), float)
+        deltas[:,0] = distances
+        result = np.zeros(len(distances), float)
+        for ff in self.ffs:
+            method = getattr(ff, "yield_pair_%s_arrays" % name)
+            for s, v in method(index1, index2, deltas, distances):
+                v = np.asarray(v)
+                if (order == 0 and (v != 1).any()) or (order > 0 and (v != 0).any()):
+                    raise TypeError("Only radial pair potentials can be tabulated.")
+                result += s
+        return result
+
+    def _setup_tables(self):
+        """Compute the cubic spline coefficients for all pairs of atom types"""
+        index1, index2 = self._get_type_pairs()
+        size = len(index1)
+        n = self.num_points
+        h = self.spacing
+        grid = self.r_min + np.arange(n)*h
+        values = self._evaluate_analytic(
+            index1.repeat(n), index2.repeat(n), np.tile(grid, size), 0
+        ).reshape((size, n)).transpose()
+        ends = np.array([self.r_min, self.r_max])
+        slopes = self._evaluate_analytic(
+            index1.repeat(2), index2.repeat(2), np.tile(ends, size), 1
+        ).reshape((size, 2))
+        # tridiagonal equations for the second derivatives of a clamped spline
+        diagonal = np.zeros(n, float)
+        diagonal[:] = 4
+        diagonal[0] = 2
+        diagonal[-1] = 2
+        offdiagonal = np.ones(n - 1, float)
+        rhs = np.zeros((n, size), float)
+        rhs[1:-1] = 6*(values[2:] - 2*values[1:-1] + values[:-2])/h**2
+        rhs[0] = 6*((values[1] - values[0])/h - slopes[:,0])/h
+        rhs[-1] = 6*(slopes[:,1] - (values[-1] - values[-2])/h)/h
+        curvatures = _solve_tridiagonal(offdiagonal, diagonal, offdiagonal, rhs)
+        # polynomial coefficients in each interval, in powers of the reduced
+        # coordinate t = (r - r_k)/h, stored as one row per table entry
+        coefficients = np.zeros((size, n - 1, 4), float)
+        coefficients[:,:,0] = values[:-1].transpose()
+        coefficients[:,:,1] = (values[1:] - values[:-1] - h**2*(2*curvatures[:-1] + curvatures[1:])/6).transpose()
+        coefficients[:,:,2] = 0.5*h**2*curvatures[:-1].transpose()
+        coefficients[:,:,3] = (h**2*(curvatures[1:] - curvatures[:-1])/6).transpose()
+        self.coefficients = coefficients.reshape((-1, 4))
+
+    def _evaluate(self, index1, index2, distances, order):
+        """Evaluate a derivative of the pair energies with the tables
+
+           See :meth:`_evaluate_analytic` for the arguments.
+        """
+        type_pairs = self.types.take(index1)*self.num_types + self.types.take(index2)
+        positions = (distances - self.r_min)*(1.0/self.spacing)
+        intervals = positions.astype(int)
+        np.clip(intervals, 0, self.num_points - 2, intervals)
+        t = positions - intervals
+        c = self.coefficients.take(type_pairs*(self.num_points - 1) + intervals, axis=0)
+        if order == 0:
+            result = c[:,0] + t*(c[:,1] + t*(c[:,2] + t*c[:,3]))
+        elif order == 1:
+            result = (c[:,1] + t*(2*c[:,2] + 3*t*c[:,3]))*(1.0/self.spacing)
+        else:
+            result = (2*c[:,2] + 6*t*c[:,3])*(1.0/self.spacing**2)
+        outside = (positions < 0) | (positions > self.num_points - 1)
+        if outside.any():
+            result[outside] = self._evaluate_analytic(
+                index1[outside], index2[outside], distances[outside], order
+            )
+        return result
+
+    def compute_errors(self, num_test=None):
+        """Compare the tables with the analytic form for all type pairs
+
+           Optional argument:
+             num_test  --  the number of random test distances. By default,
+                           three points in each interval of the tables are
+                           used.
+
+           Returns an array with the errors of the energy and its first and
+           second derivative. Each error is the largest absolute deviation
+           from the analytic form, divided by the largest absolute analytic
+           value in the range of the tables. The worst pair of atom types
+           determines the result.
+        """
+        if num_test is None:
+            offsets = np.array([0.2, 0.5, 0.8])
+            distances = self.r_min + (np.arange(self.num_points - 1).reshape((-1, 1)) + offsets).ravel()*self.spacing
+        else:
+            distances = np.random.uniform(self.r_min, self.r_max, num_test)
+        index1, index2 = self._get_type_pairs()
+        index1 = index1.repeat(len(distances))
+        index2 = index2.repeat(len(distances))
+        distances = np.tile(distances, self.num_types**2)
+        result = np.zeros(3, float)
+        for order in xrange(3):
+            reference = self._evaluate_analytic(index1, index2, distances, order)
+            errors = abs(self._evaluate(index1, index2, distances, order) - reference)
+            # one row per type pair
+            errors = errors.reshape((self.num_types**2, -1)).max(axis=1)
+            scales = abs(reference).reshape((self.num_types**2, -1)).max(axis=1)
+            mask = scales > 0
+            if mask.any():
+                result[order] = (errors[mask]/scales[mask]).max()
+        return result
+
+    def yield_pair_energies(self, index1, index2):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij))"""
+        distances = self.distances[index1, index2].reshape(1)
+        yield self._evaluate(np.array([index1]), np.array([index2]), distances, 0)[0], 1
+
+    def yield_pair_gradients(self, index1, index2):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij))"""
+        distances = self.distances[index1, index2].reshape(1)
+        yield self._evaluate(np.array([index1]), np.array([index2]), distances, 1)[0], np.zeros(3)
+
+    def yield_pair_hessians(self, index1, index2):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij))"""
+        distances = self.distances[index1, index2].reshape(1)
+        yield self._evaluate(np.array([index1]), np.array([index2]), distances, 2)[0], np.zeros((3, 3))
+
+    def yield_pair_energy_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s(r_ij), v(bar{r}_ij)) for arrays of atom pairs"""
+        yield self._evaluate(index1, index2, distances, 0), 1
+
+    def yield_pair_gradient_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s'(r_ij), grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        yield self._evaluate(index1, index2, distances, 1), 0
+
+    def yield_pair_hessian_arrays(self, index1, index2, deltas, distances):
+        """Yields pairs ((s''(r_ij), grad_i (x) grad_i v(bar{r}_ij)) for arrays of atom pairs"""
+        yield self._evaluate(index1, index2, distances, 2), 0
@@ -26,11 +26,12 @@
 from random import shuffle, sample
 
 from molmod.molecules import Molecule
+from molmod.binning import PairSearchIntra
 from molmod.graphs import GraphError
 from molmod.transformations import Translation, Complete
 from molmod.vectors import random_orthonormal, random_unit
 
-import numpy, copy
+import numpy, copy, itertools
 
 
 __all__ = [
@@ -336,18 +337,82 @@ def check_nonbond(molecule, thresholds):
        the forces projected on the nonbonding distance gradients. The distance
        for which the absolute value of these gradients drops below 100 kJ/mol is
        a coarse guess of a proper threshold value.
+
+       When the molecule has a unit cell, the distances are computed with the
+       minimum image convention, so atoms that are close through the periodic
+       boundary also violate the thresholds.
     """
 
-    # check that no atoms overlap
-    for atom1 in xrange(molecule.graph.num_vertices):
-        for atom2 in xrange(atom1):
-            if molecule.graph.distances[atom1, atom2] > 2:
-                distance = numpy.linalg.norm(molecule.coordinates[atom1] - molecule.coordinates[atom2])
-                if distance < thresholds[frozenset([molecule.numbers[atom1], molecule.numbers[atom2]])]:
-                    return False
+    # check that no atoms overlap, only pairs closer than the largest
+    # threshold need to be considered
+    if len(thresholds) == 0:
+        return True
+    distances = molecule.distance_matrix_sparse(max(thresholds.itervalues()))
+    for pair in _iter_nonbond_violations(molecule, thresholds, distances.iter_pairs()):
+        return False
     return True
 
 
+def _iter_nonbond_violations(molecule, thresholds, pairs):
+    """Iterate over the atom pairs that violate the nonbond thresholds
+
+       Arguments:
+        | ``molecule``  --  the molecule whose graph and atom numbers are used
+        | ``thresholds``  --  the thresholds, see :func:`check_nonbond`
+        | ``pairs``  --  an iterable over (atom1, atom2, distance) tuples
+    """
+    for atom1, atom2, distance in pairs:
+        if molecule.graph.distances[atom1, atom2] > 2:
+            if distance < thresholds[frozenset([molecule.numbers[atom1], molecule.numbers[atom2]])]:
+                yield atom1, atom2
+
+
+class _NonbondChecker(object):
+    """Repeated nonbond checks of geometries derived from one molecule
+
+       Each geometry is compared with the reference geometry of the molecule.
+       Only the pairs with moved atoms are searched again. This makes the
+       check cheap when a manipulation only moves a small part of the
+       molecule. The outcome is the same as that of :func:`check_nonbond`.
+    """
+    def __init__(self, molecule, thresholds):
+        self.molecule = molecule
+        self.thresholds = thresholds
+        if len(thresholds) > 0:
+            self.pair_search = PairSearchIntra(
+                molecule.coordinates, max(thresholds.itervalues()),
+                molecule.unit_cell
+            )
+            i0, i1, delta, distance = self.pair_search.as_arrays()
+            self.violations = list(_iter_nonbond_violations(
+                molecule, thresholds,
+                itertools.izip(i0.tolist(), i1.tolist(), distance.tolist())
+            ))
+
+    def check(self, coordinates):
+        """Check whether all nonbonded atoms are well separated"""
+        if len(self.thresholds) == 0:
+            return True
+        reference = self.molecule.coordinates
+        moved = (coordinates != reference).any(axis=1)
+        # violations in the reference geometry that are not affected
+        for atom1, atom2 in self.violations:
+            if not (moved[atom1] or moved[atom2]):
+                return False
+        indexes = moved.nonzero()[0]
+        if len(indexes) == 0:
+            return len(self.violations) == 0
+        i0, i1, delta, distance = self.pair_search.update(indexes, coordinates[indexes])
+        result = True
+        for pair in _iter_nonbond_violations(self.molecule, self.thresholds,
+            itertools.izip(i0.tolist(), i1.tolist(), distance.tolist())):
+            result = False
+            break
+        # restore the reference geometry in the pair search
+        self.pair_search.update(indexes, reference[indexes])
+        return result
+
+
 def randomize_molecule(molecule, manipulations, nonbond_thresholds, max_tries=1000):
     """Return a randomized copy of the molecule.
 
@@ -356,9 +421,10 @@ def randomize_molecule(molecule, manipulations, nonbond_thresholds, max_tries=10
        the randomized molecule is returned. The original molecule is not
        altered.
     """
+    checker = _NonbondChecker(molecule, nonbond_thresholds)
     for m in xrange(max_tries):
         random_molecule = randomize_molecule_low(molecule, manipulations)
-        if check_nonbond(random_molecule, nonbond_thresholds):
+        if checker.check(random_molecule.coordinates):
             return random_molecule
 
 
@@ -381,9 +447,10 @@ def single_random_manipulation(molecule, manipulations, nonbond_thresholds, max_
        the randomized molecule and the corresponding transformation is returned.
        The original molecule is not altered.
     """
+    checker = _NonbondChecker(molecule, nonbond_thresholds)
     for m in xrange(max_tries):
         random_molecule, transformation = single_random_manipulation_low(molecule, manipulations)
-        if check_nonbond(random_molecule, nonbond_thresholds):
+        if checker.check(random_molecule.coordinates):
             return random_molecule, transformation
     return None
 
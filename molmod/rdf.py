@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Radial distribution functions of periodic systems
+
+   The radial distribution function is accumulated frame by frame, such that
+   long trajectories can be processed without loading them into memory.
+   Example::
+
+       from molmod.io import XYZReader
+       xyz_reader = XYZReader("traj.xyz")
+       rdf = RDF(10*angstrom, 100, unit_cell, 8, 1, xyz_reader.numbers)
+       rdf.add_frames(xyz_reader)
+       print rdf.centers, rdf.get_rdf()
+
+   The frames of any trajectory reader can be used. For the readers whose
+   frames do not contain a plain array with coordinates, a function is given
+   that extracts the coordinates, e.g. for a LAMMPS dump file with the
+   Cartesian coordinates in the first three fields::
+
+       ldr = LAMMPSDumpReader("traj.dump", [angstrom]*3)
+       rdf.add_frames(ldr, lambda fields: numpy.array(fields[1:4]).transpose())
+"""
+
+
+from molmod.binning import PairSearchIntra, PairSearchInter
+
+import numpy
+
+
+__all__ = ["RDF"]
+
+
+def _get_coordinates(frame):
+    """Extract the coordinates from a frame of a trajectory reader
+
+       Supported frames are Nx3 arrays, tuples or lists that contain an Nx3
+       array (e.g. ``(title, coordinates)`` from the XYZReader) and
+       dictionaries with a key ``pos`` (e.g. DLPolyHistoryReader).
+    """
+    if isinstance(frame, numpy.ndarray):
+        return frame
+    if isinstance(frame, dict):
+        return frame["pos"]
+    if isinstance(frame, (tuple, list)):
+        for item in frame:
+            if isinstance(item, numpy.ndarray) and len(item.shape) == 2 and item.shape[1] == 3:
+                return item
+    raise TypeError("Could not find the coordinates in the frame. Specify the coordinates argument.")
+
+
+class RDF(object):
+    """Accumulator for a radial distribution function g(r)"""
+
+    def __init__(self, r_max, num_bins, unit_cell, selection0=None, selection1=None, numbers=None):
+        """
+           Arguments:
+            | ``r_max``  --  The largest distance in the histogram.
+            | ``num_bins``  --  The number of bins in the histogram.
+            | ``unit_cell``  --  The periodic boundary conditions. All three
+                                 cell vectors must be active.
+
+           Optional arguments:
+            | ``selection0``  --  The atoms at the center of the shells. This
+                                  is an array with atom indexes, an atomic
+                                  number or an element symbol. The default is
+                                  all atoms.
+            | ``selection1``  --  The atoms counted in the shells, same format
+                                  as selection0. The default is selection0.
+            | ``numbers``  --  The atomic numbers of all atoms. This is only
+                               needed for selections based on elements.
+
+           The value of r_max can not be larger than half of the smallest
+           spacing of the unit cell because the minimum image convention is
+           used to compute the distances.
+        """
+        if not unit_cell.active.all():
+            raise ValueError("The RDF requires a unit cell with three active cell vectors.")
+        if r_max > 0.5*unit_cell.spacings.min():
+            raise ValueError("r_max can not exceed half of the smallest spacing of the unit cell.")
+        self.r_max = r_max
+        self.num_bins = num_bins
+        self.unit_cell = unit_cell
+        self.selection0 = self._get_selection(selection0, numbers)
+        if selection1 is None:
+            self.selection1 = self.selection0
+        else:
+            self.selection1 = self._get_selection(selection1, numbers)
+        self.bin_width = r_max/num_bins
+        self.bins = numpy.arange(num_bins+1)*self.bin_width
+        self.centers = self.bins[:-1] + 0.5*self.bin_width
+        self.counts = numpy.zeros(num_bins, int)
+        self.num_frames = 0
+        self.size = None
+
+    def _get_selection(self, selection, numbers):
+        """Convert a selection into an array of atom indexes or None (all atoms)"""
+        if selection is None:
+            return None
+        if isinstance(selection, basestring):
+            from molmod.periodic import periodic
+            selection = periodic[selection].number
+        if isinstance(selection, (int, numpy.integer)):
+            if numbers is None:
+                raise ValueError("The atomic numbers are required for a selection based on elements.")
+            return (numpy.asarray(numbers) == selection).nonzero()[0]
+        return numpy.asarray(selection, int)
+
+    def _get_indexes(self, selection):
+        """Return the indexes of the selected atoms"""
+        if selection is None:
+            return numpy.arange(self.size)
+        return selection
+
+    def add_frame(self, coordinates):
+        """Add the pair distances of one frame to the histogram
+
+           Argument:
+            | ``coordinates``  --  A Nx3 array with the Cartesian coordinates
+                                   of all atoms in the frame.
+        """
+        if self.size is None:
+            self.size = len(coordinates)
+        elif self.size != len(coordinates):
+            raise ValueError("All frames must have the same number of atoms.")
+        indexes0 = self._get_indexes(self.selection0)
+        coordinates0 = coordinates[indexes0]
+        if self.selection1 is self.selection0:
+            i0, i1, delta, distance = PairSearchIntra(coordinates0, self.r_max, self.unit_cell).as_arrays()
+            # each pair contributes to the shells of both atoms
+            weight = 2
+        else:
+            indexes1 = self._get_indexes(self.selection1)
+            coordinates1 = coordinates[indexes1]
+            i0, i1, delta, distance = PairSearchInter(coordinates0, coordinates1, self.r_max, self.unit_cell).as_arrays()
+            # an atom that is part of both selections is not its own neighbor
+            distance = distance[indexes0[i0] != indexes1[i1]]
+            weight = 1
+        distance = distance[distance < self.r_max]
+        indexes = (distance/self.bin_width).astype(int).clip(0, self.num_bins-1)
+        self.counts += weight*numpy.bincount(indexes, minlength=self.num_bins)
+        self.num_frames += 1
+
+    def add_frames(self, frames, coordinates=None):
+        """Add all frames from an iterator, e.g. a trajectory reader
+
+           Argument:
+            | ``frames``  --  An iterable over frames.
+
+           Optional argument:
+            | ``coordinates``  --  A function that extracts a Nx3 coordinates
+                                   array from a frame. By default, the frames
+                                   of most trajectory readers are supported,
+                                   see :func:`_get_coordinates`.
+
+           Only one frame is kept in memory at a time.
+        """
+        if coordinates is None:
+            coordinates = _get_coordinates
+        for frame in frames:
+            self.add_frame(coordinates(frame))
+
+    def _get_num_pairs(self):
+        """The number of ordered atom pairs in the two selections"""
+        indexes0 = self._get_indexes(self.selection0)
+        if self.selection1 is self.selection0:
+            return len(indexes0)*(len(indexes0) - 1)
+        indexes1 = self._get_indexes(self.selection1)
+        common = len(numpy.intersect1d(indexes0, indexes1))
+        return len(indexes0)*len(indexes1) - common
+
+    def get_rdf(self):
+        """Return the radial distribution function at the bin centers
+
+           The histogram is normalized by the average number of atom pairs
+           that would be found in each shell for an ideal gas with the same
+           density. The result goes to one at large distances for a
+           homogeneous fluid.
+        """
+        if self.num_frames == 0:
+            raise ValueError("No frames are added to the RDF.")
+        num_pairs = self._get_num_pairs()
+        if num_pairs == 0:
+            raise ValueError("The selections do not contain any atom pair.")
+        shell_volumes = 4.0/3.0*numpy.pi*(self.bins[1:]**3 - self.bins[:-1]**3)
+        ideal = num_pairs*shell_volumes/self.unit_cell.volume
+        return self.counts/(ideal*self.num_frames)
@@ -54,11 +54,19 @@ class SimilarityDescriptor(object):
 
            Arguments:
              distance_matrix  --  a matrix with interatomic distances, this can
-                                  also be distances in a graph
+                                  also be distances in a graph. A condensed
+                                  array with distances, as computed by
+                                  molmod.distances.compute_distance_matrix,
+                                  is also accepted. (It must be in the
+                                  lower-triangle order of that function, not
+                                  in the order of scipy's pdist.)
              labels  --  a list with integer labels used to identify atoms of
                          the same type
         """
-        self.table_distances = similarity_table_distances(distance_matrix)
+        if len(distance_matrix.shape) == 1:
+            self.table_distances = distance_matrix
+        else:
+            self.table_distances = similarity_table_distances(distance_matrix)
         self.table_labels = similarity_table_labels(labels.astype(numpy.int32))
         order = numpy.lexsort([self.table_labels[:, 1], self.table_labels[:, 0]])
         self.table_labels = self.table_labels[order]
@@ -76,7 +84,7 @@ class SimilarityDescriptor(object):
         """
         if labels is None:
             labels = molecule.numbers
-        return cls(molecule.distance_matrix, labels)
+        return cls(molecule.distance_matrix_condensed(), labels)
 
     @classmethod
     def from_molecular_graph(cls, molecular_graph, labels=None):
@@ -101,9 +109,8 @@ class SimilarityDescriptor(object):
              labels  --  a list with integer labels used to identify atoms of
                          the same type
         """
-        from molmod.ext import molecules_distance_matrix
-        distance_matrix = molecules_distance_matrix(coordinates)
-        return cls(distance_matrix, labels)
+        from molmod.distances import compute_distance_matrix
+        return cls(compute_distance_matrix(coordinates, condensed=True), labels)
 
 
 def compute_similarity(a, b, margin=1.0, cutoff=10.0):
@@ -26,12 +26,92 @@
 from molmod.units import angstrom
 from molmod.utils import cached, ReadOnly, ReadOnlyAttribute
 
-import numpy
+import numpy, itertools
 
 
 __all__ = ["UnitCell"]
 
 
+def _gram_schmidt(basis):
+    """Return the Gram-Schmidt vectors and coefficients of the rows of basis"""
+    size = len(basis)
+    ortho = basis.copy()
+    mu = numpy.zeros((size, size), float)
+    for i in xrange(size):
+        for j in xrange(i):
+            mu[i, j] = numpy.dot(basis[i], ortho[j])/numpy.dot(ortho[j], ortho[j])
+            ortho[i] -= mu[i, j]*ortho[j]
+    return ortho, mu
+
+
+def _reduce_lll(basis, delta=0.99):
+    """Return an LLL-reduced basis of the lattice spanned by the rows of basis"""
+    basis = basis.copy()
+    k = 1
+    while k < len(basis):
+        # size reduction
+        for j in xrange(k-1, -1, -1):
+            mu = _gram_schmidt(basis)[1]
+            factor = numpy.round(mu[k, j])
+            if factor != 0:
+                basis[k] -= factor*basis[j]
+        # Lovasz condition
+        ortho, mu = _gram_schmidt(basis)
+        norm_sq_k = numpy.dot(ortho[k], ortho[k])
+        norm_sq_prev = numpy.dot(ortho[k-1], ortho[k-1])
+        if norm_sq_k >= (delta - mu[k, k-1]**2)*norm_sq_prev:
+            k += 1
+        else:
+            basis[[k-1, k]] = basis[[k, k-1]]
+            k = max(k-1, 1)
+    return basis
+
+
+def _reduce_greedy(basis):
+    """Shorten the rows of basis with plus or minus the other rows"""
+    basis = basis.copy()
+    changed = True
+    while changed:
+        changed = False
+        for i in xrange(len(basis)):
+            others = basis[[j for j in xrange(len(basis)) if j != i]]
+            for coeffs in itertools.product([-1, 0, 1], repeat=len(others)):
+                vector = basis[i] + numpy.dot(coeffs, others)
+                if (vector**2).sum() < (basis[i]**2).sum()*(1-1e-12):
+                    basis[i] = vector
+                    changed = True
+    return basis
+
+
+# the number of vectors that are transformed at once in place
+_block_size = 4096
+
+
+def _dot_vectors(vectors, matrix, out=None):
+    """Multiply an array of row vectors, shape (..., 3), with a 3x3 matrix
+
+       When out is given, the result is written into out without allocating
+       an array of the same size. The output array may be the input array.
+    """
+    if out is None:
+        return numpy.dot(vectors, matrix)
+    vectors = numpy.asarray(vectors)
+    if out.shape != vectors.shape:
+        raise TypeError("The output array must have the same shape as the input array.")
+    if not (out.flags.c_contiguous and out.dtype == float):
+        out[:] = numpy.dot(vectors, matrix)
+    elif numpy.may_share_memory(out, vectors):
+        # transform small blocks via a temporary array
+        flat_vectors = vectors.reshape((-1, 3))
+        flat_out = out.reshape((-1, 3))
+        for begin in xrange(0, len(flat_out), _block_size):
+            end = begin + _block_size
+            flat_out[begin:end] = numpy.dot(flat_vectors[begin:end], matrix)
+    else:
+        numpy.dot(vectors.reshape((-1, 3)), matrix, out.reshape((-1, 3)))
+    return out
+
+
 class UnitCell(ReadOnly):
     """Extensible representation of a unit cell.
 
@@ -243,45 +323,193 @@ class UnitCell(ReadOnly):
                 result[i] = result_invsq[i]**(-0.5)
         return result
 
-    def to_fractional(self, cartesian):
+    def to_fractional(self, cartesian, out=None):
         """Convert Cartesian to fractional coordinates
 
            Argument:
-            | ``cartesian``  --  Can be a numpy array with shape (3, ) or with shape
-                                 (N, 3).
+            | ``cartesian``  --  Can be a numpy array with shape (3, ) or with
+                                 shape (..., 3), e.g. (N, 3) or (M, N, 3).
+
+           Optional argument:
+            | ``out``  --  An output array with the same shape as the argument.
+                           It may be the argument itself.
 
            The return value has the same shape as the argument. This function is
            the inverse of to_cartesian.
         """
-        return numpy.dot(cartesian, self.reciprocal)
+        return _dot_vectors(cartesian, self.reciprocal, out)
 
-    def to_cartesian(self, fractional):
+    def to_cartesian(self, fractional, out=None):
         """Converts fractional to Cartesian coordinates
 
            Argument:
-            | ``fractional``  --  Can be a numpy array with shape (3, ) or with shape
-                                  (N, 3).
+            | ``fractional``  --  Can be a numpy array with shape (3, ) or with
+                                  shape (..., 3), e.g. (N, 3) or (M, N, 3).
+
+           Optional argument:
+            | ``out``  --  An output array with the same shape as the argument.
+                           It may be the argument itself.
 
            The return value has the same shape as the argument. This function is
            the inverse of to_fractional.
         """
-        return numpy.dot(fractional, self.matrix.transpose())
+        return _dot_vectors(fractional, self.matrix.transpose(), out)
 
-    def shortest_vector(self, delta):
+    def shortest_vector(self, delta, out=None):
         """Compute the relative vector under periodic boundary conditions.
 
            Argument:
-            | ``delta``  --  the relative vector between two points
+            | ``delta``  --  the relative vector between two points, or an
+                             array with relative vectors with shape (..., 3)
+
+           Optional argument:
+            | ``out``  --  An output array with the same shape as delta. It may
+                           be delta itself.
 
            The return value is not necessarily the shortest possible vector,
            but instead is the vector with fractional coordinates in the range
            [-0.5,0.5[. This is most of the times the shortest vector between
            the two points, but not always. (See commented test.) It is always
-           the shortest vector for orthorombic cells.
+           the shortest vector for orthorombic cells. Use
+           :meth:`minimum_image` to get the shortest vector for any cell.
         """
         fractional = self.to_fractional(delta)
-        fractional = numpy.floor(fractional + 0.5)
-        return delta - self.to_cartesian(fractional)
+        fractional += 0.5
+        numpy.floor(fractional, out=fractional)
+        return numpy.subtract(delta, self.to_cartesian(fractional, fractional), out)
+
+    def wrap(self, cartesian, out=None):
+        """Translate positions into the home cell
+
+           Argument:
+            | ``cartesian``  --  a position or an array with positions with
+                                 shape (..., 3), e.g. a trajectory with shape
+                                 (M, N, 3)
+
+           Optional argument:
+            | ``out``  --  An output array with the same shape as the argument.
+                           Use ``unit_cell.wrap(pos, pos)`` to wrap in place.
+
+           The fractional coordinates of the result are in the range [0,1[
+           along the active cell vectors. The positions are not changed along
+           the inactive cell vectors.
+        """
+        fractional = self.to_fractional(cartesian)
+        numpy.floor(fractional, out=fractional)
+        return numpy.subtract(cartesian, self.to_cartesian(fractional, fractional), out)
+
+    @cached
+    def reduced(self):
+        """An equivalent unit cell with short and nearly orthogonal cell vectors
+
+           The active cell vectors are first reduced with the LLL algorithm.
+           Then each cell vector is replaced by its sum with plus or minus one
+           times any of the other active cell vectors when this makes it
+           shorter, until no cell vector can be shortened this way. For up to
+           three dimensions, this results in a nearly Niggli-reduced basis. The
+           result describes the same lattice with the same orientation. The
+           inactive cell vectors are not changed.
+        """
+        active = self.active_inactive[0]
+        matrix = self.matrix.copy()
+        if len(active) == 0:
+            return self.copy_with(matrix=matrix)
+        basis = _reduce_lll(matrix[:, active].transpose())
+        basis = _reduce_greedy(basis)
+        # keep the orientation of the original cell vectors
+        transformation = self.to_fractional(basis)[:, active]
+        if numpy.linalg.det(transformation) < 0:
+            basis[0] *= -1
+        matrix[:, active] = basis.transpose()
+        return self.copy_with(matrix=matrix)
+
+    def get_optimal_subcell(self, max_spacing):
+        """Return a grid cell with nearly cubic bins that fits the unit cell
+
+           Argument:
+            | ``max_spacing``  --  The largest allowed spacing of the grid cell.
+
+           The grid cell is the reduced cell (see :attr:`reduced`) with each
+           active cell vector divided by the smallest integer that brings the
+           corresponding spacing below max_spacing. The unit cell vectors are
+           integer linear combinations of the grid cell vectors and the
+           reduced cell vectors are integer multiples of them.
+        """
+        if max_spacing <= 0:
+            raise ValueError("The maximum spacing must be strictly positive.")
+        reduced = self.reduced
+        divisions = numpy.ceil(reduced.spacings/max_spacing)
+        divisions[divisions < 1] = 1
+        return reduced/divisions
+
+    @cached
+    def image_shifts(self):
+        """The lattice vectors that may lead to a shorter relative vector
+
+           The first row is always the null vector. The other rows are the
+           Cartesian lattice vectors that must be tried to find the minimum
+           image of a relative vector that is reduced with the method
+           :meth:`shortest_vector` of the reduced cell :attr:`reduced`.
+
+           A lattice vector v can only shorten a relative vector with
+           fractional coordinates in the range [-0.5,0.5[ when the sum of the
+           absolute values of its projections on the (active) cell vectors
+           exceeds the squared norm of v. This also bounds the norm of v by the
+           sum of the lengths of the cell vectors.
+        """
+        image_cell = self.reduced
+        active = self.active_inactive[0]
+        matrix = image_cell.matrix[:, active]
+        radius = numpy.sqrt((matrix**2).sum(axis=0)).sum()
+        ranges = image_cell.get_radius_ranges(radius)
+        grids = numpy.mgrid[
+            -ranges[0]:ranges[0]+1,
+            -ranges[1]:ranges[1]+1,
+            -ranges[2]:ranges[2]+1,
+        ]
+        indexes = grids.reshape((3, -1)).transpose()
+        shifts = numpy.dot(indexes, image_cell.matrix.transpose())
+        norms_sq = (shifts**2).sum(axis=1)
+        projections = abs(numpy.dot(shifts, matrix)).sum(axis=1)
+        mask = (projections > norms_sq*(1+1e-12)) & (norms_sq > 0)
+        shifts = shifts[mask]
+        norms_sq = norms_sq[mask]
+        # sort the shifts by norm to get reproducible results
+        order = numpy.lexsort(shifts.transpose()[::-1])
+        order = order[norms_sq[order].argsort(kind="mergesort")]
+        result = numpy.zeros((len(shifts)+1, 3), float)
+        result[1:] = shifts[order]
+        return result
+
+    def minimum_image(self, delta):
+        """Compute the shortest relative vector under periodic boundary conditions.
+
+           Argument:
+            | ``delta``  --  the relative vector between two points, or an
+                             array with relative vectors with shape (..., 3)
+
+           In contrast to :meth:`shortest_vector`, the result is always the
+           shortest possible vector, also for strongly skewed unit cells. The
+           vectors are first reduced to fractional coordinates in the range
+           [-0.5,0.5[ of an equivalent cell with short cell vectors. Then all
+           lattice vectors in :attr:`image_shifts` are tried for the whole
+           array of relative vectors at once.
+        """
+        delta = self.reduced.shortest_vector(delta)
+        shifts = self.image_shifts
+        if len(shifts) == 1:
+            return delta
+        shape = delta.shape
+        delta = delta.reshape((-1, 3))
+        result = delta.copy()
+        result_norms_sq = (delta**2).sum(axis=1)
+        for shift in shifts[1:]:
+            candidate = delta - shift
+            norms_sq = (candidate**2).sum(axis=1)
+            mask = norms_sq < result_norms_sq
+            result[mask] = candidate[mask]
+            result_norms_sq[mask] = norms_sq[mask]
+        return result.reshape(shape)
 
     def add_cell_vector(self, vector):
         """Returns a new unit cell with an additional cell vector"""
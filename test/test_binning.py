@@ -23,6 +23,7 @@
 
 
 from molmod.binning import *
+from molmod.binning import Binning
 from molmod.unit_cells import UnitCell
 from molmod.units import angstrom, deg
 from molmod.periodic import periodic
@@ -53,7 +54,7 @@ class BinningTestCase(unittest.TestCase):
         for (id0, coord0), (id1, coord1) in iter_pairs():
             delta = coord1 - coord0
             if unit_cell is not None:
-                delta = unit_cell.shortest_vector(delta)
+                delta = unit_cell.minimum_image(delta)
             distance = numpy.linalg.norm(delta)
             if distance < cutoff:
                 num_total += 1
@@ -61,7 +62,7 @@ class BinningTestCase(unittest.TestCase):
                 fast_distance = distances.get(identifier)
                 if fast_distance is None:
                     missing_pairs.append(tuple(identifier) + (distance,))
-                elif fast_distance != distance:
+                elif abs(fast_distance - distance) > 1e-10:
                     wrong_distances.append(tuple(identifier) + (fast_distance, distance))
                 else:
                     num_correct += 1
@@ -188,6 +189,27 @@ class BinningTestCase(unittest.TestCase):
             ]
             self.verify_distances_intra(coordinates, cutoff, distances, unit_cell)
 
+    def test_distances_intra_skewed_periodic(self):
+        for i in xrange(5):
+            # a strongly skewed cell that describes a nearly cubic lattice
+            transformation = numpy.identity(3, int)
+            transformation[numpy.triu_indices(3, 1)] = numpy.random.randint(-3, 4, 3)
+            matrix = numpy.dot(numpy.diag(numpy.random.uniform(4, 6, 3)), transformation)
+            unit_cell = UnitCell(matrix)
+            coordinates = unit_cell.to_cartesian(numpy.random.uniform(0,1,(30,3)))
+            cutoff = numpy.random.uniform(1, 2)
+            for grid in None, unit_cell.get_optimal_subcell(cutoff/2):
+                pair_search = PairSearchIntra(coordinates, cutoff, unit_cell, grid)
+                integer_matrix = pair_search.bins.integer_cell.matrix
+                self.assertEqual(abs(integer_matrix - numpy.diag(numpy.diag(integer_matrix))).max(), 0)
+                self.verify_bins_intra_periodic(pair_search.bins)
+                distances = [
+                    (frozenset([i0, i1]), distance)
+                    for i0, i1, delta, distance
+                    in pair_search
+                ]
+                self.verify_distances_intra(coordinates, cutoff, distances, unit_cell)
+
     def test_distances_inter_random(self):
         for i in xrange(10):
             coordinates0 = numpy.random.uniform(0,5,(20,3))
@@ -224,3 +246,389 @@ class BinningTestCase(unittest.TestCase):
                 in pair_search
             ]
             self.verify_distances_inter(coordinates0, coordinates1, cutoff, distances, unit_cell)
+
+    def test_as_arrays_intra_lau_periodic(self):
+        coordinates = XYZFile("input/lau.xyz").geometries[0]
+        cutoff = periodic.max_radius*2
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([14.59, 12.88, 7.61])*angstrom,
+            numpy.array([ 90.0, 111.0, 90.0])*deg,
+        )
+        pair_search = PairSearchIntra(coordinates, cutoff, unit_cell)
+        i0, i1, delta, distance = pair_search.as_arrays()
+        self.assertEqual(delta.shape, (len(i0), 3))
+        self.assertEqual(distance.shape, (len(i0),))
+        self.assert_((i1 < i0).all())
+        self.assert_((distance <= cutoff).all())
+        self.assert_(abs(numpy.sqrt((delta**2).sum(axis=1)) - distance).max() < 1e-10)
+        distances = [
+            (frozenset([i0[k], i1[k]]), distance[k])
+            for k in xrange(len(i0))
+        ]
+        self.verify_distances_intra(coordinates, cutoff, distances, unit_cell)
+        # the iterator must give the same result
+        for k, (j0, j1, d, dist) in enumerate(pair_search):
+            self.assertEqual(j0, i0[k])
+            self.assertEqual(j1, i1[k])
+            self.assertEqual(dist, distance[k])
+
+    def test_as_arrays_inter_random(self):
+        for i in xrange(10):
+            coordinates0 = numpy.random.uniform(0,5,(20,3))
+            coordinates1 = numpy.random.uniform(0,5,(30,3))
+            cutoff = numpy.random.uniform(1, 6)
+            i0, i1, delta, distance = PairSearchInter(coordinates0, coordinates1, cutoff).as_arrays()
+            self.assert_(abs(coordinates1[i1] - coordinates0[i0] - delta).max() < 1e-10)
+            distances = [
+                ((i0[k], i1[k]), distance[k])
+                for k in xrange(len(i0))
+            ]
+            self.verify_distances_inter(coordinates0, coordinates1, cutoff, distances)
+
+    def test_as_arrays_empty(self):
+        coordinates = numpy.array([[0.0, 0.0, 0.0], [10.0, 0.0, 0.0]])
+        i0, i1, delta, distance = PairSearchIntra(coordinates, 2.0).as_arrays()
+        self.assertEqual(i0.shape, (0,))
+        self.assertEqual(i1.shape, (0,))
+        self.assertEqual(delta.shape, (0, 3))
+        self.assertEqual(distance.shape, (0,))
+        self.assertEqual(len(list(PairSearchIntra(coordinates, 2.0))), 0)
+
+    def check_neighbor_list(self, unit_cell):
+        coordinates = numpy.random.uniform(0,10,(50,3))
+        cutoff = 2.5
+        neighbor_list = NeighborList(cutoff, 1.0, unit_cell)
+        for step in xrange(20):
+            coordinates += numpy.random.uniform(-0.15, 0.15, coordinates.shape)
+            neighbor_list.update(coordinates)
+            i0, i1, delta, distance = neighbor_list.as_arrays()
+            distances = [
+                (frozenset([i0[k], i1[k]]), distance[k])
+                for k in xrange(len(i0))
+            ]
+            self.verify_distances_intra(coordinates, cutoff, distances, unit_cell)
+        self.assert_(neighbor_list.num_builds < 20)
+        self.assert_(neighbor_list.num_builds > 1)
+
+    def test_neighbor_list(self):
+        self.check_neighbor_list(None)
+
+    def test_neighbor_list_periodic(self):
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([10.0, 11.0, 12.0]),
+            numpy.array([ 90.0, 100.0, 80.0])*deg,
+        )
+        self.check_neighbor_list(unit_cell)
+
+    def test_neighbor_list_iter(self):
+        coordinates = numpy.random.uniform(0,5,(20,3))
+        neighbor_list = NeighborList(2.0, 0.5, coordinates=coordinates)
+        self.assertEqual(
+            sorted((i0, i1) for i0, i1, delta, distance in neighbor_list),
+            sorted((i0, i1) for i0, i1, delta, distance in PairSearchIntra(coordinates, 2.0)),
+        )
+
+    def test_neighbor_list_arguments(self):
+        coordinates = numpy.random.uniform(0,5,(20,3))
+        neighbor_list = NeighborList(2.0, 0.0, coordinates=coordinates.tolist())
+        neighbor_list.update(coordinates.tolist())
+        self.assertEqual(
+            sorted((i0, i1) for i0, i1, delta, distance in neighbor_list),
+            sorted((i0, i1) for i0, i1, delta, distance in PairSearchIntra(coordinates, 2.0)),
+        )
+        self.assertRaises(ValueError, NeighborList, 2.0, -0.1)
+
+    def check_cell_list(self, coordinates, cutoff, unit_cell=None):
+        pair_search = PairSearchIntra(coordinates, cutoff, unit_cell)
+        bins = pair_search.bins
+        cell_list = CellList(coordinates, cutoff, bins.grid_cell, bins.integer_cell)
+        # all atoms must be present exactly once
+        indexes = numpy.concatenate([bin for bin_id, bin in cell_list])
+        self.assertEqual(sorted(indexes), range(len(coordinates)))
+        self.assertEqual(cell_list.counts.sum(), len(coordinates))
+        # the contents of the bins must match those of the Binning object
+        for bin_id, bin in cell_list:
+            for i in bin:
+                self.assertEqual(cell_list.bin_ids[i], bin_id)
+        # the surrounding bins must match those of the Binning object
+        key_map = {}
+        for key, bin in bins:
+            key_map[tuple(bin)] = key
+        for bin_id, bin in cell_list:
+            key = key_map[tuple(bin)]
+            surrounding_a = sorted(tuple(other) for other_id, other in cell_list.iter_surrounding(bin_id))
+            surrounding_b = sorted(tuple(other) for other_key, other in bins.iter_surrounding(key))
+            self.assertEqual(surrounding_a, surrounding_b)
+        # all pairs must be found
+        distances = []
+        for bin_id0, bin0 in cell_list:
+            for bin_id1, bin1 in cell_list.iter_surrounding(bin_id0):
+                i0, i1, delta, distance = pair_search._compute_block(coordinates, bin0, coordinates, bin1, True)
+                distances.extend((frozenset([i0[k], i1[k]]), distance[k]) for k in xrange(len(i0)))
+        self.verify_distances_intra(coordinates, cutoff, distances, unit_cell)
+
+    def test_cell_list_random(self):
+        for i in xrange(10):
+            coordinates = numpy.random.uniform(-5,5,(50,3))
+            cutoff = numpy.random.uniform(1, 6)
+            self.check_cell_list(coordinates, cutoff)
+
+    def test_cell_list_lau_periodic(self):
+        coordinates = XYZFile("input/lau.xyz").geometries[0]
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([14.59, 12.88, 7.61])*angstrom,
+            numpy.array([ 90.0, 111.0, 90.0])*deg,
+        )
+        self.check_cell_list(coordinates, periodic.max_radius*2, unit_cell)
+
+    def test_cell_list_random_periodic(self):
+        for i in xrange(10):
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(0,5,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.spacings.min() > 0.5:
+                    break
+            coordinates = unit_cell.to_cartesian(numpy.random.uniform(0,1,(20,3)))*3-unit_cell.matrix.sum(axis=1)
+            self.check_cell_list(coordinates, numpy.random.uniform(1, 6), unit_cell)
+
+    def test_cell_list_empty(self):
+        grid_cell = UnitCell(numpy.identity(3, float))
+        cell_list = CellList(numpy.zeros((0,3), float), 2.0, grid_cell)
+        self.assertEqual(len(list(cell_list)), 0)
+
+    def check_spatial_index(self, coordinates, points, radius, unit_cell=None):
+        index = SpatialIndex(coordinates, unit_cell)
+        indptr, indexes, distances = index.query_radius(points, radius)
+        self.assertEqual(indptr.shape, (len(points)+1,))
+        # brute force
+        all_distances = []
+        for i, point in enumerate(points):
+            delta = coordinates - point
+            if unit_cell is not None:
+                delta = unit_cell.minimum_image(delta)
+            all_distances.append(numpy.sqrt((delta**2).sum(axis=1)))
+            expected = (all_distances[-1] <= radius).nonzero()[0]
+            self.assertEqual(indexes[indptr[i]:indptr[i+1]].tolist(), expected.tolist())
+            self.assert_(numpy.allclose(distances[indptr[i]:indptr[i+1]], all_distances[-1][expected]))
+        # the nearest neighbors
+        k = min(5, len(coordinates))
+        knn_indexes, knn_distances = index.query_knn(points, k)
+        self.assertEqual(knn_indexes.shape, (len(points), k))
+        for i in xrange(len(points)):
+            expected = numpy.sort(all_distances[i])[:k]
+            self.assert_(numpy.allclose(knn_distances[i], expected))
+            self.assert_(numpy.allclose(all_distances[i][knn_indexes[i]], expected))
+
+    def test_spatial_index_random(self):
+        for i in xrange(10):
+            coordinates = numpy.random.uniform(-5,5,(50,3))
+            points = numpy.random.uniform(-7,7,(20,3))
+            self.check_spatial_index(coordinates, points, numpy.random.uniform(1, 6))
+
+    def test_spatial_index_lau_periodic(self):
+        coordinates = XYZFile("input/lau.xyz").geometries[0]
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([14.59, 12.88, 7.61])*angstrom,
+            numpy.array([ 90.0, 111.0, 90.0])*deg,
+        )
+        points = unit_cell.to_cartesian(numpy.random.uniform(-1,2,(20,3)))
+        self.check_spatial_index(coordinates, points, periodic.max_radius*2, unit_cell)
+
+    def test_spatial_index_random_periodic(self):
+        for i in xrange(10):
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(0,5,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.spacings.min() > 0.5:
+                    break
+            coordinates = unit_cell.to_cartesian(numpy.random.uniform(0,1,(20,3)))*3-unit_cell.matrix.sum(axis=1)
+            points = unit_cell.to_cartesian(numpy.random.uniform(-1,2,(10,3)))
+            self.check_spatial_index(coordinates, points, numpy.random.uniform(1, 6), unit_cell)
+
+    def test_spatial_index_chunks(self):
+        coordinates = numpy.random.uniform(-5,5,(50,3))
+        points = numpy.random.uniform(-7,7,(20,3))
+        result_a = SpatialIndex(coordinates).query_radius(points, 3.0)
+        result_b = SpatialIndex(coordinates, chunk_size=3).query_radius(points, 3.0)
+        for a, b in zip(result_a, result_b):
+            self.assertEqual(a.tolist(), b.tolist())
+
+    def test_spatial_index_skewed_grid(self):
+        coordinates = numpy.random.uniform(0,10,(20,3))
+        unit_cell = UnitCell(numpy.identity(3)*10.0)
+        # the unit cell vectors are integer combinations of skewed grid vectors
+        grid = UnitCell(numpy.array([[5.0, 5.0, 0.0], [0.0, 5.0, 0.0], [0.0, 0.0, 5.0]]))
+        PairSearchIntra(coordinates, 3.0, unit_cell, grid)
+        self.assertRaises(ValueError, SpatialIndex, coordinates, unit_cell, grid)
+
+    def test_spatial_index_knn_too_many(self):
+        index = SpatialIndex(numpy.random.uniform(-5,5,(5,3)))
+        self.assertRaises(ValueError, index.query_knn, numpy.zeros((1,3)), 6)
+
+    def check_parallel(self, coordinates, cutoff, unit_cell=None):
+        pair_search = PairSearchIntra(coordinates, cutoff, unit_cell)
+        serial = pair_search.as_arrays()
+        parallel = pair_search.as_arrays(workers=3)
+        for a, b in zip(serial, parallel):
+            self.assertEqual(a.tolist(), b.tolist())
+        # the tasks for the workers do not contain arrays with one row per atom
+        keys = sorted(key for key, bin in pair_search.bins)
+        for part, slab_keys in pair_search._iter_slabs(keys, 4):
+            self.assert_(part.bins.coordinates is None)
+            self.assert_(part.bins._keys is None)
+
+    def test_parallel_random(self):
+        coordinates = numpy.random.uniform(-10,10,(500,3))
+        self.check_parallel(coordinates, 3.0)
+
+    def test_parallel_lau_periodic(self):
+        coordinates = XYZFile("input/lau.xyz").geometries[0]
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([14.59, 12.88, 7.61])*angstrom,
+            numpy.array([ 90.0, 111.0, 90.0])*deg,
+        )
+        self.check_parallel(coordinates, periodic.max_radius*2, unit_cell)
+
+    def check_half_shell(self, coordinates, cutoff, unit_cell=None):
+        bins = PairSearchIntra(coordinates, cutoff, unit_cell).bins
+        full = set()
+        for key0, bin0 in bins:
+            for key1, bin1 in bins.iter_surrounding(key0):
+                if key0 != key1:
+                    full.add(frozenset([key0, key1]))
+        half = []
+        for key0, bin0 in bins:
+            for key1, bin1 in bins.iter_half_surrounding(key0):
+                self.assertNotEqual(key0, key1)
+                half.append(frozenset([key0, key1]))
+        self.assertEqual(len(half), len(set(half)))
+        self.assertEqual(set(half), full)
+
+    def test_half_shell_random(self):
+        for i in xrange(10):
+            coordinates = numpy.random.uniform(-5,5,(50,3))
+            self.check_half_shell(coordinates, numpy.random.uniform(1, 6))
+
+    def test_half_shell_lau_periodic(self):
+        coordinates = XYZFile("input/lau.xyz").geometries[0]
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([14.59, 12.88, 7.61])*angstrom,
+            numpy.array([ 90.0, 111.0, 90.0])*deg,
+        )
+        for cutoff in 2.0, 5.0, 10.0:
+            self.check_half_shell(coordinates, cutoff*angstrom, unit_cell)
+
+    def test_half_shell_random_periodic(self):
+        for i in xrange(10):
+            while True:
+                unit_cell = UnitCell(
+                    numpy.random.uniform(0,5,(3,3)),
+                    numpy.random.randint(0,2,3).astype(bool),
+                )
+                if unit_cell.spacings.min() > 0.5:
+                    break
+            coordinates = unit_cell.to_cartesian(numpy.random.uniform(0,1,(20,3)))*3-unit_cell.matrix.sum(axis=1)
+            self.check_half_shell(coordinates, numpy.random.uniform(1, 6), unit_cell)
+
+    def check_sparse_distance_matrix(self, coordinates, cutoff, unit_cell=None):
+        dm = SparseDistanceMatrix(coordinates, cutoff, unit_cell, deltas=True)
+        size = len(coordinates)
+        # brute force
+        delta = coordinates - coordinates.reshape((-1, 1, 3))
+        if unit_cell is not None:
+            delta = unit_cell.minimum_image(delta)
+        distances = numpy.sqrt((delta**2).sum(axis=2))
+        for i in xrange(size):
+            expected = ((distances[i] <= cutoff) & (numpy.arange(size) != i)).nonzero()[0]
+            indices, data = dm.get_row(i)
+            self.assertEqual(indices.tolist(), expected.tolist())
+            self.assert_(numpy.allclose(data, distances[i, expected]))
+            self.assert_(numpy.allclose(dm.deltas[dm.indptr[i]:dm.indptr[i+1]], delta[i, expected]))
+        self.assertEqual(dm.get_neighbor_counts().sum(), len(dm.data))
+        dense = dm.to_dense(-1)
+        mask = (distances <= cutoff) | numpy.identity(size, bool)
+        self.assert_(numpy.allclose(dense[mask], distances[mask]))
+        self.assert_((dense[~mask] == -1).all())
+        pairs = list(dm.iter_pairs())
+        self.assertEqual(2*len(pairs), len(dm.data))
+        for i, j, distance in pairs:
+            self.assert_(i < j)
+            self.assertAlmostEqual(distance, distances[i, j])
+
+    def test_sparse_distance_matrix_random(self):
+        for i in xrange(10):
+            coordinates = numpy.random.uniform(-5,5,(50,3))
+            self.check_sparse_distance_matrix(coordinates, numpy.random.uniform(1, 6))
+
+    def test_sparse_distance_matrix_lau_periodic(self):
+        coordinates = XYZFile("input/lau.xyz").geometries[0]
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([14.59, 12.88, 7.61])*angstrom,
+            numpy.array([ 90.0, 111.0, 90.0])*deg,
+        )
+        self.check_sparse_distance_matrix(coordinates, periodic.max_radius*2, unit_cell)
+
+    def test_sparse_distance_matrix_empty(self):
+        dm = SparseDistanceMatrix(numpy.zeros((0, 3), float), 2.0)
+        self.assertEqual(dm.indptr.tolist(), [0])
+        self.assertEqual(dm.to_dense().shape, (0, 0))
+
+    def check_update_intra(self, coordinates, cutoff, unit_cell=None):
+        pair_search = PairSearchIntra(coordinates, cutoff, unit_cell)
+        for i in xrange(5):
+            indexes = numpy.random.permutation(len(coordinates))[:5]
+            new_coordinates = coordinates[indexes] + numpy.random.uniform(-2, 2, (5, 3))
+            coordinates = coordinates.copy()
+            coordinates[indexes] = new_coordinates
+            i0, i1, delta, distance = pair_search.update(indexes, new_coordinates)
+            self.assert_((i1 < i0).all())
+            # compare with a new pair search
+            j0, j1, delta_ref, distance_ref = PairSearchIntra(coordinates, cutoff, unit_cell).as_arrays()
+            mask = numpy.in1d(j0, indexes) | numpy.in1d(j1, indexes)
+            expected = dict(((a, b), (d, r)) for a, b, d, r in zip(j0[mask], j1[mask], delta_ref[mask], distance_ref[mask]))
+            self.assertEqual(len(i0), len(expected))
+            for a, b, d, r in zip(i0, i1, delta, distance):
+                self.assert_(numpy.allclose(expected[(a, b)][0], d))
+                self.assertAlmostEqual(expected[(a, b)][1], r)
+            # the binning must be consistent with the new coordinates
+            self.assertEqual(
+                sorted(zip(*pair_search.as_arrays()[:2])),
+                sorted(zip(j0, j1)),
+            )
+
+    def test_update_intra_random(self):
+        coordinates = numpy.random.uniform(-5,5,(50,3))
+        self.check_update_intra(coordinates, 3.0)
+
+    def test_update_intra_lau_periodic(self):
+        coordinates = XYZFile("input/lau.xyz").geometries[0]
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([14.59, 12.88, 7.61])*angstrom,
+            numpy.array([ 90.0, 111.0, 90.0])*deg,
+        )
+        self.check_update_intra(coordinates, periodic.max_radius*2, unit_cell)
+
+    def test_update_inter_random(self):
+        coordinates0 = numpy.random.uniform(-5,5,(30,3))
+        coordinates1 = numpy.random.uniform(-5,5,(30,3))
+        pair_search = PairSearchInter(coordinates0, coordinates1, 3.0)
+        indexes0 = numpy.array([2, 5, 7])
+        indexes1 = numpy.array([1, 5, 20, 21])
+        new0 = numpy.random.uniform(-5,5,(3,3))
+        new1 = numpy.random.uniform(-5,5,(4,3))
+        i0, i1, delta, distance = pair_search.update(indexes0, new0, indexes1, new1)
+        coordinates0 = coordinates0.copy()
+        coordinates0[indexes0] = new0
+        coordinates1 = coordinates1.copy()
+        coordinates1[indexes1] = new1
+        j0, j1, delta_ref, distance_ref = PairSearchInter(coordinates0, coordinates1, 3.0).as_arrays()
+        mask = numpy.in1d(j0, indexes0) | numpy.in1d(j1, indexes1)
+        self.assertEqual(sorted(zip(i0, i1)), sorted(zip(j0[mask], j1[mask])))
+        self.assertEqual(
+            sorted(zip(*pair_search.as_arrays()[:2])),
+            sorted(zip(j0, j1)),
+        )
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from common import BaseTestCase
+
+from molmod.distances import *
+from molmod.molecules import Molecule
+from molmod.similarity import SimilarityDescriptor
+from molmod.unit_cells import UnitCell
+
+import numpy
+
+
+__all__ = ["DistanceMatrixTestCase"]
+
+
+class DistanceMatrixTestCase(BaseTestCase):
+    def get_reference(self, coordinates, unit_cell=None):
+        deltas = coordinates.reshape((-1, 1, 3)) - coordinates
+        if unit_cell is not None:
+            deltas = unit_cell.minimum_image(deltas)
+        return numpy.sqrt((deltas**2).sum(axis=2))
+
+    def check_distance_matrix(self, coordinates, unit_cell=None, methods=["direct", "gram"]):
+        size = len(coordinates)
+        reference = self.get_reference(coordinates, unit_cell)
+        rows, columns = numpy.tril_indices(size, -1)
+        for method in methods:
+            for block_size in 1, 37, 2**20:
+                for workers in 1, 3:
+                    dm = compute_distance_matrix(coordinates, unit_cell, False, block_size, method, workers)
+                    self.assertEqual(dm.shape, (size, size))
+                    self.assert_(abs(dm - reference).max() < 1e-10)
+                    self.assert_((dm == dm.transpose()).all())
+                    self.assert_((dm.diagonal() == 0).all())
+                    condensed = compute_distance_matrix(coordinates, unit_cell, True, block_size, method, workers)
+                    self.assertEqual(condensed.shape, (size*(size-1)/2,))
+                    self.assert_(abs(condensed - reference[rows, columns]).max() < 1e-10)
+
+    def test_random(self):
+        self.check_distance_matrix(numpy.random.uniform(-5, 5, (50, 3)))
+
+    def test_periodic(self):
+        unit_cell = UnitCell(numpy.array([[6.0, 1.0, 0.0], [0.5, 5.0, 0.0], [0.0, 1.5, 7.0]]))
+        coordinates = unit_cell.to_cartesian(numpy.random.uniform(0, 1, (40, 3)))
+        self.check_distance_matrix(coordinates, unit_cell, ["direct"])
+        self.assertRaises(ValueError, compute_distance_matrix, coordinates, unit_cell, method="gram")
+
+    def test_periodic_2d(self):
+        unit_cell = UnitCell(numpy.identity(3)*5.0, numpy.array([True, False, True]))
+        coordinates = numpy.random.uniform(0, 10, (30, 3))
+        self.check_distance_matrix(coordinates, unit_cell, ["direct"])
+
+    def test_small(self):
+        for size in 0, 1, 2:
+            coordinates = numpy.random.uniform(-5, 5, (size, 3))
+            self.assertEqual(compute_distance_matrix(coordinates).shape, (size, size))
+            self.assertEqual(compute_distance_matrix(coordinates, condensed=True).shape, (size*(size-1)/2,))
+
+    def test_molecule(self):
+        unit_cell = UnitCell(numpy.identity(3)*6.0)
+        coordinates = numpy.random.uniform(0, 6, (20, 3))
+        molecule = Molecule(numpy.ones(20, int), coordinates, unit_cell=unit_cell)
+        reference = self.get_reference(coordinates, unit_cell)
+        self.assert_(abs(molecule.distance_matrix - reference).max() < 1e-10)
+        rows, columns = numpy.tril_indices(20, -1)
+        self.assert_(abs(molecule.distance_matrix_condensed() - reference[rows, columns]).max() < 1e-10)
+
+    def test_similarity(self):
+        molecule = Molecule.from_file("input/tpa.xyz")
+        d1 = SimilarityDescriptor(molecule.distance_matrix, molecule.numbers)
+        d2 = SimilarityDescriptor.from_molecule(molecule)
+        self.assert_((d1.table_labels == d2.table_labels).all())
+        self.assert_(abs(d1.table_distances - d2.table_distances).max() < 1e-10)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from common import BaseTestCase
+
+from molmod.formats import *
+from molmod.molecules import Molecule
+
+import shutil
+
+
+__all__ = ["FormatsTestCase"]
+
+
+class FormatsTestCase(BaseTestCase):
+    filenames = [
+        "input/caplayer.cml", "input/1TOH.b3lyp.fchk", "input/il2.pdb",
+        "input/CID_22898828.sdf", "input/water.xyz",
+    ]
+    names = ["cml", "fchk", "pdb", "sdf", "xyz"]
+
+    def test_detect_extension(self):
+        for filename, name in zip(self.filenames, self.names):
+            self.assertEqual(detect_format(filename).name, name)
+
+    def test_detect_contents(self):
+        for filename, name in zip(self.filenames, self.names):
+            # no extension
+            shutil.copy(filename, "output/sniff_%s" % name)
+            self.assertEqual(detect_format("output/sniff_%s" % name).name, name)
+            # a wrong extension
+            shutil.copy(filename, "output/sniff_%s.txt.xyz" % name)
+            self.assertEqual(detect_format("output/sniff_%s.txt.xyz" % name).name, name)
+        molecule = Molecule.from_file("output/sniff_sdf.txt.xyz")
+        self.assertEqual(molecule.size, 14)
+        self.assertRaises(ValueError, detect_format, "input/thf.psf")
+
+    def test_detect_pdb_header(self):
+        # a header as found in files from the RCSB
+        f = file("output/sniff_rcsb", "w")
+        f.write("HEADER    CYTOKINE                                01-JAN-00   1ABC              \n")
+        f.write("TITLE     INTERLEUKIN 2                                                         \n")
+        f.write("COMPND    MOL_ID: 1;                                                            \n")
+        f.write("SOURCE    MOL_ID: 1;                                                            \n")
+        f.write("KEYWDS    CYTOKINE                                                              \n")
+        f.write("EXPDTA    SOLUTION NMR                                                          \n")
+        f.write("AUTHOR    A.AUTHOR                                                              \n")
+        f.write("REVDAT   1   01-JAN-00 1ABC    0                                                \n")
+        f.write("JRNL        AUTH   A.AUTHOR                                                     \n")
+        f.write("SEQRES   1 A  133  ALA PRO THR SER SER SER THR LYS LYS THR GLN LEU GLN          \n")
+        f.write("HELIX    1   1 SER A    6  LEU A   19  1                                  14    \n")
+        f.write(file("input/il2.pdb").read())
+        f.close()
+        self.assertEqual(detect_format("output/sniff_rcsb").name, "pdb")
+
+    def test_no_molfile_extension(self):
+        # a *.mol file is only recognized by its contents
+        self.assertEqual(get_format("sdf").extensions, (".sdf",))
+
+    def test_load_molecule(self):
+        molecule = load_molecule("input/water.xyz", format="xyz")
+        self.assertEqual(molecule.symbols, ("O", "H", "H"))
+        self.assertRaises(ValueError, load_molecule, "input/water.xyz", format="foo")
+
+    def test_register_format(self):
+        def load(filename):
+            return Molecule([1], [[0.0, 0.0, 0.0]], title=filename)
+        register_format("dummy", [".dummy"], load)
+        try:
+            self.assertEqual(load_molecule("foo.dummy").title, "foo.dummy")
+            self.assertEqual(get_format("dummy").extensions, (".dummy",))
+        finally:
+            import molmod.formats
+            molmod.formats._formats.remove(get_format("dummy"))
+
+    def test_load_many(self):
+        filenames = self.filenames*3
+        expected = [Molecule.from_file(filename) for filename in filenames]
+        for workers in 1, 2:
+            molecules = list(load_many(filenames, workers=workers, chunk_size=2))
+            self.assertEqual(len(molecules), len(expected))
+            for molecule, reference in zip(molecules, expected):
+                self.assertArraysEqual(molecule.numbers, reference.numbers)
+                self.assertArraysAlmostEqual(molecule.coordinates, reference.coordinates)
+        self.assertRaises(ValueError, list, load_many(filenames, workers=0))
@@ -289,6 +289,22 @@ class GraphTestCase(unittest.TestCase):
         self.assertEqual(expecting.shape,graph.distances.shape)
         self.assert_((expecting==graph.distances).all())
 
+    def test_edge_array(self):
+        for case in self.iter_cases():
+            graph = case.graph
+            self.assertEqual(graph.edge_array.shape, (graph.num_edges, 2))
+            other = Graph(graph.edge_array, graph.num_vertices)
+            self.assertEqual(other.edges, graph.edges)
+            self.assertEqual(other.num_vertices, graph.num_vertices)
+            tripled = graph*3
+            self.assertEqual(tripled.num_edges, 3*graph.num_edges)
+            for i, j in graph.edges:
+                self.assert_(frozenset([i+2*graph.num_vertices, j+2*graph.num_vertices]) in tripled.edge_index)
+        self.assertRaises(ValueError, Graph, numpy.array([[0, 1], [2, 2]]))
+        self.assertRaises(TypeError, Graph, numpy.array([[0, 1], [-1, 2]]))
+        self.assertRaises(TypeError, Graph, numpy.array([[0.0, 1.0]]))
+        self.assertEqual(Graph(numpy.zeros(0, int)).num_vertices, 0)
+
     def test_neighbors(self):
         for case in self.iter_cases():
             g = case.graph
@@ -362,6 +362,9 @@ class MolecularGraphTestCase(unittest.TestCase):
             self.assert_((check.numbers==check_numbers).all())
             self.assertEqual(check.orders.shape,check_orders.shape)
             self.assert_((check.orders==check_orders).all())
+        # fractional bond orders are not truncated
+        mgraph = MolecularGraph(edges, numbers, [1.5, 1.5, 1.5, 1.5])
+        self.assert_(((mgraph*2).orders == 1.5).all())
 
     def test_fingerprints(self):
         for mol in self.iter_molecules():
@@ -31,7 +31,7 @@ from molmod.units import angstrom, deg
 import unittest, numpy
 
 
-__all__ = ["MoleculeTestCase"]
+__all__ = ["MoleculeTestCase", "MoleculeEnsembleTestCase"]
 
 
 class MoleculeTestCase(BaseTestCase):
@@ -43,6 +43,15 @@ class MoleculeTestCase(BaseTestCase):
         dm = numpy.sqrt(dm)
         self.assert_((abs(molecule.distance_matrix - dm) < 1e-5).all(), "Wrong distance matrix")
 
+    def test_distance_matrix_large(self):
+        # also exact for large systems with nearly coincident atoms
+        coordinates = numpy.random.uniform(-20, 20, (600, 3))
+        coordinates[1] = coordinates[0] + [1e-7, 0.0, 0.0]
+        molecule = Molecule(numpy.ones(600, int), coordinates)
+        self.assertEqual(molecule.distance_matrix[0, 1], coordinates[1, 0] - coordinates[0, 0])
+        deltas = coordinates[:50].reshape((-1, 1, 3)) - coordinates
+        self.assertArraysEqual(molecule.distance_matrix[:50], numpy.sqrt((deltas**2).sum(axis=2)))
+
     def test_distance_matrix_periodic(self):
         for i in xrange(1000):
             N = 6
@@ -62,6 +71,13 @@ class MoleculeTestCase(BaseTestCase):
                     distance = numpy.linalg.norm(delta)
                     self.assertAlmostEqual(dm[i,j], distance)
 
+    def test_distance_matrix_sparse(self):
+        molecule = Molecule.from_file("input/tpa.xyz")
+        cutoff = 3*angstrom
+        dm = molecule.distance_matrix_sparse(cutoff)
+        dense = molecule.distance_matrix
+        self.assert_(abs(dm.to_dense() - dense*(dense <= cutoff)).max() < 1e-10)
+
     def test_read_only(self):
         numbers = [8, 1]
         coordinates = [
@@ -104,6 +120,62 @@ class MoleculeTestCase(BaseTestCase):
         )
         self.assertArraysAlmostEqual(molecule.inertia_tensor, expected_result)
 
+    def test_batch_properties(self):
+        from molmod.io import XYZFile
+        from molmod.periodic import periodic
+        xyz_file = XYZFile("input/dopamine.xyz")
+        masses = numpy.array([periodic[n].mass for n in xyz_file.numbers])
+        # a trajectory with random perturbations of the geometry
+        geometries = xyz_file.geometries + numpy.random.normal(0, 0.1, (6, len(masses), 3))
+        coms = compute_coms(geometries, masses)
+        tensors = compute_inertia_tensors(geometries, masses)
+        moments = compute_principal_moments(geometries, masses)
+        radii = compute_radii_of_gyration(geometries, masses)
+        self.assertEqual(coms.shape, (len(geometries), 3))
+        self.assertEqual(tensors.shape, (len(geometries), 3, 3))
+        for i in xrange(len(geometries)):
+            molecule = Molecule(xyz_file.numbers, geometries[i], masses=masses)
+            self.assertArraysAlmostEqual(coms[i], molecule.com)
+            self.assertArraysAlmostEqual(tensors[i], molecule.inertia_tensor)
+            self.assertArraysAlmostEqual(moments[i], numpy.linalg.eigvalsh(molecule.inertia_tensor))
+            relative = molecule.coordinates - molecule.com
+            expected = numpy.sqrt((masses*(relative**2).sum(axis=1)).sum()/molecule.mass)
+            self.assertAlmostEqual(radii[i], expected)
+        # chunks and single geometries
+        self.assertArraysAlmostEqual(compute_inertia_tensors(geometries, masses, chunk_size=3), tensors)
+        self.assertArraysAlmostEqual(compute_radii_of_gyration(geometries, masses, 2), radii)
+        self.assertArraysAlmostEqual(compute_coms(geometries[1], masses), coms[1])
+        self.assertAlmostEqual(compute_radii_of_gyration(geometries[1], masses), radii[1])
+        self.assertRaises(TypeError, compute_coms, geometries.ravel(), masses)
+
+    def test_supercell(self):
+        molecule = Molecule.from_file("input/lau.xyz")
+        uc = UnitCell.from_parameters3(
+            numpy.array([14.587, 12.877, 7.613])*angstrom,
+            numpy.array([90.000, 111.159, 90.000])*deg
+        )
+        molecule = molecule.copy_with(unit_cell=uc.alignment_c*uc)
+        molecule.set_default_graph()
+        molecule.set_default_masses()
+        supercell = make_supercell(molecule, (2, 1, 3))
+        self.assertEqual(supercell.size, 6*molecule.size)
+        self.assertArraysAlmostEqual(supercell.unit_cell.matrix, molecule.unit_cell.matrix*[2, 1, 3])
+        self.assertArraysEqual(supercell.numbers[molecule.size:2*molecule.size], molecule.numbers)
+        self.assertAlmostEqual(supercell.mass, 6*molecule.mass)
+        # the second image is shifted along the third cell vector
+        self.assertArraysAlmostEqual(
+            supercell.coordinates[molecule.size:2*molecule.size],
+            molecule.coordinates + molecule.unit_cell.matrix[:,2]
+        )
+        # the bonds, including those that cross the cell boundaries, must be
+        # the same as those derived from the geometry of the supercell
+        self.assertEqual(supercell.graph.num_edges, 6*molecule.graph.num_edges)
+        reference = supercell.copy_with(graph=None)
+        reference.set_default_graph()
+        self.assertEqual(set(supercell.graph.edges), set(reference.graph.edges))
+        self.assertRaises(ValueError, make_supercell, molecule, (0, 1, 1))
+        self.assertRaises(ValueError, make_supercell, molecule.copy_with(unit_cell=None), (1, 1, 1))
+
     def test_chemical_formula(self):
         molecule = Molecule.from_file("input/water.xyz")
         self.assertEqual(molecule.chemical_formula, "OH2")
@@ -201,3 +273,84 @@ class MoleculeTestCase(BaseTestCase):
         mol1.write_to_file("output/probes.xyz")
         mol2 = Molecule.from_file("input/probes.xyz")
         self.assertArraysEqual(mol1.numbers, mol2.numbers)
+
+
+class MoleculeEnsembleTestCase(BaseTestCase):
+    def get_ensemble(self, size=6):
+        from molmod.io import XYZFile
+        xyz_file = XYZFile("input/dopamine.xyz")
+        geometries = xyz_file.geometries + numpy.random.normal(0, 0.1, (size, len(xyz_file.numbers), 3))
+        titles = ["frame %i" % i for i in xrange(size)]
+        energies = numpy.random.uniform(0, 1, size)
+        ensemble = MoleculeEnsemble(xyz_file.numbers, geometries, titles, energies)
+        ensemble.set_default_masses()
+        ensemble.set_default_symbols()
+        return ensemble
+
+    def test_frames(self):
+        ensemble = self.get_ensemble()
+        self.assertEqual(len(ensemble), 6)
+        self.assertEqual(ensemble.geometries.shape, (6, ensemble.size, 3))
+        for i, molecule in enumerate(ensemble):
+            self.assert_(isinstance(molecule, Molecule))
+            self.assertEqual(molecule.title, "frame %i" % i)
+            self.assertArraysEqual(molecule.coordinates, ensemble.geometries[i])
+            # the frames share the memory of the ensemble
+            self.assert_(numpy.may_share_memory(molecule.coordinates, ensemble.geometries))
+            self.assert_(numpy.may_share_memory(molecule.masses, ensemble.masses))
+            self.assertEqual(molecule.symbols, ensemble.symbols)
+        self.assertArraysEqual(ensemble[-1].coordinates, ensemble.geometries[5])
+        self.assertRaises(IndexError, ensemble.__getitem__, 6)
+        try:
+            ensemble[0].coordinates[0,0] = 5.0
+            self.fail("Should have raised an error")
+        except (RuntimeError, ValueError):
+            pass
+
+    def test_subset(self):
+        ensemble = self.get_ensemble()
+        subset = ensemble[1:5:2]
+        self.assert_(isinstance(subset, MoleculeEnsemble))
+        self.assertEqual(len(subset), 2)
+        self.assertEqual(subset.titles, ("frame 1", "frame 3"))
+        self.assertArraysEqual(subset.energies, ensemble.energies[1:5:2])
+        self.assert_(numpy.may_share_memory(subset.geometries, ensemble.geometries))
+        subset = ensemble[numpy.array([4, 0])]
+        self.assertEqual(subset.titles, ("frame 4", "frame 0"))
+        self.assertArraysEqual(subset.geometries[1], ensemble.geometries[0])
+
+    def test_bulk_properties(self):
+        ensemble = self.get_ensemble()
+        for i, molecule in enumerate(ensemble):
+            self.assertArraysAlmostEqual(ensemble.coms[i], molecule.com)
+            self.assertArraysAlmostEqual(ensemble.inertia_tensors[i], molecule.inertia_tensor)
+        self.assertArraysAlmostEqual(ensemble.principal_moments, compute_principal_moments(ensemble.geometries, ensemble.masses))
+        self.assertArraysAlmostEqual(ensemble.radii_of_gyration, compute_radii_of_gyration(ensemble.geometries, ensemble.masses))
+        self.assertAlmostEqual(ensemble.mass, ensemble[0].mass)
+
+    def test_rmsds(self):
+        ensemble = self.get_ensemble()
+        reference = ensemble[2]
+        rmsds = ensemble.compute_rmsds(reference)
+        for i, molecule in enumerate(ensemble):
+            self.assertAlmostEqual(rmsds[i], reference.rmsd(molecule)[2], 6)
+        self.assertArraysAlmostEqual(ensemble.compute_rmsds(reference.coordinates, chunk_size=4), rmsds)
+        self.assertAlmostEqual(rmsds[2], 0.0, 6)
+
+    def test_from_molecules(self):
+        ensemble = self.get_ensemble(3)
+        other = MoleculeEnsemble.from_molecules(list(ensemble), ensemble.energies)
+        self.assertArraysEqual(other.geometries, ensemble.geometries)
+        self.assertArraysEqual(other.masses, ensemble.masses)
+        self.assertEqual(other.titles, ensemble.titles)
+        molecule = Molecule.from_file("input/water.xyz")
+        self.assertRaises(ValueError, MoleculeEnsemble.from_molecules, [ensemble[0], molecule])
+        self.assertRaises(TypeError, MoleculeEnsemble, ensemble.numbers, ensemble.geometries, ["a"])
+
+    def test_file(self):
+        ensemble = self.get_ensemble(3)
+        ensemble.write_to_file("output/ensemble.xyz")
+        other = MoleculeEnsemble.from_file("output/ensemble.xyz")
+        self.assertEqual(other.titles, ensemble.titles)
+        self.assertArraysEqual(other.numbers, ensemble.numbers)
+        self.assertArraysAlmostEqual(other.geometries, ensemble.geometries)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from common import BaseTestCase
+
+from molmod.multipole import *
+from molmod.pairff import CoulombFF
+
+import numpy
+
+
+__all__ = ["MultipoleTreeTestCase"]
+
+
+class MultipoleTreeTestCase(BaseTestCase):
+    def make_cluster(self, size=500, do_charges=True, do_dipoles=True):
+        coordinates = numpy.random.uniform(-10, 10, (size, 3))
+        charges = numpy.random.uniform(-1, 1, size) if do_charges else None
+        dipoles = numpy.random.uniform(-0.5, 0.5, (size, 3)) if do_dipoles else None
+        return coordinates, charges, dipoles
+
+    def get_direct(self, coordinates, charges, dipoles, points):
+        # reference values with the direct sum of CoulombFF
+        ff = CoulombFF(numpy.ones((len(coordinates), len(coordinates))), charges, dipoles, coordinates)
+        esp = numpy.array([ff.esp_point(point) for point in points])
+        efield = numpy.array([ff.efield_point(point) for point in points])
+        return esp, efield
+
+    def check_accuracy(self, do_charges, do_dipoles):
+        coordinates, charges, dipoles = self.make_cluster(500, do_charges, do_dipoles)
+        points = numpy.random.uniform(-20, 20, (50, 3))
+        esp_direct, efield_direct = self.get_direct(coordinates, charges, dipoles, points)
+        errors = []
+        for theta in 0.3, 0.1:
+            tree = MultipoleTree(coordinates, charges, dipoles, theta, leaf_size=8)
+            esp, efield = tree.esp_efield(points)
+            self.assertArraysAlmostEqual(esp, tree.esp(points))
+            self.assertArraysAlmostEqual(efield, tree.efield(points))
+            # relative root-mean-square errors
+            error = numpy.sqrt(((esp - esp_direct)**2).sum()/(esp_direct**2).sum())
+            self.assert_(error < 3*theta**2)
+            error = numpy.sqrt(((efield - efield_direct)**2).sum()/(efield_direct**2).sum())
+            self.assert_(error < 3*theta**2)
+            errors.append(error)
+        # the error must decrease with the opening angle
+        self.assert_(errors[0] > errors[1])
+
+    def test_accuracy_c(self):
+        self.check_accuracy(True, False)
+
+    def test_accuracy_d(self):
+        self.check_accuracy(False, True)
+
+    def test_accuracy_cd(self):
+        self.check_accuracy(True, True)
+
+    def test_exact(self):
+        coordinates, charges, dipoles = self.make_cluster(100)
+        points = numpy.random.uniform(-15, 15, (20, 3))
+        esp_direct, efield_direct = self.get_direct(coordinates, charges, dipoles, points)
+        tree = MultipoleTree(coordinates, charges, dipoles, 0.0, leaf_size=4)
+        self.assertArraysAlmostEqual(tree.esp(points), esp_direct, 1e-10)
+        self.assertArraysAlmostEqual(tree.efield(points), efield_direct, 1e-10)
+        # single points
+        self.assertAlmostEqual(tree.esp(points[0]), esp_direct[0])
+        self.assertArraysAlmostEqual(tree.efield(points[0]), efield_direct[0], 1e-10)
+
+    def test_far_field(self):
+        # the multipole expansion of the root is exact up to the quadrupole
+        coordinates, charges, dipoles = self.make_cluster(20)
+        points = numpy.random.normal(0, 1, (10, 3))
+        points *= 1e4/numpy.sqrt((points**2).sum(axis=1)).reshape((-1, 1))
+        esp_direct, efield_direct = self.get_direct(coordinates, charges, dipoles, points)
+        tree = MultipoleTree(coordinates, charges, dipoles, 1.0)
+        self.assertArraysAlmostEqual(tree.esp(points), esp_direct, 1e-6)
+        self.assertArraysAlmostEqual(tree.efield(points), efield_direct, 1e-6)
+
+    def test_atom_positions(self):
+        # atoms that coincide with a point are excluded
+        coordinates, charges, dipoles = self.make_cluster(50)
+        ff = CoulombFF(numpy.ones((50, 50)) - numpy.identity(50), charges, dipoles, coordinates)
+        tree = ff.get_multipole_tree(0.0)
+        self.assertArraysAlmostEqual(tree.esp(coordinates), ff.esp(), 1e-10)
+        self.assertArraysAlmostEqual(tree.efield(coordinates), ff.efield(), 1e-10)
+
+    def test_errors(self):
+        coordinates = numpy.random.uniform(-1, 1, (10, 3))
+        self.assertRaises(ValueError, MultipoleTree, coordinates)
+        self.assertRaises(ValueError, MultipoleTree, coordinates, numpy.ones(10), theta=-1.0)
+        self.assertRaises(TypeError, MultipoleTree, coordinates, numpy.ones(9))
+
+    def test_empty(self):
+        tree = MultipoleTree(numpy.zeros((0, 3)), numpy.zeros(0), numpy.zeros((0, 3)))
+        points = numpy.random.uniform(-1, 1, (5, 3))
+        self.assertArraysEqual(tree.esp(points), numpy.zeros(5))
+        self.assertArraysEqual(tree.efield(points), numpy.zeros((5, 3)))
+        self.assertEqual(tree.esp(points[0]), 0.0)
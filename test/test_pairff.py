@@ -29,7 +29,10 @@ import molmod.pairff
 import unittest, numpy as np
 
 
-__all__ = ["PairFFTestCase", "CoulombFFTestCase"]
+__all__ = [
+    "PairFFTestCase", "CoulombFFTestCase", "SparsePairFFTestCase",
+    "EwaldCoulombFFTestCase", "CompositeFFTestCase", "TabulatedFFTestCase",
+]
 
 
 class Debug1FF(molmod.pairff.PairFF):
@@ -173,6 +176,16 @@ class PairFFTestCase(unittest.TestCase):
     def test_exprepff(self):
         self.check_ff(self.make_exprepff())
 
+    def make_tabulatedff(self, make_ff):
+        analytic = make_ff()
+        return molmod.pairff.TabulatedFF(analytic, [0, 1, 2], 0.5, 5.0, 2000, analytic.coordinates)
+
+    def test_tabulatedff(self):
+        for make_ff in self.make_dispersionff, self.make_pauliff, self.make_exprepff:
+            ff = self.make_tabulatedff(make_ff)
+            self.check_ff(ff)
+            self.check_arrays(ff)
+
     def make_debug1ff(self):
         coordinates = np.array([
             [ 0.5, 2.5, 0.1],
@@ -382,6 +395,45 @@ class PairFFTestCase(unittest.TestCase):
         self.assertAlmostEqual(error, 0.0, 3, "2b) The off-diagonal blocks of the analytical hessian are incorrect: % 12.8f / %12.8f" % (error, reference))
 
 
+    def check_arrays(self, ff):
+        # compare the array methods with the methods for a single pair
+        index1, index2 = (1 - np.identity(ff.numc)).nonzero()
+        deltas = ff.deltas[index1, index2]
+        distances = ff.distances[index1, index2]
+        for name in "energy", "gradient", "hessian":
+            array_method = getattr(ff, "yield_pair_%s_arrays" % name)
+            pair_method = getattr(molmod.pairff.PairFF, "yield_pair_%s_arrays" % name)
+            for (s1, v1), (s2, v2) in zip(
+                array_method(index1, index2, deltas, distances),
+                pair_method(ff, index1, index2, deltas, distances),
+            ):
+                self.assert_(abs(s1 - s2).max() < 1e-10)
+                self.assert_(abs(v1 - v2).max() < 1e-10)
+        # the results must not depend on the chunk size
+        energy = ff.energy()
+        gradient = ff.gradient()
+        hessian = ff.hessian()
+        ff.chunk_size = 2
+        self.assertAlmostEqual(ff.energy(), energy)
+        self.assert_(abs(ff.gradient() - gradient).max() < 1e-10)
+        self.assert_(abs(ff.hessian() - hessian).max() < 1e-10)
+        for index in xrange(ff.numc):
+            self.assert_(abs(ff.gradient_component(index) - gradient[index]).max() < 1e-10)
+        # hessian-vector products
+        vector = np.random.normal(0, 1, (ff.numc, 3))
+        expected = np.dot(hessian.reshape((ff.numc*3, -1)), vector.ravel())
+        self.assert_(abs(ff.hessian_dot(vector).ravel() - expected).max() < 1e-10)
+        self.assert_(abs(ff.hessian_dot(vector.ravel()) - expected).max() < 1e-10)
+
+    def test_arrays(self):
+        self.check_arrays(self.make_coulombff(do_charges=True,  do_dipoles=False))
+        self.check_arrays(self.make_coulombff(do_charges=False, do_dipoles=True))
+        self.check_arrays(self.make_coulombff(do_charges=True,  do_dipoles=True))
+        self.check_arrays(self.make_dispersionff())
+        self.check_arrays(self.make_pauliff())
+        self.check_arrays(self.make_exprepff())
+
+
 class CoulombFFTestCase(BaseTestCase):
     def test_cc1(self):
         coordinates = np.array([
@@ -529,3 +581,372 @@ class CoulombFFTestCase(BaseTestCase):
         ff2 = molmod.pairff.CoulombFF(scaling, charges=charges, dipoles=dipoles, coordinates=coordinates)
         self.assertArraysAlmostEqual(ff1.gradient()[0], -ff1.efield()[0])
         self.assertArraysAlmostEqual(ff1.gradient()[0], -ff2.efield_point(point))
+
+    def make_random_ff(self, size=20):
+        coordinates = np.random.uniform(-3, 3, (size, 3))
+        charges = np.random.uniform(-1, 1, size)
+        dipoles = np.random.uniform(-1, 1, (size, 3))
+        scaling = 1 - np.identity(size, float)
+        return molmod.pairff.CoulombFF(scaling, charges, dipoles, coordinates)
+
+    def test_esp_grid(self):
+        ff = self.make_random_ff()
+        points = np.random.uniform(-5, 5, (4, 5, 3))
+        expected = np.array([ff.esp_point(point) for point in points.reshape((-1, 3))])
+        self.assertArraysAlmostEqual(ff.esp_grid(points), expected.reshape((4, 5)), 1e-10)
+        approx = ff.esp_grid(points, theta=0.3)
+        self.assertArraysAlmostEqual(approx, expected.reshape((4, 5)), 1e-1)
+        ff.chunk_size = 7
+        self.assertArraysAlmostEqual(ff.esp_grid(points[0]), expected[:5], 1e-10)
+
+    def test_efield_grid(self):
+        ff = self.make_random_ff()
+        points = np.random.uniform(-5, 5, (30, 3))
+        expected = np.array([ff.efield_point(point) for point in points])
+        self.assertArraysAlmostEqual(ff.efield_grid(points), expected, 1e-10)
+
+    def test_esp_grid_cube_spec(self):
+        from molmod.io.cube import get_cube_points
+        ff = self.make_random_ff()
+        origin = np.array([-5.0, -4.0, -6.0])
+        axes = np.identity(3)*1.5
+        nrep = np.array([3, 4, 5])
+        points = get_cube_points(origin, axes, nrep)
+        esp = ff.esp_grid(origin=origin, axes=axes, nrep=nrep)
+        self.assertEqual(esp.shape, (3, 4, 5))
+        self.assertArraysAlmostEqual(esp, ff.esp_grid(points))
+        self.assertRaises(TypeError, ff.esp_grid, points, origin)
+        self.assertRaises(TypeError, ff.esp_grid, origin=origin, axes=axes)
+
+    def test_esp_cube(self):
+        from molmod import Molecule
+        ff = self.make_random_ff()
+        molecule = Molecule(np.ones(20, int), ff.coordinates, title="random")
+        origin = np.array([-5.0, -4.0, -6.0])
+        axes = np.identity(3)*1.5
+        nrep = np.array([3, 4, 5])
+        cube = ff.esp_cube(molecule, origin, axes, nrep)
+        self.assertArraysAlmostEqual(cube.data, ff.esp_grid(cube.get_points()))
+        cube.write_to_file("output/esp.cube")
+
+
+class SparsePairFFTestCase(BaseTestCase):
+    def make_ffs(self, cutoff, factors, unit_cell=None, skin=0.0):
+        size = 40
+        coordinates = np.random.uniform(0, 8, (size, 3))
+        atom_strengths = np.random.uniform(0.5, 1.0, size)
+        strengths = np.outer(atom_strengths, atom_strengths)
+        charges = np.random.uniform(-1, 1, size)
+        dipoles = np.random.uniform(-1, 1, (size, 3))
+        # dense reference with the same interacting pairs
+        deltas = coordinates.reshape((-1, 1, 3)) - coordinates
+        if unit_cell is not None:
+            deltas = unit_cell.minimum_image(deltas)
+        distances = np.sqrt((deltas**2).sum(axis=2))
+        scaling = (distances <= cutoff).astype(float)
+        for (i, j), factor in factors.iteritems():
+            scaling[i, j] *= factor
+            scaling[j, i] *= factor
+        sparse_scaling = molmod.pairff.CutoffScaling(cutoff, factors, unit_cell, skin)
+        return [
+            (
+                molmod.pairff.DispersionFF(scaling.copy(), strengths, coordinates),
+                molmod.pairff.DispersionFF(sparse_scaling, strengths, coordinates),
+            ),
+            (
+                molmod.pairff.CoulombFF(scaling.copy(), charges, dipoles, coordinates),
+                molmod.pairff.CoulombFF(sparse_scaling, charges, dipoles, coordinates),
+            ),
+        ]
+
+    def test_compare_dense(self):
+        factors = {(0, 1): 0.0, (5, 3): 0.5, (7, 9): 0.0, (2, 12): 0.3}
+        for dense, sparse in self.make_ffs(3.0, factors):
+            self.assertAlmostEqual(dense.energy(), sparse.energy())
+            self.assertArraysAlmostEqual(dense.gradient(), sparse.gradient(), 1e-10)
+            self.assertArraysAlmostEqual(dense.hessian(), sparse.hessian(), 1e-10)
+            vector = np.random.normal(0, 1, dense.coordinates.shape)
+            self.assertArraysAlmostEqual(dense.hessian_dot(vector), sparse.hessian_dot(vector), 1e-10)
+            for index in 0, 5, 10:
+                self.assertArraysAlmostEqual(dense.gradient_component(index), sparse.gradient_component(index), 1e-8, doabs=True)
+                self.assertArraysAlmostEqual(dense.hessian_component(index, index), sparse.hessian_component(index, index), 1e-8, doabs=True)
+                self.assertArraysAlmostEqual(dense.hessian_component(index, 3), sparse.hessian_component(index, 3), 1e-8, doabs=True)
+
+    def test_esp_efield(self):
+        factors = {(0, 1): 0.0, (5, 3): 0.5}
+        dense, sparse = self.make_ffs(3.0, factors)[1]
+        self.assertArraysAlmostEqual(dense.esp(), sparse.esp(), 1e-10)
+        self.assertArraysAlmostEqual(dense.efield(), sparse.efield(), 1e-10)
+        for index in 0, 5, 10:
+            self.assertAlmostEqual(dense.esp_component(index), sparse.esp_component(index))
+            self.assertArraysAlmostEqual(dense.efield_component(index), sparse.efield_component(index), 1e-10, doabs=True)
+
+    def test_periodic(self):
+        from molmod.unit_cells import UnitCell
+        unit_cell = UnitCell(np.identity(3)*8.0)
+        dense, sparse = self.make_ffs(3.5, {}, unit_cell)[0]
+        # compute the reference energy with the minimum image convention
+        deltas = dense.coordinates.reshape((-1, 1, 3)) - dense.coordinates
+        deltas = unit_cell.minimum_image(deltas)
+        distances = np.sqrt((deltas**2).sum(axis=2))
+        mask = np.tril(distances <= 3.5, -1)
+        expected = (dense.strengths[mask]*distances[mask]**(-6)).sum()
+        self.assertAlmostEqual(sparse.energy(), expected)
+
+    def test_update(self):
+        dense, sparse = self.make_ffs(3.0, {}, skin=0.5)[0]
+        for i in xrange(3):
+            coordinates = sparse.coordinates + np.random.uniform(-0.1, 0.1, sparse.coordinates.shape)
+            sparse.update_coordinates(coordinates)
+            distances = np.sqrt(((coordinates.reshape((-1, 1, 3)) - coordinates)**2).sum(axis=2))
+            mask = np.tril(distances <= 3.0, -1)
+            expected = (sparse.strengths[mask]*distances[mask]**(-6)).sum()
+            self.assertAlmostEqual(sparse.energy(), expected)
+
+    def test_factors(self):
+        scaling = molmod.pairff.CutoffScaling(1.0, {(3, 1): 0.5, frozenset([2, 7]): 0.0})
+        factors = scaling.get_factors(np.array([1, 3, 7, 2, 5]), np.array([3, 1, 2, 4, 6]))
+        self.assertArraysEqual(factors, np.array([0.5, 0.5, 0.0, 1.0, 1.0]))
+
+
+class CompositeFFTestCase(BaseTestCase):
+    def make_parameters(self, size):
+        charges = np.random.uniform(-1, 1, size)
+        dipoles = np.random.uniform(-1, 1, (size, 3))
+        atom_strengths = np.random.uniform(0.5, 1.0, size)
+        strengths = np.outer(atom_strengths, atom_strengths)
+        atom_As = np.random.uniform(0.5, 1.0, size)
+        As = np.sqrt(np.outer(atom_As, atom_As))
+        atom_Bs = np.random.uniform(0.1, 0.3, size)
+        Bs = 0.5*np.add.outer(atom_Bs, atom_Bs)
+        return charges, dipoles, strengths, As, Bs
+
+    def make_terms(self, parameters, make_scaling):
+        charges, dipoles, strengths, As, Bs = parameters
+        return [
+            molmod.pairff.CoulombFF(make_scaling(0), charges, dipoles),
+            molmod.pairff.DispersionFF(make_scaling(1), strengths),
+            molmod.pairff.ExpRepFF(make_scaling(2), As, Bs),
+        ]
+
+    def check_composite(self, composite, terms, coordinates):
+        for term in terms:
+            term.update_coordinates(coordinates)
+        self.assertAlmostEqual(composite.energy(), sum(term.energy() for term in terms))
+        expected = sum(term.gradient() for term in terms)
+        self.assertArraysAlmostEqual(composite.gradient(), expected, 1e-10)
+        for index in 0, 3:
+            self.assertArraysAlmostEqual(composite.gradient_component(index), expected[index], 1e-6, doabs=True)
+        expected = sum(term.hessian() for term in terms)
+        self.assertArraysAlmostEqual(composite.hessian(), expected, 1e-10)
+        self.assertArraysAlmostEqual(composite.hessian_component(1, 2), expected[1,:,2,:], 1e-6, doabs=True)
+        vector = np.random.normal(0, 1, coordinates.shape)
+        expected = sum(term.hessian_dot(vector) for term in terms)
+        self.assertArraysAlmostEqual(composite.hessian_dot(vector), expected, 1e-10)
+
+    def test_dense(self):
+        size = 10
+        coordinates = np.random.uniform(0, 5, (size, 3))
+        scalings = []
+        for i in xrange(3):
+            scaling = np.random.uniform(0, 1, (size, size))
+            scaling = scaling + scaling.transpose()
+            scaling[scaling < 0.7] = 0.0
+            scalings.append(scaling)
+        parameters = self.make_parameters(size)
+        terms = self.make_terms(parameters, lambda i: scalings[i].copy())
+        composite = molmod.pairff.CompositeFF(terms, coordinates)
+        references = self.make_terms(parameters, lambda i: scalings[i].copy())
+        self.check_composite(composite, references, coordinates)
+        # the geometry is shared with the terms
+        coordinates = coordinates + np.random.uniform(-0.1, 0.1, coordinates.shape)
+        composite.update_coordinates(coordinates)
+        for term in terms:
+            self.assert_(term.distances is composite.distances)
+        self.check_composite(composite, references, coordinates)
+
+    def test_sparse(self):
+        size = 40
+        coordinates = np.random.uniform(0, 8, (size, 3))
+        factors = {(0, 1): 0.0, (5, 3): 0.5}
+        cutoffs = [4.0, 3.0, 2.5]
+        parameters = self.make_parameters(size)
+        make_scaling = lambda i: molmod.pairff.CutoffScaling(cutoffs[i], factors)
+        composite = molmod.pairff.CompositeFF(self.make_terms(parameters, make_scaling), coordinates)
+        self.assertEqual(composite.scaling.cutoff, 4.0)
+        references = self.make_terms(parameters, make_scaling)
+        self.check_composite(composite, references, coordinates)
+
+    def test_sparse_unit_cell(self):
+        from molmod.unit_cells import UnitCell
+        size = 40
+        coordinates = np.random.uniform(0, 8, (size, 3))
+        parameters = self.make_parameters(size)
+        # equal unit cells that are different objects
+        make_scaling = lambda i: molmod.pairff.CutoffScaling(3.0, None, UnitCell(np.identity(3)*8.0))
+        composite = molmod.pairff.CompositeFF(self.make_terms(parameters, make_scaling), coordinates)
+        references = self.make_terms(parameters, make_scaling)
+        self.check_composite(composite, references, coordinates)
+        # different unit cells
+        make_scaling = lambda i: molmod.pairff.CutoffScaling(3.0, None, UnitCell(np.identity(3)*(8.0 + i)))
+        self.assertRaises(ValueError, molmod.pairff.CompositeFF, self.make_terms(parameters, make_scaling))
+        make_scaling = lambda i: molmod.pairff.CutoffScaling(3.0, None, [None, UnitCell(np.identity(3)*8.0)][i > 0])
+        self.assertRaises(ValueError, molmod.pairff.CompositeFF, self.make_terms(parameters, make_scaling))
+
+    def test_mixed(self):
+        parameters = self.make_parameters(5)
+        terms = self.make_terms(parameters, lambda i: [np.ones((5, 5)), molmod.pairff.CutoffScaling(3.0)][i%2])
+        self.assertRaises(ValueError, molmod.pairff.CompositeFF, terms)
+        self.assertRaises(ValueError, molmod.pairff.CompositeFF, [])
+
+
+class EwaldCoulombFFTestCase(BaseTestCase):
+    def make_nacl(self, size=5.0):
+        from molmod.unit_cells import UnitCell
+        unit_cell = UnitCell(np.identity(3)*size)
+        fractional = np.array([
+            [0.0, 0.0, 0.0], [0.0, 0.5, 0.5], [0.5, 0.0, 0.5], [0.5, 0.5, 0.0],
+            [0.5, 0.5, 0.5], [0.5, 0.0, 0.0], [0.0, 0.5, 0.0], [0.0, 0.0, 0.5],
+        ])
+        charges = np.array([1.0]*4 + [-1.0]*4)
+        return charges, unit_cell, unit_cell.to_cartesian(fractional)
+
+    def test_erfc(self):
+        import math
+        x = np.concatenate([np.linspace(-3, 30, 1001), np.random.uniform(0, 6, 1000)])
+        expected = np.array([math.erfc(value) for value in x])
+        result = molmod.pairff._erfc(x)
+        self.assert_((abs(result - expected) <= 1e-12*expected + 1e-290).all())
+        self.assertAlmostEqual(molmod.pairff._erfc(0.5), math.erfc(0.5), 14)
+
+    def make_random(self):
+        from molmod.unit_cells import UnitCell
+        unit_cell = UnitCell(np.array([[6.0, 0.5, 0.0], [0.3, 5.0, 0.2], [-0.4, 0.1, 5.5]]))
+        coordinates = np.random.uniform(0, 5, (6, 3))
+        charges = np.random.uniform(-1, 1, 6)
+        return charges, unit_cell, coordinates
+
+    def test_madelung(self):
+        charges, unit_cell, coordinates = self.make_nacl()
+        ff = molmod.pairff.EwaldCoulombFF(charges, unit_cell, coordinates)
+        # four formula units with a nearest-neighbor distance of 2.5
+        expected = -4*1.747564594633/2.5
+        self.assertAlmostEqual(ff.energy(), expected, 6)
+        self.assertArraysAlmostEqual(ff.gradient(), np.zeros((8, 3)), 1e-6, doabs=True)
+
+    def test_alpha(self):
+        charges, unit_cell, coordinates = self.make_random()
+        energies = []
+        for alpha in 0.4, 0.7, 1.0:
+            ff = molmod.pairff.EwaldCoulombFF(charges, unit_cell, coordinates, alpha=alpha)
+            energies.append(ff.energy())
+        self.assertAlmostEqual(energies[0], energies[1], 6)
+        self.assertAlmostEqual(energies[0], energies[2], 6)
+
+    def test_gradient(self):
+        charges, unit_cell, coordinates = self.make_random()
+        ff = molmod.pairff.EwaldCoulombFF(charges, unit_cell, coordinates, accuracy=1e-12)
+        gradient = ff.gradient()
+        eps = 1e-5
+        numerical = np.zeros(gradient.shape)
+        for i in xrange(len(coordinates)):
+            for j in xrange(3):
+                tmp = coordinates.copy()
+                tmp[i, j] += eps
+                ff.update_coordinates(tmp)
+                e_plus = ff.energy()
+                tmp[i, j] -= 2*eps
+                ff.update_coordinates(tmp)
+                e_min = ff.energy()
+                numerical[i, j] = (e_plus - e_min)/(2*eps)
+        self.assertArraysAlmostEqual(gradient, numerical, 1e-6, doabs=True)
+
+    def test_translation(self):
+        charges, unit_cell, coordinates = self.make_random()
+        ff = molmod.pairff.EwaldCoulombFF(charges, unit_cell, coordinates)
+        energy = ff.energy()
+        ff.update_coordinates(coordinates + unit_cell.matrix[:,1] + 0.3)
+        self.assertAlmostEqual(ff.energy(), energy, 8)
+
+    def test_non_periodic(self):
+        from molmod.unit_cells import UnitCell
+        unit_cell = UnitCell(np.identity(3)*5.0, np.array([True, True, False]))
+        self.assertRaises(ValueError, molmod.pairff.EwaldCoulombFF, np.ones(2), unit_cell)
+
+
+class TabulatedFFTestCase(BaseTestCase):
+    def make_ffs(self, size=30, scaling=None):
+        types = np.random.randint(0, 3, size)
+        types[:3] = [0, 1, 2]
+        coordinates = np.random.uniform(0, 6, (size, 3))
+        type_As = np.array([0.3, 0.5, 0.8])
+        type_Bs = np.array([0.9, 1.2, 1.5])
+        As = np.sqrt(np.outer(type_As[types], type_As[types]))
+        Bs = 0.5*np.add.outer(type_Bs[types], type_Bs[types])
+        if scaling is None:
+            scaling = 1 - np.identity(size, float)
+        analytic = molmod.pairff.ExpRepFF(scaling, As, Bs, coordinates)
+        tabulated = molmod.pairff.TabulatedFF(analytic, types, 0.5, 12.0, 1000, coordinates)
+        return analytic, tabulated
+
+    def test_compare_analytic(self):
+        analytic, tabulated = self.make_ffs()
+        self.assert_((tabulated.errors < [1e-8, 1e-6, 1e-4]).all())
+        self.assert_((tabulated.compute_errors(1000) < [1e-8, 1e-6, 1e-4]).all())
+        self.assertAlmostEqual(tabulated.energy(), analytic.energy(), 8)
+        self.assertArraysAlmostEqual(tabulated.gradient(), analytic.gradient(), 1e-6)
+        self.assertArraysAlmostEqual(tabulated.hessian(), analytic.hessian(), 1e-4)
+
+    def test_outside_range(self):
+        analytic, tabulated = self.make_ffs()
+        # move two atoms closer than r_min and two atoms beyond r_max
+        coordinates = analytic.coordinates.copy()
+        coordinates[1] = coordinates[0] + [0.3, 0.0, 0.0]
+        coordinates[2] = coordinates[0] + [0.0, 0.0, 20.0]
+        analytic.update_coordinates(coordinates)
+        tabulated.update_coordinates(coordinates)
+        self.assertAlmostEqual(tabulated.energy(), analytic.energy(), 8)
+        self.assertArraysAlmostEqual(tabulated.gradient(), analytic.gradient(), 1e-6)
+
+    def test_combined(self):
+        analytic, tabulated = self.make_ffs()
+        strengths = np.random.uniform(1, 2, 3)[tabulated.types]
+        dispersion = molmod.pairff.DispersionFF(analytic.scaling, -np.outer(strengths, strengths), analytic.coordinates)
+        combined = molmod.pairff.TabulatedFF([analytic, dispersion], tabulated.types, 1.0, 12.0, 2000, analytic.coordinates)
+        self.assert_((combined.errors < [1e-7, 1e-6, 1e-3]).all())
+        self.assertAlmostEqual(combined.energy(), analytic.energy() + dispersion.energy(), 6)
+        self.assertArraysAlmostEqual(combined.gradient(), analytic.gradient() + dispersion.gradient(), 1e-5)
+
+    def test_sparse(self):
+        scaling = molmod.pairff.CutoffScaling(4.0)
+        analytic, tabulated = self.make_ffs(scaling=scaling)
+        self.assert_(tabulated.sparse)
+        self.assertAlmostEqual(tabulated.energy(), analytic.energy(), 8)
+
+    def test_not_radial(self):
+        scaling = 1 - np.identity(3, float)
+        ff = molmod.pairff.CoulombFF(scaling, dipoles=np.random.normal(0, 1, (3, 3)))
+        self.assertRaises(TypeError, molmod.pairff.TabulatedFF, ff, [0, 1, 2], 0.5, 5.0)
+        ff = molmod.pairff.DispersionFF(scaling, np.ones((3, 3)))
+        self.assertRaises(ValueError, molmod.pairff.TabulatedFF, ff, [0, 1, 2], 5.0, 0.5)
+
+    def test_solve_tridiagonal(self):
+        n = 7
+        lower = np.random.uniform(-1, 1, n-1)
+        upper = np.random.uniform(-1, 1, n-1)
+        diagonal = np.random.uniform(3, 4, n)
+        matrix = np.diag(diagonal) + np.diag(lower, -1) + np.diag(upper, 1)
+        rhs = np.random.normal(0, 1, (n, 4))
+        solution = molmod.pairff._solve_tridiagonal(lower, diagonal, upper, rhs)
+        self.assertArraysAlmostEqual(solution, np.linalg.solve(matrix, rhs), 1e-10)
+
+    def test_inconsistent_types(self):
+        analytic, tabulated = self.make_ffs()
+        types = tabulated.types.copy()
+        # atoms 0 and 1 have different parameters
+        types[1] = 0
+        self.assertRaises(ValueError, molmod.pairff.TabulatedFF, analytic, types, 0.5, 12.0)
+        scaling = 1 - np.identity(3, float)
+        ff = molmod.pairff.CoulombFF(scaling, charges=np.array([0.5, -0.5, 0.5]))
+        molmod.pairff.TabulatedFF(ff, [0, 1, 0], 0.5, 5.0)
+        self.assertRaises(ValueError, molmod.pairff.TabulatedFF, ff, [0, 0, 1], 0.5, 5.0)
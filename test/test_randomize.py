@@ -24,6 +24,7 @@
 from common import BaseTestCase
 
 from molmod.randomize import *
+from molmod.randomize import _NonbondChecker
 from molmod.molecules import Molecule
 from molmod.units import angstrom
 from molmod.transformations import Translation, Rotation
@@ -91,3 +92,28 @@ class RandomizeTestCase(BaseTestCase):
                 self.assertEqual(mol_transformation.affected_atoms, check_transformation.affected_atoms)
                 self.assertArraysAlmostEqual(mol_transformation.transformation.r, check_transformation.transformation.r, 1e-5, doabs=True)
                 self.assertArraysAlmostEqual(mol_transformation.transformation.t, check_transformation.transformation.t, 1e-5, doabs=True)
+
+    def test_nonbond_checker(self):
+        for molecule in self.iter_test_molecules():
+            manipulations = generate_manipulations(molecule)
+            checker = _NonbondChecker(molecule, nonbond_thresholds)
+            for i in xrange(20):
+                random_molecule = randomize_molecule_low(molecule, manipulations)
+                outcome = check_nonbond(random_molecule, nonbond_thresholds)
+                self.assertEqual(checker.check(random_molecule.coordinates), outcome)
+            self.assertEqual(checker.check(molecule.coordinates), check_nonbond(molecule, nonbond_thresholds))
+
+    def test_nonbond_periodic(self):
+        from molmod.molecular_graphs import MolecularGraph
+        from molmod.unit_cells import UnitCell
+        # a chain of four carbon atoms, whose ends only meet through the
+        # periodic boundary
+        numbers = numpy.array([6, 6, 6, 6])
+        coordinates = numpy.array([[0.5, 0, 0], [3.0, 0, 0], [5.5, 0, 0], [8.0, 0, 0]])
+        graph = MolecularGraph([(0, 1), (1, 2), (2, 3)], numbers)
+        molecule = Molecule(numbers, coordinates, graph=graph)
+        self.assert_(check_nonbond(molecule, nonbond_thresholds))
+        molecule = Molecule(numbers, coordinates, graph=graph, unit_cell=UnitCell(numpy.identity(3)*9.0))
+        self.assertFalse(check_nonbond(molecule, nonbond_thresholds))
+        checker = _NonbondChecker(molecule, nonbond_thresholds)
+        self.assertFalse(checker.check(molecule.coordinates))
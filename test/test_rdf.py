@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# MolMod is a collection of molecular modelling tools for python.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of MolMod.
+#
+# MolMod is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# MolMod is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from common import BaseTestCase
+
+from molmod.rdf import *
+from molmod.unit_cells import UnitCell
+from molmod.io.dlpoly import DLPolyHistoryReader
+from molmod.io.xyz import XYZReader
+
+import numpy
+
+
+__all__ = ["RDFTestCase"]
+
+
+class RDFTestCase(BaseTestCase):
+    def get_counts(self, frames, unit_cell, r_max, num_bins, indexes0, indexes1):
+        counts = numpy.zeros(num_bins, int)
+        for coordinates in frames:
+            for i in indexes0:
+                for j in indexes1:
+                    if i == j:
+                        continue
+                    delta = unit_cell.minimum_image(coordinates[j] - coordinates[i])
+                    distance = numpy.linalg.norm(delta)
+                    if distance < r_max:
+                        counts[int(distance/r_max*num_bins)] += 1
+        return counts
+
+    def test_counts_intra(self):
+        unit_cell = UnitCell(numpy.diag([10.0, 12.0, 11.0]))
+        frames = [numpy.random.uniform(0, 10, (30, 3)) for i in xrange(3)]
+        rdf = RDF(4.5, 20, unit_cell)
+        rdf.add_frames(frames)
+        self.assertEqual(rdf.num_frames, 3)
+        expected = self.get_counts(frames, unit_cell, 4.5, 20, range(30), range(30))
+        self.assertEqual(rdf.counts.tolist(), expected.tolist())
+
+    def test_counts_inter(self):
+        unit_cell = UnitCell.from_parameters3(
+            numpy.array([10.0, 12.0, 11.0]),
+            numpy.array([80.0, 95.0, 100.0])*numpy.pi/180,
+        )
+        numbers = numpy.array([1, 8, 1]*10)
+        frames = [
+            ("title", unit_cell.to_cartesian(numpy.random.uniform(0, 1, (30, 3))))
+            for i in xrange(3)
+        ]
+        rdf = RDF(4.0, 10, unit_cell, "O", range(20), numbers)
+        rdf.add_frames(frames)
+        expected = self.get_counts([c for t, c in frames], unit_cell, 4.0, 10, (numbers == 8).nonzero()[0], range(20))
+        self.assertEqual(rdf.counts.tolist(), expected.tolist())
+        g = rdf.get_rdf()
+        self.assertEqual(g.shape, (10,))
+
+    def test_ideal_gas(self):
+        unit_cell = UnitCell(numpy.identity(3)*20.0)
+        rdf = RDF(8.0, 8, unit_cell)
+        for i in xrange(20):
+            rdf.add_frame(numpy.random.uniform(0, 20, (200, 3)))
+        g = rdf.get_rdf()
+        self.assert_(abs(g[2:] - 1).max() < 0.2)
+
+    def test_dlpoly(self):
+        hr = DLPolyHistoryReader("input/dlpoly_HISTORY")
+        unit_cell = UnitCell(hr.next()["cell"])
+        r_max = 0.49*unit_cell.spacings.min()
+        rdf = RDF(r_max, 10, unit_cell)
+        rdf.add_frames(DLPolyHistoryReader("input/dlpoly_HISTORY"))
+        self.assert_(rdf.num_frames > 1)
+        self.assert_(rdf.counts.sum() > 0)
+
+    def test_errors(self):
+        unit_cell = UnitCell(numpy.identity(3)*10.0)
+        self.assertRaises(ValueError, RDF, 6.0, 10, unit_cell)
+        self.assertRaises(ValueError, RDF, 4.0, 10, UnitCell(numpy.identity(3)*10.0, numpy.array([True, True, False])))
+        self.assertRaises(ValueError, RDF, 4.0, 10, unit_cell, 8)
+        rdf = RDF(4.0, 10, unit_cell)
+        self.assertRaises(ValueError, rdf.get_rdf)
+        self.assertRaises(TypeError, rdf.add_frames, [object()])
@@ -470,6 +470,104 @@ class UnitCellTestCase(BaseTestCase):
         ])
         self.assertArraysAlmostEqual(uc.matrix, expected_matrix)
 
+    def test_transforms_out(self):
+        import molmod.unit_cells
+        for full in True, False:
+            uc = self.get_random_uc(full=full)
+            cartesian = numpy.random.uniform(-3, 3, (4,5,3))
+            fractional = uc.to_fractional(cartesian)
+            self.assertEqual(fractional.shape, (4,5,3))
+            for i in xrange(4):
+                self.assertArraysAlmostEqual(fractional[i], uc.to_fractional(cartesian[i]), doabs=True)
+            out = numpy.zeros((4,5,3), float)
+            self.assert_(uc.to_fractional(cartesian, out) is out)
+            self.assertArraysAlmostEqual(out, fractional, doabs=True)
+            shortest = uc.shortest_vector(cartesian)
+            self.assertArraysAlmostEqual(uc.shortest_vector(cartesian, out), shortest, doabs=True)
+            # in place, with blocks smaller than the array
+            block_size = molmod.unit_cells._block_size
+            molmod.unit_cells._block_size = 7
+            try:
+                work = cartesian.copy()
+                uc.to_fractional(work, work)
+                self.assertArraysAlmostEqual(work, fractional, doabs=True)
+                uc.to_cartesian(work, work)
+                self.assertArraysAlmostEqual(work, uc.to_cartesian(fractional), doabs=True)
+                work[:] = cartesian
+                uc.shortest_vector(work, work)
+                self.assertArraysAlmostEqual(work, shortest, doabs=True)
+            finally:
+                molmod.unit_cells._block_size = block_size
+            # a non-contiguous output array
+            out = numpy.zeros((5,4,3), float).transpose(1,0,2)
+            uc.to_fractional(cartesian, out)
+            self.assertArraysAlmostEqual(out, fractional, doabs=True)
+            self.assertRaises(TypeError, uc.to_cartesian, fractional, numpy.zeros((4,3)))
+
+    def test_wrap(self):
+        for full in True, False:
+            uc = self.get_random_uc(full=full)
+            trajectory = numpy.random.uniform(-10, 10, (3,6,3))
+            wrapped = uc.wrap(trajectory)
+            fractional = uc.to_fractional(wrapped)
+            active = uc.active
+            self.assert_((fractional[...,active] >= -1e-10).all())
+            self.assert_((fractional[...,active] < 1+1e-10).all())
+            # the difference must be a lattice vector
+            index = uc.to_fractional(trajectory - wrapped)
+            self.assertArraysAlmostEqual(index, numpy.round(index), doabs=True)
+            # only translations along the active cell vectors
+            self.assertArraysAlmostEqual(uc.to_cartesian(numpy.round(index)), trajectory - wrapped, doabs=True)
+            self.assertArraysAlmostEqual(uc.wrap(trajectory[1,2]), wrapped[1,2], doabs=True)
+            uc.wrap(trajectory, trajectory)
+            self.assertArraysAlmostEqual(trajectory, wrapped, doabs=True)
+
+    def test_reduced(self):
+        for counter in xrange(20):
+            uc = self.get_random_uc(full=(counter%2==0))
+            if not uc.active.any():
+                continue
+            reduced = uc.reduced
+            self.assertArraysEqual(reduced.active, uc.active)
+            self.assertAlmostEqual(reduced.volume, uc.volume)
+            active, inactive = uc.active_inactive
+            # the same lattice and the same orientation
+            transformation = uc.to_fractional(reduced.matrix.transpose())[:,active][active]
+            self.assertArraysAlmostEqual(transformation, numpy.round(transformation), doabs=True)
+            self.assertAlmostEqual(numpy.linalg.det(transformation), 1.0)
+            self.assertArraysEqual(reduced.matrix[:,inactive], uc.matrix[:,inactive])
+            # no cell vector is shortened by adding or subtracting the others
+            matrix = reduced.matrix[:,active]
+            norms = numpy.sqrt((matrix**2).sum(axis=0))
+            for i in xrange(len(active)):
+                for j in xrange(len(active)):
+                    if i != j:
+                        for sign in -1, 1:
+                            self.assert_(numpy.linalg.norm(matrix[:,i] + sign*matrix[:,j]) >= norms[i]*(1-1e-10))
+            # the reduced cell is not more skewed than the original
+            self.assert_(reduced.spacings[active].min() >= uc.spacings[active].min()*(1-1e-10))
+        # a simple case
+        uc = UnitCell(numpy.array([[1.0, 0.0, 0.0], [5.0, 1.0, 0.0], [-3.0, 2.0, 1.0]]).transpose())
+        self.assertArraysAlmostEqual(abs(uc.reduced.matrix), numpy.identity(3), doabs=True)
+        self.assertAlmostEqual(numpy.linalg.det(uc.reduced.matrix), 1.0)
+
+    def test_optimal_subcell(self):
+        for counter in xrange(20):
+            uc = self.get_random_uc(full=(counter%2==0))
+            if not uc.active.any():
+                continue
+            max_spacing = numpy.random.uniform(0.1, 1.0)
+            grid = uc.get_optimal_subcell(max_spacing)
+            active = uc.active
+            self.assert_((grid.spacings[active] <= max_spacing*(1+1e-10)).all())
+            # the cell vectors are not divided more than needed
+            divided = abs(grid.spacings - uc.reduced.spacings) > 1e-10
+            self.assert_((grid.spacings[active & divided] > 0.5*max_spacing*(1-1e-10)).all())
+            # the unit cell vectors are integer combinations of the grid vectors
+            integer_matrix = grid.to_fractional(uc.matrix[:,active].transpose())
+            self.assertArraysAlmostEqual(integer_matrix, numpy.round(integer_matrix), doabs=True)
+        self.assertRaises(ValueError, uc.get_optimal_subcell, 0.0)
+
     def test_shortest_vector_aperiodic(self):
         unit_cell = UnitCell(numpy.identity(3, float), numpy.zeros(3, bool))
         shortest = unit_cell.shortest_vector(numpy.ones(3, float))
@@ -487,3 +585,34 @@ class UnitCellTestCase(BaseTestCase):
             for i1, i0 in enumerate(uc0.active_inactive[0]):
                 self.assertArraysAlmostEqual(uc0.matrix[:,i0], uc1.matrix[:,i1])
                 self.assertEqual(uc0.active[i0], uc1.active[i1])
+
+    def test_minimum_image(self):
+        for uc_counter in xrange(20):
+            while True:
+                uc = self.get_random_uc(full=(uc_counter%2==0))
+                if not uc.active.any() or uc.spacings[uc.active].min() > 0.5:
+                    break
+            r0 = numpy.random.normal(0, 10, (20,3))
+            r1 = uc.minimum_image(r0)
+            self.assertEqual(r1.shape, r0.shape)
+            for i in xrange(len(r0)):
+                self.assertArraysAlmostEqual(uc.minimum_image(r0[i]), r1[i], doabs=True)
+                # the difference must be a lattice vector
+                index = uc.to_fractional(r0[i] - r1[i])
+                self.assertArraysAlmostEqual(index, numpy.round(index), doabs=True)
+                # the result may not be longer than the shortest_vector
+                norm = numpy.linalg.norm(r1[i])
+                self.assert_(norm <= numpy.linalg.norm(uc.shortest_vector(r0[i]))*(1+1e-10))
+                # brute force check with all lattice vectors shorter than 2*norm
+                ranges = uc.get_radius_ranges(2*norm)
+                for j0 in xrange(-ranges[0], ranges[0]+1):
+                    for j1 in xrange(-ranges[1], ranges[1]+1):
+                        for j2 in xrange(-ranges[2], ranges[2]+1):
+                            other = r1[i] - uc.to_cartesian([j0, j1, j2])
+                            self.assert_(numpy.linalg.norm(other) >= norm*(1-1e-10))
+
+    def test_minimum_image_orthorhombic(self):
+        uc = UnitCell(numpy.diag([3.0, 4.0, 5.0]))
+        self.assertEqual(len(uc.image_shifts), 1)
+        r0 = numpy.random.normal(0, 10, (5,4,3))
+        self.assertArraysAlmostEqual(uc.minimum_image(r0), uc.shortest_vector(r0), doabs=True)